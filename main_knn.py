@@ -20,100 +20,72 @@
 import json
 import os
 from pathlib import Path
-from typing import Tuple
+from typing import Optional, Tuple
 
 import torch
-import torch.nn as nn
 from omegaconf import OmegaConf
 from torch.utils.data import DataLoader
-from tqdm import tqdm
 
 from solo.args.knn import parse_args_knn
-from solo.data.classification_dataloader import (
-    prepare_dataloaders,
-    prepare_datasets,
-    prepare_transforms,
-)
+from solo.data.classification_dataloader import prepare_datasets, prepare_transforms
+from solo.data.loader import dataloader_kwargs
 from solo.methods import METHODS
+from solo.utils.feature_store import FeatureStore, extract_or_load_features, feature_store_key
 from solo.utils.knn import WeightedKNNClassifier
 
 
 @torch.no_grad()
-def extract_features(loader: DataLoader, model: nn.Module) -> Tuple[torch.Tensor]:
-    """Extract features from a data loader using a model.
-
-    Args:
-        loader (DataLoader): dataloader for a dataset.
-        model (nn.Module): torch module used to extract features.
-
-    Returns:
-        Tuple(torch.Tensor): tuple containing the backbone features, projector features and labels.
-    """
-
-    model.eval()
-    backbone_features, proj_features, labels = [], [], []
-    for im, lab in tqdm(loader):
-        im = im.cuda(non_blocking=True)
-        lab = lab.cuda(non_blocking=True)
-        outs = model(im)
-        backbone_features.append(outs["feats"].detach())
-        proj_features.append(outs["z"])
-        labels.append(lab)
-    model.train()
-    backbone_features = torch.cat(backbone_features)
-    proj_features = torch.cat(proj_features)
-    labels = torch.cat(labels)
-    return backbone_features, proj_features, labels
-
-
-@torch.no_grad()
-def run_knn(
+def compute_knn_neighbors(
     train_features: torch.Tensor,
     train_targets: torch.Tensor,
     test_features: torch.Tensor,
     test_targets: torch.Tensor,
     k: int,
-    T: float,
     distance_fx: str,
-) -> Tuple[float]:
-    """Runs offline knn on a train and a test dataset.
+    cache_path: Optional[Path] = None,
+) -> Tuple[WeightedKNNClassifier, torch.Tensor, torch.Tensor]:
+    """Finds the top-k neighbors of the test features once, so that the accuracy of every
+    smaller k and every temperature can be derived from them.
 
     Args:
         train_features (torch.Tensor, optional): train features.
         train_targets (torch.Tensor, optional): train targets.
         test_features (torch.Tensor, optional): test features.
         test_targets (torch.Tensor, optional): test targets.
-        k (int): number of neighbors.
-        T (float): temperature for the exponential. Only used with cosine
-            distance.
+        k (int): maximum number of neighbors.
         distance_fx (str): distance function.
+        cache_path (Optional[Path]): file where the neighbors are cached. They are loaded
+            from it if it exists. Defaults to None.
 
     Returns:
-        Tuple[float]: tuple containing the the knn acc@1 and acc@5 for the model.
+        Tuple[WeightedKNNClassifier, torch.Tensor, torch.Tensor]: the knn classifier, and the
+            similarities and targets of the sorted top-k neighbors of each test sample.
     """
 
-    # build knn
-    knn = WeightedKNNClassifier(
-        k=k,
-        T=T,
-        distance_fx=distance_fx,
-    )
+    knn = WeightedKNNClassifier(k=k, distance_fx=distance_fx, streaming=True)
 
-    # add features
-    knn(
+    if cache_path is not None and cache_path.exists():
+        cached = torch.load(cache_path, map_location=test_features.device)
+        similarities, neighbors = cached["similarities"], cached["neighbors"]
+        assert (
+            similarities.size(0) == neighbors.size(0) == test_targets.size(0)
+        ), f"The neighbors cached in {cache_path} do not match the test set."
+        return knn, similarities, neighbors
+
+    knn.update(
         train_features=train_features,
         train_targets=train_targets,
         test_features=test_features,
         test_targets=test_targets,
     )
+    similarities, neighbors, _ = knn.compute_neighbors()
+    knn.reset()
 
-    # compute
-    acc1, acc5 = knn.compute()
-
-    # free up memory
-    del knn
+    if cache_path is not None:
+        cache_path.parent.mkdir(parents=True, exist_ok=True)
+        torch.save({"similarities": similarities, "neighbors": neighbors}, cache_path)
 
-    return acc1, acc5
+    return knn, similarities, neighbors
 
 
 def main():
@@ -142,38 +114,61 @@ def main():
         val_data_path=args.val_data_path,
         data_format=args.data_format,
     )
-    train_loader, val_loader = prepare_dataloaders(
-        train_dataset,
-        val_dataset,
-        batch_size=args.batch_size,
-        num_workers=args.num_workers,
-    )
-
-    # extract train features
-    train_features_bb, train_features_proj, train_targets = extract_features(train_loader, model)
-    train_features = {"backbone": train_features_bb, "projector": train_features_proj}
-
-    # extract test features
-    test_features_bb, test_features_proj, test_targets = extract_features(val_loader, model)
-    test_features = {"backbone": test_features_bb, "projector": test_features_proj}
+    # the features are extracted in the dataset order, without dropping samples
+    loader_kwargs = dataloader_kwargs(args.num_workers)
+    train_loader = DataLoader(train_dataset, batch_size=args.batch_size, **loader_kwargs)
+    val_loader = DataLoader(val_dataset, batch_size=args.batch_size, **loader_kwargs)
+
+    # extract the features or load them from the feature store
+    store = FeatureStore(args.feature_cache_dir) if args.feature_cache_dir else None
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    features, keys = {}, {}
+    for split, loader, data_path in [
+        ("train", train_loader, args.train_data_path),
+        ("val", val_loader, args.val_data_path),
+    ]:
+        key = None
+        if store is not None or args.knn_cache_dir is not None:
+            key = feature_store_key(ckpt_path, f"{args.dataset}:{data_path}", T, split)
+        keys[split] = key
+        features[split] = extract_or_load_features(loader, model, store, key, device=device)
+
+    feature_names = {"backbone": "feats", "projector": "z"}
+    for feat_type in args.feature_type:
+        assert (
+            feature_names[feat_type] in features["train"]
+        ), f"The model does not produce {feat_type} features."
+    train_targets = features["train"]["targets"].to(device)
+    test_targets = features["val"]["targets"].to(device)
 
     # run k-nn for all possible combinations of parameters
+    # the neighbors are searched once per distance function, at the largest k
+    max_k = max(args.k)
     for feat_type in args.feature_type:
         print(f"\n### {feat_type.upper()} ###")
-        for k in args.k:
-            for distance_fx in args.distance_function:
-                temperatures = args.temperature if distance_fx == "cosine" else [None]
+        for distance_fx in args.distance_function:
+            cache_path = None
+            if args.knn_cache_dir is not None:
+                # the feature keys identify the checkpoint, data and transforms
+                cache_path = Path(args.knn_cache_dir) / (
+                    f"{keys['train']}-{keys['val']}-{feat_type}-{distance_fx}-k={max_k}.pt"
+                )
+            knn, similarities, neighbors = compute_knn_neighbors(
+                train_features=features["train"][feature_names[feat_type]].to(device).float(),
+                train_targets=train_targets,
+                test_features=features["val"][feature_names[feat_type]].to(device).float(),
+                test_targets=test_targets,
+                k=max_k,
+                distance_fx=distance_fx,
+                cache_path=cache_path,
+            )
+            temperatures = args.temperature if distance_fx == "cosine" else [None]
+            for k in args.k:
                 for T in temperatures:
                     print("---")
                     print(f"Running k-NN with params: distance_fx={distance_fx}, k={k}, T={T}...")
-                    acc1, acc5 = run_knn(
-                        train_features=train_features[feat_type],
-                        train_targets=train_targets,
-                        test_features=test_features[feat_type],
-                        test_targets=test_targets,
-                        k=k,
-                        T=T,
-                        distance_fx=distance_fx,
+                    acc1, acc5 = knn.accuracy_from_neighbors(
+                        similarities, neighbors, test_targets, k=k, T=T
                     )
                     print(f"Result: acc@1={acc1}, acc@5={acc5}")
 
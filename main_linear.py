@@ -20,24 +20,28 @@
 import inspect
 import logging
 import os
+from typing import Optional
 
 import hydra
 import torch
 import torch.nn as nn
-from lightning.pytorch import Trainer
+from lightning.pytorch import LightningDataModule, Trainer
 from lightning.pytorch.callbacks import LearningRateMonitor
 from lightning.pytorch.loggers import WandbLogger
 from lightning.pytorch.strategies.ddp import DDPStrategy
 from omegaconf import DictConfig, OmegaConf
 from timm.data.mixup import Mixup
 from timm.loss import LabelSmoothingCrossEntropy, SoftTargetCrossEntropy
+from torch.utils.data import DataLoader, TensorDataset
 
 from solo.args.linear import parse_cfg
-from solo.data.classification_dataloader import prepare_data
+from solo.data.classification_dataloader import prepare_data, prepare_dataloaders
+from solo.data.loader import dataloader_kwargs
 from solo.methods.base import BaseMethod
 from solo.methods.linear import LinearModel
 from solo.utils.auto_resumer import AutoResumer
 from solo.utils.checkpointer import Checkpointer
+from solo.utils.feature_store import FeatureStore, extract_or_load_features, feature_store_key
 from solo.utils.misc import make_contiguous
 
 try:
@@ -48,6 +52,79 @@ else:
     _dali_avaliable = True
 
 
+class CachedFeaturesDataModule(LightningDataModule):
+    def __init__(
+        self,
+        backbone: nn.Module,
+        train_loader: DataLoader,
+        val_loader: DataLoader,
+        cfg: DictConfig,
+    ):
+        """Serves the features of the frozen backbone instead of the images. The features are
+        extracted once, by the local rank 0 of each node in prepare_data, and saved in the
+        feature store, from which every rank loads them in setup. The train features contain
+        cfg.cached_features.num_views augmented views of each sample.
+
+        Args:
+            backbone (nn.Module): frozen backbone.
+            train_loader (DataLoader): train dataloader of images.
+            val_loader (DataLoader): validation dataloader of images.
+            cfg (DictConfig): linear evaluation config.
+        """
+
+        super().__init__()
+
+        self.backbone = backbone
+        self.batch_size = cfg.optimizer.batch_size
+        self.store = FeatureStore(cfg.cached_features.dir)
+
+        loader_kwargs = dataloader_kwargs(cfg.data.num_workers)
+        self.splits = {}
+        for split, loader, data_path, num_views in [
+            ("train", train_loader, cfg.data.train_path, cfg.cached_features.num_views),
+            ("val", val_loader, cfg.data.val_path, 1),
+        ]:
+            # the samples are extracted in order, without dropping any
+            dataset = loader.dataset
+            loader = DataLoader(
+                dataset, batch_size=cfg.cached_features.extraction_batch_size, **loader_kwargs
+            )
+            key = feature_store_key(
+                cfg.pretrained_feature_extractor,
+                f"{cfg.data.dataset}:{data_path}",
+                getattr(dataset, "transform", None),
+                split,
+                num_views=num_views,
+            )
+            self.splits[split] = (loader, key, num_views)
+
+        self.loaders = None
+
+    def prepare_data(self):
+        # runs on a single process per node, on the device of that process
+        device = self.trainer.strategy.root_device
+        for loader, key, num_views in self.splits.values():
+            if key not in self.store:
+                extract_or_load_features(
+                    loader, self.backbone, self.store, key, num_views=num_views, device=device
+                )
+
+    def setup(self, stage: Optional[str] = None):
+        datasets = []
+        for _, key, _ in self.splits.values():
+            features = self.store.load(key)
+            datasets.append(TensorDataset(features["feats"], features["targets"]))
+
+        # the features are already in memory, so there is no need for workers
+        self.loaders = prepare_dataloaders(*datasets, batch_size=self.batch_size, num_workers=0)
+
+    def train_dataloader(self) -> DataLoader:
+        return self.loaders[0]
+
+    def val_dataloader(self) -> DataLoader:
+        return self.loaders[1]
+
+
 @hydra.main(version_base="1.2")
 def main(cfg: DictConfig):
     # hydra doesn't allow us to add new keys for "safety"
@@ -125,8 +202,14 @@ def main(cfg: DictConfig):
         batch_size=cfg.optimizer.batch_size,
         num_workers=cfg.data.num_workers,
         auto_augment=cfg.auto_augment,
+        loader_kwargs=cfg.data.loader,
+        ram_cache_dir=cfg.data.ram_cache_dir,
     )
 
+    if cfg.cached_features.enabled:
+        assert cfg.data.format != "dali", "Cached features are not supported with Dali."
+        cached_datamodule = CachedFeaturesDataModule(backbone, train_loader, val_loader, cfg)
+
     if cfg.data.format == "dali":
         assert (
             _dali_avaliable
@@ -212,6 +295,8 @@ def main(cfg: DictConfig):
 
     if cfg.data.format == "dali":
         trainer.fit(model, ckpt_path=ckpt_path, datamodule=dali_datamodule)
+    elif cfg.cached_features.enabled:
+        trainer.fit(model, ckpt_path=ckpt_path, datamodule=cached_datamodule)
     else:
         trainer.fit(model, train_loader, val_loader, ckpt_path=ckpt_path)
 
@@ -29,13 +29,21 @@ from lightning.pytorch.strategies.ddp import DDPStrategy
 from omegaconf import DictConfig, OmegaConf
 from solo.args.pretrain import parse_cfg
 from solo.data.classification_dataloader import prepare_data as prepare_data_classification
+from solo.data.batched_augmentations import (
+    BatchedAugmentationCollate,
+    MultiCropBatchedAugmentation,
+)
 from solo.data.pretrain_dataloader import (
     FullTransformPipeline,
+    MAETargetPipeline,
     NCropAugmentation,
+    build_batched_transform_pipeline,
     build_transform_pipeline,
+    prepare_multicrop_generator,
     prepare_dataloader,
     prepare_datasets,
 )
+from solo.data.sampler import ResumableDistributedSampler
 from solo.methods import METHODS
 from solo.utils.auto_resumer import AutoResumer
 from solo.utils.checkpointer import Checkpointer
@@ -95,9 +103,41 @@ def main(cfg: DictConfig):
             data_format=val_data_format,
             batch_size=cfg.optimizer.batch_size,
             num_workers=cfg.data.num_workers,
+            loader_kwargs=cfg.data.loader,
+            # Lightning does not shard the data when the resumable sampler is used
+            shard_val=cfg.data.resumable_sampler,
         )
 
     # pretrain dataloader
+    if cfg.data.resumable_sampler:
+        assert cfg.data.format != "dali", "The resumable sampler is not supported with dali."
+    if cfg.data.precompute_mae_targets:
+        assert cfg.method in ["mae", "mae-reg", "u-mae"]
+        assert cfg.data.format != "dali", "MAE targets can not be precomputed with dali."
+    if cfg.data.batched_augmentations:
+        assert cfg.data.format != "dali", "Batched augmentations are not supported with dali."
+        assert (
+            not cfg.data.precompute_mae_targets
+        ), "MAE targets can not be precomputed before the batched augmentations."
+    if cfg.data.decode_once_crops:
+        assert cfg.data.format != "dali", "Decode-once crops are not supported with dali."
+        if not cfg.data.batched_augmentations:
+            # the crops are only cropped and normalized, so nothing else can be enabled
+            for aug_cfg in cfg.augmentations:
+                for aug in [
+                    "color_jitter",
+                    "grayscale",
+                    "gaussian_blur",
+                    "solarization",
+                    "equalization",
+                    "horizontal_flip",
+                ]:
+                    assert not aug_cfg[aug].prob, (
+                        "Decode-once crops without batched augmentations "
+                        f"only support random resized crops, but {aug} is enabled."
+                    )
+
+    train_sampler = None
     if cfg.data.format == "dali":
         assert (
             _dali_avaliable
@@ -130,13 +170,39 @@ def main(cfg: DictConfig):
         dali_datamodule.val_dataloader = lambda: val_loader
     else:
         pipelines = []
+        batched_augmentations = []
         for aug_cfg in cfg.augmentations:
-            pipelines.append(
-                NCropAugmentation(
-                    build_transform_pipeline(cfg.data.dataset, aug_cfg), aug_cfg.num_crops
+            if cfg.data.batched_augmentations:
+                aug_transform, batched_aug = build_batched_transform_pipeline(
+                    cfg.data.dataset, aug_cfg
                 )
+                batched_augmentations.extend([batched_aug] * aug_cfg.num_crops)
+            else:
+                aug_transform = build_transform_pipeline(cfg.data.dataset, aug_cfg)
+            pipelines.append(NCropAugmentation(aug_transform, aug_cfg.num_crops))
+        if cfg.data.decode_once_crops:
+            transform = prepare_multicrop_generator(
+                cfg.data.dataset,
+                cfg.augmentations,
+                normalize=not cfg.data.batched_augmentations,
             )
-        transform = FullTransformPipeline(pipelines)
+        else:
+            transform = FullTransformPipeline(pipelines)
+        if cfg.data.precompute_mae_targets:
+            transform = MAETargetPipeline(
+                transform,
+                num_large_crops=cfg.data.num_large_crops,
+                patch_size=model._vit_patch_size,
+                norm_pix_loss=model.norm_pix_loss,
+            )
+
+        collate_fn = None
+        if cfg.data.batched_augmentations:
+            batched_augmentation = MultiCropBatchedAugmentation(batched_augmentations)
+            if cfg.data.batched_augmentations_on_device:
+                model.batched_augmentation = batched_augmentation
+            else:
+                collate_fn = BatchedAugmentationCollate(batched_augmentation)
 
         if cfg.debug_augmentations:
             print("Transforms:")
@@ -149,9 +215,17 @@ def main(cfg: DictConfig):
             data_format=cfg.data.format,
             no_labels=cfg.data.no_labels,
             data_fraction=cfg.data.fraction,
+            ram_cache_dir=cfg.data.ram_cache_dir,
         )
+        if cfg.data.resumable_sampler:
+            train_sampler = ResumableDistributedSampler(train_dataset, seed=cfg.seed)
         train_loader = prepare_dataloader(
-            train_dataset, batch_size=cfg.optimizer.batch_size, num_workers=cfg.data.num_workers
+            train_dataset,
+            batch_size=cfg.optimizer.batch_size,
+            num_workers=cfg.data.num_workers,
+            collate_fn=collate_fn,
+            sampler=train_sampler,
+            **cfg.data.loader,
         )
 
     # 1.7 will deprecate resume_from_checkpoint, but for the moment
@@ -181,6 +255,8 @@ def main(cfg: DictConfig):
             logdir=os.path.join(cfg.checkpoint.dir, cfg.method),
             frequency=cfg.checkpoint.frequency,
             keep_prev=cfg.checkpoint.keep_prev,
+            every_n_steps=cfg.checkpoint.every_n_steps,
+            sampler=train_sampler,
         )
         callbacks.append(ckpt)
 
@@ -226,6 +302,10 @@ def main(cfg: DictConfig):
             else cfg.strategy,
         }
     )
+    if cfg.data.resumable_sampler:
+        # the train sampler already shards the data across the processes and the validation
+        # dataloader has its own sampler, so Lightning must not replace them
+        trainer_kwargs["use_distributed_sampler"] = False
     trainer = Trainer(**trainer_kwargs)
 
     if cfg.data.format == "dali":
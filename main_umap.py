@@ -21,12 +21,16 @@ import json
 import os
 from pathlib import Path
 
+import torch
 from omegaconf import OmegaConf
+from torch.utils.data import DataLoader
 
 from solo.args.umap import parse_args_umap
-from solo.data.classification_dataloader import prepare_data
+from solo.data.classification_dataloader import prepare_datasets, prepare_transforms
+from solo.data.loader import dataloader_kwargs
 from solo.methods import METHODS
 from solo.utils.auto_umap import OfflineUMAP
+from solo.utils.feature_store import FeatureStore, extract_or_load_features, feature_store_key
 
 
 def main():
@@ -43,30 +47,38 @@ def main():
     cfg = OmegaConf.create(method_args)
 
     # build the model
-    model = (
-        METHODS[method_args["method"]]
-        .load_from_checkpoint(ckpt_path, strict=False, cfg=cfg)
-        .backbone
-    )
+    # the whole method is used (instead of only its backbone), so that the stored features
+    # are the same as the ones of main_knn.py
+    model = METHODS[method_args["method"]].load_from_checkpoint(ckpt_path, strict=False, cfg=cfg)
+
     # prepare data
-    train_loader, val_loader = prepare_data(
+    # the validation transformations are used for both splits, so that the features are
+    # deterministic and can be reused from the feature store
+    _, T = prepare_transforms(args.dataset)
+    train_dataset, val_dataset = prepare_datasets(
         args.dataset,
+        T_train=T,
+        T_val=T,
         train_data_path=args.train_data_path,
         val_data_path=args.val_data_path,
         data_format=args.data_format,
-        batch_size=args.batch_size,
-        num_workers=args.num_workers,
-        auto_augment=False,
     )
+    loader_kwargs = dataloader_kwargs(args.num_workers)
 
     umap = OfflineUMAP()
-
-    # move model to the gpu
-    device = "cuda:0"
-    model = model.to(device)
-
-    umap.plot(device, model, train_loader, "im100_train_umap.pdf")
-    umap.plot(device, model, val_loader, "im100_val_umap.pdf")
+    store = FeatureStore(args.feature_cache_dir) if args.feature_cache_dir else None
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+
+    for split, dataset, data_path in [
+        ("train", train_dataset, args.train_data_path),
+        ("val", val_dataset, args.val_data_path),
+    ]:
+        loader = DataLoader(dataset, batch_size=args.batch_size, **loader_kwargs)
+        key = None
+        if store is not None:
+            key = feature_store_key(ckpt_path, f"{args.dataset}:{data_path}", T, split)
+        features = extract_or_load_features(loader, model, store, key, device=device)
+        umap.plot_features(features["feats"], features["targets"], f"im100_{split}_umap.pdf")
 
 
 if __name__ == "__main__":
@@ -0,0 +1,109 @@
+# Copyright 2023 solo-learn development team.
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in
+# the Software without restriction, including without limitation the rights to use,
+# copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the
+# Software, and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all copies
+# or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR
+# PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE
+# FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR
+# OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+
+import argparse
+import time
+
+import numpy as np
+import torch
+from solo.losses.manifold_regularizer import ManifoldRegularizer
+from solo.utils.embedding_propagation import get_laplacian
+
+
+def dense_manifold_regularizer_loss(x: torch.Tensor, y: torch.Tensor, rbf_scale: float = 1.0):
+    """Reference implementation that broadcasts the pairwise differences into a (b, b, c)
+    tensor and takes the trace of the full (d, d) product.
+    """
+
+    b, c = x.size()
+    sq_dist = ((x.view(b, 1, c) - x.view(1, b, c)) ** 2).sum(-1)
+    gamma = sq_dist[sq_dist != 0].std()
+    weights = torch.exp(-sq_dist / gamma * rbf_scale)
+    mask = torch.eye(b, dtype=torch.bool, device=x.device)
+    weights = weights * (~mask).float()
+    laplacian = get_laplacian(weights, normalized=True)
+    return torch.trace(y.T @ laplacian @ y) / (b**2)
+
+
+def benchmark(fn, x: torch.Tensor, y: torch.Tensor, repeats: int):
+    """Times forward + backward of fn and measures its peak memory (only on cuda).
+
+    Args:
+        fn (Callable): function mapping (x, y) to a scalar loss.
+        x (torch.Tensor): representations used to build the graph.
+        y (torch.Tensor): representations that are regularized.
+        repeats (int): number of timed iterations.
+
+    Returns:
+        Tuple[float, float, float]: loss value, mean time in ms and peak memory in MB.
+    """
+
+    cuda = x.device.type == "cuda"
+    # warmup
+    fn(x, y).backward()
+    if cuda:
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats()
+    start = time.perf_counter()
+    for _ in range(repeats):
+        x.grad = y.grad = None
+        loss = fn(x, y)
+        loss.backward()
+    if cuda:
+        torch.cuda.synchronize()
+    elapsed = (time.perf_counter() - start) / repeats * 1000
+    peak_memory = torch.cuda.max_memory_allocated() / 2**20 if cuda else float("nan")
+    return loss.item(), elapsed, peak_memory
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--batch_sizes", type=int, nargs="+", default=[256, 512, 1024])
+    parser.add_argument("--dim", type=int, default=768)
+    parser.add_argument("--repeats", type=int, default=10)
+    parser.add_argument("--chunk_size", type=int, default=128)
+    parser.add_argument(
+        "--device", type=str, default="cuda" if torch.cuda.is_available() else "cpu"
+    )
+    args = parser.parse_args()
+
+    regularizer = ManifoldRegularizer()
+    chunked_regularizer = ManifoldRegularizer(chunk_size=args.chunk_size)
+    paths = {
+        "dense": dense_manifold_regularizer_loss,
+        "gram": lambda x, y: regularizer.manifold_regularizer_loss(x, y)[0],
+        "chunked": lambda x, y: chunked_regularizer.manifold_regularizer_loss(x, y)[0],
+    }
+    for b in args.batch_sizes:
+        x = torch.randn(b, args.dim, device=args.device, requires_grad=True)
+        y = torch.randn(b, args.dim, device=args.device, requires_grad=True)
+        results = {}
+        for name, fn in paths.items():
+            try:
+                results[name] = benchmark(fn, x, y, args.repeats)
+            except RuntimeError as e:  # usually out of memory for the dense path
+                print(f"b={b} {name}: failed ({e})")
+                continue
+            loss, elapsed, peak_memory = results[name]
+            print(
+                f"b={b} {name}: loss={loss:.6f} time={elapsed:.2f}ms peak_mem={peak_memory:.1f}MB"
+            )
+        losses = [loss for loss, _, _ in results.values()]
+        if losses:
+            assert np.allclose(losses, losses[-1], rtol=1e-4), "paths disagree"
@@ -16,10 +16,12 @@ def parse_args_knn() -> argparse.Namespace:
     parser.add_argument("--pretrained_checkpoint_dir", type=str)
     parser.add_argument("--batch_size", type=int, default=16)
     parser.add_argument("--num_workers", type=int, default=10)
+    parser.add_argument("--feature_cache_dir", type=str, default=None)
     parser.add_argument("--k", type=int, nargs="+")
     parser.add_argument("--temperature", type=float, nargs="+")
     parser.add_argument("--distance_function", type=str, nargs="+")
     parser.add_argument("--feature_type", type=str, nargs="+")
+    parser.add_argument("--knn_cache_dir", type=str, default=None)
 
     # add shared arguments
     dataset_args(parser)
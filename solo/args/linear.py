@@ -65,6 +65,14 @@ def add_and_assert_dataset_cfg(cfg: omegaconf.DictConfig) -> omegaconf.DictConfi
 
     cfg.data.format = omegaconf_select(cfg, "data.format", "image_folder")
     cfg.data.fraction = omegaconf_select(cfg, "data.fraction", -1)
+    cfg.data.ram_cache_dir = omegaconf_select(cfg, "data.ram_cache_dir", None)
+    cfg.data.loader = omegaconf_select(cfg, "data.loader", {})
+    cfg.data.loader.pin_memory = omegaconf_select(cfg, "data.loader.pin_memory", True)
+    cfg.data.loader.persistent_workers = omegaconf_select(
+        cfg, "data.loader.persistent_workers", False
+    )
+    cfg.data.loader.prefetch_factor = omegaconf_select(cfg, "data.loader.prefetch_factor", None)
+    cfg.data.loader.channels_last = omegaconf_select(cfg, "data.loader.channels_last", False)
 
     return cfg
 
@@ -152,6 +160,17 @@ def parse_cfg(cfg: omegaconf.DictConfig):
     cfg.mixup = omegaconf_select(cfg, "mixup", 0.0)
     cfg.cutmix = omegaconf_select(cfg, "cutmix", 0.0)
 
+    # linear evaluation on features extracted once by the frozen backbone
+    cfg.cached_features = omegaconf_select(cfg, "cached_features", {})
+    cfg.cached_features.enabled = omegaconf_select(cfg, "cached_features.enabled", False)
+    cfg.cached_features.num_views = omegaconf_select(cfg, "cached_features.num_views", 1)
+    cfg.cached_features.dir = omegaconf_select(
+        cfg, "cached_features.dir", os.path.join(cfg.checkpoint.dir, "linear", "features")
+    )
+    cfg.cached_features.extraction_batch_size = omegaconf_select(
+        cfg, "cached_features.extraction_batch_size", cfg.optimizer.batch_size
+    )
+
     # augmentation related (crop size and custom mean/std values for normalization)
     cfg.data.augmentations = omegaconf_select(cfg, "data.augmentations", {})
     cfg.data.augmentations.crop_size = omegaconf_select(cfg, "data.augmentations.crop_size", 224)
@@ -64,6 +64,21 @@ def add_and_assert_dataset_cfg(cfg: omegaconf.DictConfig) -> omegaconf.DictConfi
     cfg.data.format = omegaconf_select(cfg, "data.format", "image_folder")
     cfg.data.no_labels = omegaconf_select(cfg, "data.no_labels", False)
     cfg.data.fraction = omegaconf_select(cfg, "data.fraction", -1)
+    cfg.data.ram_cache_dir = omegaconf_select(cfg, "data.ram_cache_dir", None)
+    cfg.data.precompute_mae_targets = omegaconf_select(cfg, "data.precompute_mae_targets", False)
+    cfg.data.batched_augmentations = omegaconf_select(cfg, "data.batched_augmentations", False)
+    cfg.data.batched_augmentations_on_device = omegaconf_select(
+        cfg, "data.batched_augmentations_on_device", False
+    )
+    cfg.data.decode_once_crops = omegaconf_select(cfg, "data.decode_once_crops", False)
+    cfg.data.resumable_sampler = omegaconf_select(cfg, "data.resumable_sampler", False)
+    cfg.data.loader = omegaconf_select(cfg, "data.loader", {})
+    cfg.data.loader.pin_memory = omegaconf_select(cfg, "data.loader.pin_memory", True)
+    cfg.data.loader.persistent_workers = omegaconf_select(
+        cfg, "data.loader.persistent_workers", False
+    )
+    cfg.data.loader.prefetch_factor = omegaconf_select(cfg, "data.loader.prefetch_factor", None)
+    cfg.data.loader.channels_last = omegaconf_select(cfg, "data.loader.channels_last", False)
     cfg.debug_augmentations = omegaconf_select(cfg, "debug_augmentations", False)
     cfg.data.tfrecord = omegaconf_select(cfg, "data.tfrecord", False)
 
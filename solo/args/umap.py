@@ -16,6 +16,7 @@ def parse_args_umap() -> argparse.Namespace:
     parser.add_argument("--pretrained_checkpoint_dir", type=str)
     parser.add_argument("--batch_size", type=int, default=16)
     parser.add_argument("--num_workers", type=int, default=10)
+    parser.add_argument("--feature_cache_dir", type=str, default=None)
 
     # add shared arguments
     dataset_args(parser)
@@ -19,10 +19,56 @@
 
 # Adapted from timm https://github.com/rwightman/pytorch-image-models/blob/master/timm/
 
+from functools import partial
+from typing import Dict, Sequence
+
+import torch
+import torch.nn as nn
 from timm.models.registry import register_model
 from timm.models.vision_transformer import _create_vision_transformer
 
 
+class BlockTap:
+    """Persistently taps the mean patch token representation of some blocks of a ViT.
+
+    The forward hooks are registered once and only on the requested blocks. They reduce the
+    block outputs right away, so the full token sequences are not retained. The reductions of
+    the last forward pass are returned (and released) by pop.
+
+    Args:
+        backbone (nn.Module): ViT with a sequence of transformer blocks in backbone.blocks.
+        blocks (Sequence[int]): indexes of the blocks to tap.
+    """
+
+    def __init__(self, backbone: nn.Module, blocks: Sequence[int]):
+        self.num_prefix_tokens = getattr(backbone, "num_prefix_tokens", 1)
+        self.block_feats = {}
+        self.handles = [
+            backbone.blocks[number].register_forward_hook(partial(self._hook, number))
+            for number in sorted(set(blocks))
+        ]
+
+    def _hook(self, number: int, module: nn.Module, input: torch.Tensor, output: torch.Tensor):
+        self.block_feats[number] = output[:, self.num_prefix_tokens :, :].mean(dim=1)
+
+    def pop(self) -> Dict[int, torch.Tensor]:
+        """Returns the reductions of the last forward pass and releases them.
+
+        Returns:
+            Dict[int, torch.Tensor]: mean patch token of each tapped block.
+        """
+
+        block_feats, self.block_feats = self.block_feats, {}
+        return block_feats
+
+    def remove(self):
+        """Removes the forward hooks."""
+
+        for handle in self.handles:
+            handle.remove()
+        self.handles = []
+
+
 @register_model
 def vit_tiny(patch_size=16, **kwargs):
     """ViT-Tiny (Vit-Ti/16)"""
@@ -83,6 +83,9 @@ class MaskedAutoencoderViT(VisionTransformer):
         self.norm = norm_layer(embed_dim)
         # --------------------------------------------------------------------------
 
+        # blocks whose mean patch token is returned by forward_encoder
+        self.tapped_blocks = ()
+
         self.initialize_weights()
 
     def initialize_weights(self):
@@ -114,6 +117,18 @@ class MaskedAutoencoderViT(VisionTransformer):
             nn.init.constant_(m.bias, 0)
             nn.init.constant_(m.weight, 1.0)
 
+    def set_tapped_blocks(self, blocks):
+        """Sets the blocks whose mean patch token representation is returned by forward_encoder.
+        Only these reductions are kept, the full token sequences of the intermediate blocks are
+        not retained.
+
+        Args:
+            blocks (Sequence[int]): indexes of the blocks to tap.
+        """
+
+        assert all(0 <= block < len(self.blocks) for block in blocks)
+        self.tapped_blocks = tuple(sorted(set(blocks)))
+
     def random_masking(self, x, mask_ratio):
         """
         Perform per-sample random masking by per-sample shuffling.
@@ -160,17 +175,25 @@ class MaskedAutoencoderViT(VisionTransformer):
             cls_tokens = cls_token.expand(x.shape[0], -1, -1)
             x = torch.cat((cls_tokens, x), dim=1)
 
-        # apply Transformer blocks
-        x = self.blocks(x)
+        # apply Transformer blocks, reducing the output of the tapped ones
+        block_feats = {}
+        if self.tapped_blocks:
+            num_prefix_tokens = 1 if self.class_token else 0
+            for number, block in enumerate(self.blocks):
+                x = block(x)
+                if number in self.tapped_blocks:
+                    block_feats[number] = x[:, num_prefix_tokens:, :].mean(dim=1)
+        else:
+            x = self.blocks(x)
         x = self.norm(x)
 
-        return x, mask, ids_restore
+        return x, mask, ids_restore, block_feats
 
     def forward(self, imgs, mask_ratio=0):
-        feats, mask, ids_restore = self.forward_encoder(imgs, mask_ratio)
+        feats, mask, ids_restore, block_feats = self.forward_encoder(imgs, mask_ratio)
         out = self.forward_head(feats)
         if mask_ratio:
-            return out, feats, mask, ids_restore
+            return out, feats, mask, ids_restore, block_feats
         return out
 
 
@@ -18,10 +18,12 @@
 # DEALINGS IN THE SOFTWARE.
 
 
-from solo.data import classification_dataloader, pretrain_dataloader
+from solo.data import classification_dataloader, loader, mmap_dataset, pretrain_dataloader
 
 __all__ = [
     "classification_dataloader",
+    "loader",
+    "mmap_dataset",
     "pretrain_dataloader",
     "ram_dataset",
 ]
@@ -0,0 +1,264 @@
+# Copyright 2023 solo-learn development team.
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in
+# the Software without restriction, including without limitation the rights to use,
+# copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the
+# Software, and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all copies
+# or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR
+# PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE
+# FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR
+# OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+
+
+import math
+from typing import List, Sequence
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from torchvision.transforms import functional as TF
+
+
+def _grayscale(x: torch.Tensor) -> torch.Tensor:
+    """Luma of a (B, 3, H, W) batch, with the same weights as PIL."""
+
+    return (0.299 * x[:, 0] + 0.587 * x[:, 1] + 0.114 * x[:, 2]).unsqueeze(1)
+
+
+def _rgb_to_hsv(x: torch.Tensor) -> torch.Tensor:
+    r, g, b = x.unbind(1)
+    maxc, _ = x.max(dim=1)
+    minc, _ = x.min(dim=1)
+    delta = maxc - minc
+
+    s = delta / torch.where(maxc == 0, torch.ones_like(maxc), maxc)
+    safe_delta = torch.where(delta == 0, torch.ones_like(delta), delta)
+    rc = (maxc - r) / safe_delta
+    gc = (maxc - g) / safe_delta
+    bc = (maxc - b) / safe_delta
+
+    h = torch.where(maxc == r, bc - gc, torch.where(maxc == g, 2.0 + rc - bc, 4.0 + gc - rc))
+    h = torch.where(delta == 0, torch.zeros_like(h), h)
+    h = torch.fmod(h / 6.0 + 1.0, 1.0)
+    return torch.stack((h, s, maxc), dim=1)
+
+
+def _hsv_to_rgb(x: torch.Tensor) -> torch.Tensor:
+    h, s, v = x.unbind(1)
+    i = torch.floor(h * 6.0)
+    f = h * 6.0 - i
+    i = i.to(torch.int64) % 6
+
+    p = (v * (1.0 - s)).clamp(0.0, 1.0)
+    q = (v * (1.0 - s * f)).clamp(0.0, 1.0)
+    t = (v * (1.0 - s * (1.0 - f))).clamp(0.0, 1.0)
+
+    mask = i.unsqueeze(1) == torch.arange(6, device=i.device).view(1, -1, 1, 1)
+    r = torch.stack((v, q, p, p, t, v), dim=1)
+    g = torch.stack((t, v, v, q, p, p), dim=1)
+    b = torch.stack((p, p, t, v, v, q), dim=1)
+    return torch.stack(((r * mask).sum(dim=1), (g * mask).sum(dim=1), (b * mask).sum(dim=1)), dim=1)
+
+
+class BatchedAugmentation(nn.Module):
+    def __init__(
+        self,
+        mean: Sequence[float],
+        std: Sequence[float],
+        color_jitter_prob: float = 0.0,
+        brightness: float = 0.0,
+        contrast: float = 0.0,
+        saturation: float = 0.0,
+        hue: float = 0.0,
+        grayscale_prob: float = 0.0,
+        gaussian_blur_prob: float = 0.0,
+        solarization_prob: float = 0.0,
+        equalization_prob: float = 0.0,
+        horizontal_flip_prob: float = 0.0,
+        sigma: Sequence[float] = (0.1, 2.0),
+    ):
+        """Photometric augmentations applied to a whole batch of crops at once.
+        The crops are expected as a uint8 (B, 3, H, W) tensor, i.e. the output of the
+        per-sample part of the pipeline (random resized crop + PILToTensor) after collation.
+        Every random parameter (application, jitter factors, blur sigma, ...) is sampled
+        independently per sample, so the result follows the same distribution as the
+        PIL pipeline in build_transform_pipeline, with the exception that the order of
+        the color jitter operations is shuffled per batch instead of per image.
+
+        Args:
+            mean (Sequence[float]): mean used for normalization.
+            std (Sequence[float]): std used for normalization.
+            color_jitter_prob (float): probability of applying color jitter.
+            brightness (float): brightness jitter strength.
+            contrast (float): contrast jitter strength.
+            saturation (float): saturation jitter strength.
+            hue (float): hue jitter strength.
+            grayscale_prob (float): probability of converting to grayscale.
+            gaussian_blur_prob (float): probability of applying gaussian blur.
+            solarization_prob (float): probability of applying solarization.
+            equalization_prob (float): probability of applying histogram equalization.
+            horizontal_flip_prob (float): probability of flipping horizontally.
+            sigma (Sequence[float]): range to sample the std of the gaussian blur.
+                Defaults to (0.1, 2.0).
+        """
+
+        super().__init__()
+
+        self.color_jitter_prob = color_jitter_prob
+        self.brightness = brightness
+        self.contrast = contrast
+        self.saturation = saturation
+        self.hue = hue
+        self.grayscale_prob = grayscale_prob
+        self.gaussian_blur_prob = gaussian_blur_prob
+        self.solarization_prob = solarization_prob
+        self.equalization_prob = equalization_prob
+        self.horizontal_flip_prob = horizontal_flip_prob
+        self.sigma = sigma
+
+        # non persistent, so that checkpoints are unaffected
+        self.register_buffer("mean", torch.tensor(mean).view(1, 3, 1, 1), persistent=False)
+        self.register_buffer("std", torch.tensor(std).view(1, 3, 1, 1), persistent=False)
+
+    @staticmethod
+    def _sample_mask(x: torch.Tensor, p: float) -> torch.Tensor:
+        return torch.rand(x.size(0), 1, 1, 1, device=x.device) < p
+
+    @staticmethod
+    def _sample_factor(x: torch.Tensor, low: float, high: float) -> torch.Tensor:
+        return torch.empty(x.size(0), 1, 1, 1, device=x.device).uniform_(low, high)
+
+    def color_jitter(self, x: torch.Tensor) -> torch.Tensor:
+        ops = []
+        if self.brightness:
+            ops.append("brightness")
+        if self.contrast:
+            ops.append("contrast")
+        if self.saturation:
+            ops.append("saturation")
+        if self.hue:
+            ops.append("hue")
+
+        for i in torch.randperm(len(ops)).tolist():
+            op = ops[i]
+            if op == "brightness":
+                f = self._sample_factor(x, max(0.0, 1 - self.brightness), 1 + self.brightness)
+                x = (x * f).clamp(0.0, 1.0)
+            elif op == "contrast":
+                f = self._sample_factor(x, max(0.0, 1 - self.contrast), 1 + self.contrast)
+                m = _grayscale(x).mean(dim=(1, 2, 3), keepdim=True)
+                x = (f * x + (1 - f) * m).clamp(0.0, 1.0)
+            elif op == "saturation":
+                f = self._sample_factor(x, max(0.0, 1 - self.saturation), 1 + self.saturation)
+                x = (f * x + (1 - f) * _grayscale(x)).clamp(0.0, 1.0)
+            else:
+                f = self._sample_factor(x, -self.hue, self.hue).squeeze(1)
+                hsv = _rgb_to_hsv(x)
+                h = torch.remainder(hsv[:, 0] + f, 1.0)
+                x = _hsv_to_rgb(torch.stack((h, hsv[:, 1], hsv[:, 2]), dim=1))
+        return x
+
+    def gaussian_blur(self, x: torch.Tensor) -> torch.Tensor:
+        """Separable gaussian blur with a different sigma per sample, as a grouped conv."""
+
+        b, c, h, w = x.shape
+        sigma = torch.empty(b, device=x.device).uniform_(self.sigma[0], self.sigma[1])
+        radius = min(math.ceil(3 * self.sigma[1]), (min(h, w) - 1) // 2)
+        coords = torch.arange(-radius, radius + 1, device=x.device, dtype=x.dtype)
+        kernel = torch.exp(-(coords.view(1, -1) ** 2) / (2 * sigma.view(-1, 1) ** 2))
+        kernel = (kernel / kernel.sum(dim=1, keepdim=True)).repeat_interleave(c, dim=0)
+
+        out = x.reshape(1, b * c, h, w)
+        out = F.pad(out, (radius, radius, radius, radius), mode="reflect")
+        out = F.conv2d(out, kernel.view(b * c, 1, 1, -1), groups=b * c)
+        out = F.conv2d(out, kernel.view(b * c, 1, -1, 1), groups=b * c)
+        return out.view(b, c, h, w)
+
+    @torch.no_grad()
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        """Augments and normalizes a batch of crops.
+
+        Args:
+            x (torch.Tensor): uint8 batch of crops with shape (B, 3, H, W).
+
+        Returns:
+            torch.Tensor: augmented and normalized float batch.
+        """
+
+        x = x.float() / 255.0
+
+        if self.color_jitter_prob:
+            mask = self._sample_mask(x, self.color_jitter_prob)
+            x = torch.where(mask, self.color_jitter(x), x)
+
+        if self.grayscale_prob:
+            mask = self._sample_mask(x, self.grayscale_prob)
+            x = torch.where(mask, _grayscale(x).expand_as(x), x)
+
+        if self.gaussian_blur_prob:
+            mask = self._sample_mask(x, self.gaussian_blur_prob)
+            x = torch.where(mask, self.gaussian_blur(x), x)
+
+        if self.solarization_prob:
+            # same threshold as PIL's solarize on uint8 images
+            mask = self._sample_mask(x, self.solarization_prob)
+            x = torch.where(mask & (x >= 128 / 255), 1.0 - x, x)
+
+        if self.equalization_prob:
+            mask = self._sample_mask(x, self.equalization_prob)
+            equalized = TF.equalize((x * 255).round().to(torch.uint8)).float() / 255.0
+            x = torch.where(mask, equalized, x)
+
+        if self.horizontal_flip_prob:
+            mask = self._sample_mask(x, self.horizontal_flip_prob)
+            x = torch.where(mask, x.flip(-1), x)
+
+        return (x - self.mean) / self.std
+
+
+class MultiCropBatchedAugmentation(nn.Module):
+    def __init__(self, augmentations: List[BatchedAugmentation]):
+        """Applies the batched augmentation of each crop to the corresponding batch of crops.
+
+        Args:
+            augmentations (List[BatchedAugmentation]): one augmentation per crop, in the same
+                order as the crops generated by the data pipeline.
+        """
+
+        super().__init__()
+
+        self.augmentations = nn.ModuleList(augmentations)
+
+    def forward(self, X: List[torch.Tensor]) -> List[torch.Tensor]:
+        num_crops = len(self.augmentations)
+        assert len(X) >= num_crops
+        # anything after the crops (e.g. extra targets) is left untouched
+        return [aug(x) for aug, x in zip(self.augmentations, X)] + list(X[num_crops:])
+
+
+class BatchedAugmentationCollate:
+    def __init__(self, augmentation: MultiCropBatchedAugmentation, collate_fn=None):
+        """Collate function that applies the batched augmentations in the data loading workers.
+
+        Args:
+            augmentation (MultiCropBatchedAugmentation): augmentations of the crops.
+            collate_fn (Callable, optional): base collate function.
+                Defaults to torch's default_collate.
+        """
+
+        self.augmentation = augmentation
+        self.collate_fn = collate_fn or torch.utils.data.default_collate
+
+    def __call__(self, batch):
+        # batches are (indexes, crops, targets)
+        batch = self.collate_fn(batch)
+        batch[1] = self.augmentation(batch[1])
+        return batch
@@ -19,16 +19,21 @@
 
 import os
 from pathlib import Path
-from typing import Callable, Optional, Tuple, Union
+from typing import Any, Callable, Dict, Optional, Tuple, Union
 
 import torchvision
 from timm.data import create_transform
 from timm.data.constants import IMAGENET_DEFAULT_MEAN, IMAGENET_DEFAULT_STD
 from torch import nn
-from torch.utils.data import DataLoader, Dataset
+from torch.utils.data import DataLoader, Dataset, Sampler
 from torchvision import transforms
-from torchvision.datasets import STL10, ImageFolder
+from torchvision.datasets import STL10
+from solo.data.compact_dataset import CompactImageFolder
+from solo.data.loader import dataloader_kwargs
+from solo.data.mmap_dataset import MMapDataset
 from solo.data.ram_dataset import RAMImageFolder
+from solo.data.sampler import ResumableDistributedSampler
+from solo.data.subset import stratified_subset
 
 try:
     from solo.data.h5_dataset import H5Dataset
@@ -178,6 +183,7 @@ def prepare_datasets(
     download: bool = True,
     data_fraction: float = -1.0,
     skip_train_ram = False,
+    ram_cache_dir: Optional[str] = None,
 ) -> Tuple[Dataset, Dataset]:
     """Prepares train and val datasets.
 
@@ -190,9 +196,11 @@ def prepare_datasets(
         val_data_path (Optional[Union[str, Path]], optional): path where the
             validation data is located. Defaults to None.
         data_format (Optional[str]): format of the data. Defaults to "image_folder".
-            Possible values are "image_folder", "h5" and "ram_image_folder.
+            Possible values are "image_folder", "h5", "ram_image_folder" and "npy_mmap".
         data_fraction (Optional[float]): percentage of data to use. Use all data when set to -1.0.
             Defaults to -1.0.
+        ram_cache_dir (Optional[str]): folder where the "ram_image_folder" format caches the
+            decoded images. Defaults to None (no cache).
 
     Returns:
         Tuple[Dataset, Dataset]: training dataset and validation dataset.
@@ -245,32 +253,35 @@ def prepare_datasets(
             val_dataset = H5Dataset(dataset, val_data_path, T_val)
         elif data_format == "ram_image_folder":
             if not skip_train_ram:
-                train_dataset = RAMImageFolder(train_data_path, T_train)
+                train_dataset = RAMImageFolder(train_data_path, T_train, cache_dir=ram_cache_dir)
             else:
-                train_dataset = ImageFolder(train_data_path, T_train)
-            val_dataset = RAMImageFolder(val_data_path, T_val)
+                train_dataset = CompactImageFolder(train_data_path, T_train)
+            val_dataset = RAMImageFolder(val_data_path, T_val, cache_dir=ram_cache_dir)
+        elif data_format == "npy_mmap":
+            train_dataset = MMapDataset(train_data_path, T_train)
+            val_dataset = MMapDataset(val_data_path, T_val)
         else:
-            train_dataset = ImageFolder(train_data_path, T_train)
-            val_dataset = ImageFolder(val_data_path, T_val)
+            train_dataset = CompactImageFolder(train_data_path, T_train)
+            val_dataset = CompactImageFolder(val_data_path, T_val)
 
     if data_fraction > 0:
-        assert data_fraction < 1, "Only use data_fraction for values smaller than 1."
-        data = train_dataset.samples
-        files = [f for f, _ in data]
-        labels = [l for _, l in data]
-
-        from sklearn.model_selection import train_test_split
-
-        files, _, labels, _ = train_test_split(
-            files, labels, train_size=data_fraction, stratify=labels, random_state=42
-        )
-        train_dataset.samples = [tuple(p) for p in zip(files, labels)]
+        train_dataset = stratified_subset(train_dataset, data_fraction)
 
     return train_dataset, val_dataset
 
 
 def prepare_dataloaders(
-    train_dataset: Dataset, val_dataset: Dataset, batch_size: int = 64, num_workers: int = 4
+    train_dataset: Dataset,
+    val_dataset: Dataset,
+    batch_size: int = 64,
+    num_workers: int = 4,
+    pin_memory: bool = True,
+    persistent_workers: bool = False,
+    prefetch_factor: Optional[int] = None,
+    channels_last: bool = False,
+    worker_init_fn: Optional[Callable] = None,
+    train_sampler: Optional[Sampler] = None,
+    val_sampler: Optional[Sampler] = None,
 ) -> Tuple[DataLoader, DataLoader]:
     """Wraps a train and a validation dataset with a DataLoader.
 
@@ -279,24 +290,45 @@ def prepare_dataloaders(
         val_dataset (Dataset): object containing validation data.
         batch_size (int): batch size.
         num_workers (int): number of parallel workers.
+        pin_memory (bool): whether to pin the batches. Defaults to True.
+        persistent_workers (bool): whether to keep the workers alive between epochs, so that
+            they are not re-created at every validation epoch. Defaults to False.
+        prefetch_factor (Optional[int]): number of batches loaded in advance by each worker.
+            Defaults to None (torch's default).
+        channels_last (bool): whether to collate the images in the channels last format.
+            Defaults to False.
+        worker_init_fn (Optional[Callable]): function called in each worker on startup.
+            Defaults to None.
+        train_sampler (Optional[Sampler]): sampler of the training samples. Shuffles the
+            training dataset when None. Defaults to None.
+        val_sampler (Optional[Sampler]): sampler of the validation samples. Iterates the
+            validation dataset in order when None. Defaults to None.
     Returns:
         Tuple[DataLoader, DataLoader]: training dataloader and validation dataloader.
     """
 
+    loader_kwargs = dataloader_kwargs(
+        num_workers,
+        pin_memory=pin_memory,
+        persistent_workers=persistent_workers,
+        prefetch_factor=prefetch_factor,
+        channels_last=channels_last,
+        worker_init_fn=worker_init_fn,
+    )
     train_loader = DataLoader(
         train_dataset,
         batch_size=batch_size,
-        shuffle=True,
-        num_workers=num_workers,
-        pin_memory=True,
+        shuffle=train_sampler is None,
+        sampler=train_sampler,
         drop_last=True,
+        **loader_kwargs,
     )
     val_loader = DataLoader(
         val_dataset,
         batch_size=batch_size,
-        num_workers=num_workers,
-        pin_memory=True,
+        sampler=val_sampler,
         drop_last=False,
+        **loader_kwargs,
     )
     return train_loader, val_loader
 
@@ -312,6 +344,9 @@ def prepare_data(
     data_fraction: float = -1.0,
     auto_augment: bool = False,
     skip_train_ram: bool = False,
+    loader_kwargs: Optional[Dict[str, Any]] = None,
+    ram_cache_dir: Optional[str] = None,
+    shard_val: bool = False,
 ) -> Tuple[DataLoader, DataLoader]:
     """Prepares transformations, creates dataset objects and wraps them in dataloaders.
 
@@ -322,13 +357,20 @@ def prepare_data(
         val_data_path (Optional[Union[str, Path]], optional): path where the
             validation data is located. Defaults to None.
         data_format (Optional[str]): format of the data. Defaults to "image_folder".
-            Possible values are "image_folder", "h5", and "ram_image_folder".
+            Possible values are "image_folder", "h5", "ram_image_folder" and "npy_mmap".
         batch_size (int, optional): batch size. Defaults to 64.
         num_workers (int, optional): number of parallel workers. Defaults to 4.
         data_fraction (Optional[float]): percentage of data to use. Use all data when set to -1.0.
             Defaults to -1.0.
         auto_augment (bool, optional): use auto augment following timm.data.create_transform.
             Defaults to False.
+        loader_kwargs (Optional[Dict[str, Any]], optional): extra arguments of
+            prepare_dataloaders, e.g. persistent_workers. Defaults to None.
+        ram_cache_dir (Optional[str], optional): folder where the "ram_image_folder" format
+            caches the decoded images. Defaults to None (no cache).
+        shard_val (bool, optional): whether the validation dataloader shards the data across
+            the processes itself, for when Lightning's distributed sampler is disabled.
+            Defaults to False.
 
     Returns:
         Tuple[DataLoader, DataLoader]: prepared training and validation dataloader.
@@ -359,11 +401,14 @@ def prepare_data(
         download=download,
         data_fraction=data_fraction,
         skip_train_ram = skip_train_ram,
+        ram_cache_dir=ram_cache_dir,
     )
     train_loader, val_loader = prepare_dataloaders(
         train_dataset,
         val_dataset,
         batch_size=batch_size,
         num_workers=num_workers,
+        val_sampler=ResumableDistributedSampler(val_dataset, shuffle=False) if shard_val else None,
+        **(loader_kwargs or {}),
     )
     return train_loader, val_loader
@@ -0,0 +1,187 @@
+# Copyright 2023 solo-learn development team.
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in
+# the Software without restriction, including without limitation the rights to use,
+# copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the
+# Software, and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all copies
+# or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR
+# PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE
+# FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR
+# OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+
+
+import hashlib
+import os
+from pathlib import Path
+from typing import Callable, List, Optional, Tuple, Union
+
+import numpy as np
+from torch.utils.data import Dataset
+from torchvision.datasets.folder import IMG_EXTENSIONS, default_loader, has_file_allowed_extension
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "solo-learn", "image_folder")
+
+
+def _pack_paths(paths: List[str]) -> Tuple[np.ndarray, np.ndarray]:
+    """Packs a list of paths into a single byte buffer and an offset array.
+
+    Args:
+        paths (List[str]): list of paths.
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray]: uint8 buffer and int64 offsets of size len(paths) + 1.
+    """
+
+    encoded = [os.fsencode(path) for path in paths]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(path) for path in encoded])
+    return np.frombuffer(b"".join(encoded), dtype=np.uint8), offsets
+
+
+class CompactImageFolder(Dataset):
+    def __init__(
+        self,
+        root: Union[str, Path],
+        transform: Optional[Callable] = None,
+        target_transform: Optional[Callable] = None,
+        loader: Callable = default_loader,
+        cache_dir: Optional[str] = DEFAULT_CACHE_DIR,
+    ):
+        """Drop-in replacement for torchvision's ImageFolder with a compact sample index.
+        Paths are stored in a single byte buffer with an offset array and labels in an
+        int64 array, instead of a list of (path, label) tuples. This keeps the index small
+        and avoids dirtying one python object per sample in every DataLoader worker.
+
+        The result of scanning the folder is cached as a manifest in cache_dir. It is
+        reused as long as the modification times of the folder and its subfolders are
+        unchanged, i.e. no file was added, removed or renamed.
+
+        Args:
+            root (Union[str, Path]): root folder with one subfolder per class.
+            transform (Optional[Callable]): pipeline of transformations. Defaults to None.
+            target_transform (Optional[Callable]): transformation of the targets.
+                Defaults to None.
+            loader (Callable): function to load an image given its path.
+                Defaults to torchvision's default_loader.
+            cache_dir (Optional[str]): folder for the scan manifests, None disables caching.
+                Defaults to ~/.cache/solo-learn/image_folder.
+        """
+
+        self.root = str(root)
+        self.transform = transform
+        self.target_transform = target_transform
+        self.loader = loader
+        self.cache_dir = cache_dir
+
+        manifest = self._load_manifest() if cache_dir is not None else None
+        if manifest is None:
+            manifest = self._scan()
+            if cache_dir is not None:
+                self._save_manifest(manifest)
+
+        self.classes = manifest["classes"].tolist()
+        self.class_to_idx = {cls_name: i for i, cls_name in enumerate(self.classes)}
+        self._paths = manifest["paths"]
+        self._offsets = manifest["offsets"]
+        self.targets = manifest["targets"]
+
+    @property
+    def _manifest_path(self) -> str:
+        abs_root = os.path.abspath(self.root)
+        key = hashlib.sha1(abs_root.encode()).hexdigest()[:16]
+        return os.path.join(self.cache_dir, f"{os.path.basename(abs_root)}-{key}.npz")
+
+    def _scan(self) -> dict:
+        """Scans the folder in the same order as torchvision's ImageFolder."""
+
+        classes = sorted(entry.name for entry in os.scandir(self.root) if entry.is_dir())
+        if not classes:
+            raise FileNotFoundError(f"Couldn't find any class folder in {self.root}.")
+
+        paths, targets = [], []
+        dirs, dir_mtimes = [self.root], [os.stat(self.root).st_mtime_ns]
+        for y, class_name in enumerate(classes):
+            class_dir = os.path.join(self.root, class_name)
+            for dir_path, _, fnames in sorted(os.walk(class_dir, followlinks=True)):
+                dirs.append(dir_path)
+                dir_mtimes.append(os.stat(dir_path).st_mtime_ns)
+                for fname in sorted(fnames):
+                    if has_file_allowed_extension(fname, IMG_EXTENSIONS):
+                        paths.append(os.path.relpath(os.path.join(dir_path, fname), self.root))
+                        targets.append(y)
+
+        packed_paths, offsets = _pack_paths(paths)
+        return {
+            "classes": np.array(classes),
+            "paths": packed_paths,
+            "offsets": offsets,
+            "targets": np.array(targets, dtype=np.int64),
+            "dirs": np.array([os.path.relpath(d, self.root) for d in dirs]),
+            "dir_mtimes": np.array(dir_mtimes, dtype=np.int64),
+        }
+
+    def _load_manifest(self) -> Optional[dict]:
+        if not os.path.isfile(self._manifest_path):
+            return None
+
+        with np.load(self._manifest_path) as data:
+            manifest = dict(data)
+        try:
+            dir_mtimes = [
+                os.stat(os.path.join(self.root, d)).st_mtime_ns for d in manifest["dirs"].tolist()
+            ]
+        except FileNotFoundError:
+            return None
+        if not np.array_equal(dir_mtimes, manifest["dir_mtimes"]):
+            return None
+        return manifest
+
+    def _save_manifest(self, manifest: dict):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        # write to a temporary file first, other ranks may be saving the same manifest
+        tmp_path = f"{self._manifest_path}.{os.getpid()}.tmp.npz"
+        np.savez(tmp_path, **manifest)
+        os.replace(tmp_path, self._manifest_path)
+
+    def _path(self, index: int) -> str:
+        path = self._paths[self._offsets[index] : self._offsets[index + 1]].tobytes()
+        return os.path.join(self.root, os.fsdecode(path))
+
+    @property
+    def samples(self) -> List[Tuple[str, int]]:
+        """List of (path, label) tuples, only materialized on request."""
+
+        return [(self._path(i), y) for i, y in enumerate(self.targets.tolist())]
+
+    @samples.setter
+    def samples(self, samples: List[Tuple[str, int]]):
+        self._paths, self._offsets = _pack_paths(
+            [os.path.relpath(path, self.root) for path, _ in samples]
+        )
+        self.targets = np.array([y for _, y in samples], dtype=np.int64)
+
+    @property
+    def imgs(self) -> List[Tuple[str, int]]:
+        return self.samples
+
+    def __getitem__(self, index: int):
+        x = self.loader(self._path(index))
+        y = int(self.targets[index])
+
+        if self.transform is not None:
+            x = self.transform(x)
+        if self.target_transform is not None:
+            y = self.target_transform(y)
+
+        return x, y
+
+    def __len__(self):
+        return len(self.targets)
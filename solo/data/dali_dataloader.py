@@ -23,6 +23,7 @@ from pathlib import Path
 from typing import Callable, List, Optional, Union
 from subprocess import call
 
+import numpy as np
 import nvidia.dali.fn as fn
 import nvidia.dali.ops as ops
 import nvidia.dali.types as types
@@ -33,6 +34,7 @@ import torch
 import torch.nn as nn
 from nvidia.dali.pipeline import pipeline_def
 from nvidia.dali.plugin.pytorch import DALIGenericIterator, LastBatchPolicy
+from solo.data.subset import stratified_subset_indices
 from solo.utils.misc import omegaconf_select
 from timm.data.constants import IMAGENET_DEFAULT_MEAN, IMAGENET_DEFAULT_STD
 
@@ -242,13 +244,9 @@ class NormalPipelineBuilder:
 
         # sample data if needed
         if data_fraction > 0:
-            assert data_fraction < 1, "data_fraction must be smaller than 1."
-
-            from sklearn.model_selection import train_test_split
-
-            files, _, labels, _ = train_test_split(
-                files, labels, train_size=data_fraction, stratify=labels, random_state=42
-            )
+            idxs = stratified_subset_indices(np.array(labels), data_fraction)
+            files = [files[i] for i in idxs]
+            labels = [labels[i] for i in idxs]
         if self.use_tfrecords:
             print("Using TFRecord reader")
 
@@ -567,16 +565,9 @@ class PretrainPipelineBuilder:
         if data_fraction > 0:
             assert data_fraction < 1, "Only use data_fraction for values smaller than 1."
             print(f"Using a fraction of {data_fraction} for the train_size.")
-            if no_labels:
-                labels = [-1] * len(files)
-            else:
-                labels = [l for _, l in data]
-
-            from sklearn.model_selection import train_test_split
-
-            files, _, labels, _ = train_test_split(
-                files, labels, train_size=data_fraction, stratify=labels, random_state=42
-            )
+            idxs = stratified_subset_indices(np.array(labels), data_fraction)
+            files = [files[i] for i in idxs]
+            labels = [labels[i] for i in idxs]
             self.reader = ops.readers.File(
                 files=files,
                 labels=labels,
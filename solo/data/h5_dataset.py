@@ -18,17 +18,27 @@
 # DEALINGS IN THE SOFTWARE.
 
 
+import hashlib
 import io
 import os
 import logging
 from pathlib import Path
-from typing import Callable, Optional
+from typing import Callable, List, Optional
 
 import h5py
+import numpy as np
 from PIL import Image
 from torch.utils.data import Dataset
 from tqdm import tqdm
 
+try:
+    # registers the LZ4 filter used by compressed blob files
+    import hdf5plugin
+except ImportError:
+    _hdf5plugin_available = False
+else:
+    _hdf5plugin_available = True
+
 
 class H5Dataset(Dataset):
     def __init__(
@@ -38,7 +48,7 @@ class H5Dataset(Dataset):
         transform: Optional[Callable] = None,
     ):
         """H5 Dataset.
-        The dataset assumes that data is organized as:
+        The dataset supports two layouts. The "groups" layout stores one dataset per image:
             "class_name"
                 "img_name"
                 "img_name"
@@ -48,6 +58,22 @@ class H5Dataset(Dataset):
                 "img_name"
                 "img_name"
 
+        The "blob" layout (file attribute layout="blob") stores all encoded images
+        back to back in a single byte dataset:
+            "images": uint8 blob with all the encoded images.
+            "offsets": int64 array of size N + 1, image i is images[offsets[i]:offsets[i + 1]].
+
+        Files written by `convert_imgfolder_to_h5` embed an index in both layouts, which
+        is loaded with a single read:
+            "index/classes": sorted class names.
+            "index/image_names": image name of each sample.
+            "index/labels": class index of each sample.
+        For files without index, the groups are walked once and the result is cached in
+        ~/.cache/solo-learn/h5, keyed by the absolute path of the file.
+
+        The blob layout avoids a metadata lookup per image and supports batched
+        fetches through __getitems__, which the DataLoader uses automatically.
+
         Args:
             dataset (str): dataset name.
             h5_path (str): path of the h5 file.
@@ -60,23 +86,50 @@ class H5Dataset(Dataset):
 
         assert dataset in ["imagenet100", "imagenet"]
 
-        self._load_h5_data_info()
+        with h5py.File(self.h5_path, "r") as h5_file:
+            self.layout = h5_file.attrs.get("layout", "groups")
+            if "index" in h5_file:
+                classes, image_names, labels = self._load_h5_index(h5_file)
+            else:
+                classes, image_names, labels = self._load_h5_data_info(h5_file)
+            if self.layout == "blob":
+                self._offsets = h5_file["offsets"][:]
+
+        # classes of the file, samples refer to them through class_id
+        self._file_classes = classes
+        self.classes = classes
+        self.class_to_idx = {cls_name: i for i, cls_name in enumerate(self.classes)}
+
+        # a single structured array instead of a list of tuples keeps the memory compact
+        # and avoids dirtying one python object per sample in each worker
+        self._data = np.empty(
+            len(labels),
+            dtype=[
+                ("img_name", image_names.dtype),
+                ("class_id", np.int32),
+                ("label", np.int64),
+                ("row", np.int64),
+            ],
+        )
+        self._data["img_name"] = image_names
+        self._data["class_id"] = labels
+        self._data["label"] = labels
+        self._data["row"] = np.arange(len(labels))
 
         # filter if needed to avoid having a copy of imagenet100 data
         if dataset == "imagenet100":
             script_folder = Path(os.path.dirname(__file__))
             classes_file = script_folder / "dataset_subset" / "imagenet100_classes.txt"
             with open(classes_file) as f:
-                self.classes = f.readline().strip().split()
-            self.classes = sorted(self.classes)
-            self.class_to_idx = {cls_name: i for i, cls_name in enumerate(self.classes)}
-
-            class_set = set(self.classes)
-            new_data = []
-            for class_name, img_name, _ in self._data:
-                if class_name in class_set:
-                    new_data.append((class_name, img_name, self.class_to_idx[class_name]))
-            if not new_data:
+                selected_classes = sorted(f.readline().strip().split())
+            selected_to_idx = {cls_name: i for i, cls_name in enumerate(selected_classes)}
+
+            new_labels = np.array(
+                [selected_to_idx.get(cls_name, -1) for cls_name in self._file_classes],
+                dtype=np.int64,
+            )[self._data["class_id"]]
+            keep = new_labels >= 0
+            if not keep.any():
                 logging.warn(
                     "Skipped filtering. Tried to filter classes for imagenet100, "
                     "but wasn't able to do so. Either make sure that you do not "
@@ -84,34 +137,60 @@ class H5Dataset(Dataset):
                     "or make sure the class names are the default ones."
                 )
             else:
-                self._data = new_data
+                self.classes = selected_classes
+                self.class_to_idx = selected_to_idx
+                self._data = self._data[keep]
+                self._data["label"] = new_labels[keep]
+
+    @property
+    def targets(self) -> np.ndarray:
+        """Class index of each sample."""
 
-    def _load_h5_data_info(self):
-        self._data = []
+        return self._data["label"]
+
+    def _load_h5_index(self, h5_file: h5py.File):
+        index = h5_file["index"]
+        classes = list(index["classes"].asstr()[:])
+        image_names = index["image_names"][:].astype(bytes)
+        labels = index["labels"][:]
+        return classes, image_names, labels
+
+    def _load_h5_data_info(self, h5_file: h5py.File):
+        abs_path = os.path.abspath(self.h5_path)
         h5_data_info_file = os.path.join(
-            os.path.expanduser("~"), os.path.basename(os.path.splitext(self.h5_path)[0]) + ".txt"
+            os.path.expanduser("~"),
+            ".cache",
+            "solo-learn",
+            "h5",
+            os.path.basename(os.path.splitext(abs_path)[0])
+            + "-"
+            + hashlib.sha1(abs_path.encode()).hexdigest()[:16]
+            + ".txt",
         )
+        classes, _ = self._find_classes(h5_file)
+        image_names, labels = [], []
         if not os.path.isfile(h5_data_info_file):
-            temp_h5_file = h5py.File(self.h5_path, "r")
-
             # collect data from the h5 file directly
-            self.classes, self.class_to_idx = self._find_classes(temp_h5_file)
-            for class_name in tqdm(self.classes, desc="Collecting information about the h5 file"):
-                y = self.class_to_idx[class_name]
-                for img_name in temp_h5_file[class_name].keys():
-                    self._data.append((class_name, img_name, int(y)))
+            for y, class_name in enumerate(
+                tqdm(classes, desc="Collecting information about the h5 file")
+            ):
+                for img_name in h5_file[class_name].keys():
+                    image_names.append(img_name)
+                    labels.append(y)
 
             # save the info locally to speed up sequential executions
+            os.makedirs(os.path.dirname(h5_data_info_file), exist_ok=True)
             with open(h5_data_info_file, "w") as f:
-                for class_name, img_name, y in self._data:
-                    f.write(f"{class_name}/{img_name} {y}\n")
+                for img_name, y in zip(image_names, labels):
+                    f.write(f"{classes[y]}/{img_name} {y}\n")
         else:
             # load data info file that was already generated by previous runs
             with open(h5_data_info_file) as f:
                 for line in f:
                     class_name_img, y = line.strip().split(" ")
-                    class_name, img_name = class_name_img.split("/")
-                    self._data.append((class_name, img_name, int(y)))
+                    image_names.append(class_name_img.split("/", 1)[1])
+                    labels.append(int(y))
+        return classes, np.array(image_names, dtype=bytes), np.array(labels, dtype=np.int64)
 
     def _find_classes(self, h5_file: h5py.File):
         classes = sorted(h5_file.keys())
@@ -123,17 +202,156 @@ class H5Dataset(Dataset):
         img = Image.open(io.BytesIO(img)).convert("RGB")
         return img
 
+    def _load_blob_imgs(self, rows: np.ndarray):
+        """Loads images from the blob layout, reading runs of adjacent rows at once.
+
+        Args:
+            rows (np.ndarray): rows of the images in the blob.
+
+        Returns:
+            List[Image.Image]: the images in the same order as rows.
+        """
+
+        starts = self._offsets[rows]
+        ends = self._offsets[rows + 1]
+        order = np.argsort(starts, kind="stable")
+
+        imgs = [None] * len(rows)
+        i = 0
+        while i < len(order):
+            # extend the range while the next image starts where the previous ended
+            j = i + 1
+            end = ends[order[i]]
+            while j < len(order) and starts[order[j]] <= end:
+                end = max(end, ends[order[j]])
+                j += 1
+
+            range_start = starts[order[i]]
+            data = self._images[range_start:end]
+            for k in order[i:j]:
+                buffer = data[starts[k] - range_start : ends[k] - range_start]
+                imgs[k] = Image.open(io.BytesIO(buffer)).convert("RGB")
+            i = j
+        return imgs
+
+    def _open(self):
+        self.h5_file = h5py.File(self.h5_path, "r")
+        if self.layout == "blob":
+            self._images = self.h5_file["images"]
+
     def __getitem__(self, index: int):
         if self.h5_file is None:
-            self.h5_file = h5py.File(self.h5_path, "r")
+            self._open()
 
-        class_name, img, y = self._data[index]
+        sample = self._data[index]
+        y = int(sample["label"])
 
-        x = self._load_img(class_name, img)
+        if self.layout == "blob":
+            x = self._load_blob_imgs(np.array([sample["row"]]))[0]
+        else:
+            class_name = self._file_classes[sample["class_id"]]
+            x = self._load_img(class_name, sample["img_name"].decode())
         if self.transform:
             x = self.transform(x)
 
         return x, y
 
+    def __getitems__(self, indices: List[int]):
+        if self.layout != "blob":
+            return [self[index] for index in indices]
+
+        if self.h5_file is None:
+            self._open()
+
+        samples = self._data[indices]
+        imgs = self._load_blob_imgs(samples["row"])
+        out = []
+        for x, y in zip(imgs, samples["label"].tolist()):
+            if self.transform:
+                x = self.transform(x)
+            out.append((x, y))
+        return out
+
     def __len__(self):
         return len(self._data)
+
+
+def convert_imgfolder_to_h5(
+    folder_path: str,
+    h5_path: str,
+    layout: str = "blob",
+    compression: Optional[str] = None,
+):
+    """Converts image folder to a h5 dataset.
+
+    Args:
+        folder_path (str): path to the image folder.
+        h5_path (str): output path of the h5 file.
+        layout (str): either "blob", which stores all images in a single dataset with an
+            offset table, or "groups", which stores one dataset per image. Defaults to "blob".
+        compression (Optional[str]): compression of the image data, one of None, "gzip"
+            or "lz4" (requires hdf5plugin). Encoded images barely compress, so None is
+            usually the fastest option. Defaults to None.
+    """
+
+    assert layout in ["blob", "groups"]
+    assert compression in [None, "gzip", "lz4"]
+
+    if compression == "gzip":
+        compression_kwargs = dict(compression="gzip", compression_opts=9)
+    elif compression == "lz4":
+        assert _hdf5plugin_available, "hdf5plugin is required for lz4 compression."
+        compression_kwargs = dict(hdf5plugin.LZ4())
+    else:
+        compression_kwargs = {}
+
+    classes = sorted(os.listdir(folder_path))
+    paths, image_names, labels = [], [], []
+    for y, class_name in enumerate(classes):
+        for img_name in sorted(os.listdir(os.path.join(folder_path, class_name))):
+            paths.append(os.path.join(folder_path, class_name, img_name))
+            image_names.append(img_name)
+            labels.append(y)
+
+    with h5py.File(h5_path, "w") as h5:
+        if layout == "groups":
+            class_groups = {class_name: h5.create_group(class_name) for class_name in classes}
+            for path, img_name, y in zip(
+                tqdm(paths, desc="Processing images"), image_names, labels
+            ):
+                with open(path, "rb") as fid_img:
+                    binary_data = fid_img.read()
+                data = np.frombuffer(binary_data, dtype="uint8")
+                class_groups[classes[y]].create_dataset(
+                    img_name, data=data, shape=data.shape, **compression_kwargs
+                )
+        else:
+            offsets = np.zeros(len(paths) + 1, dtype=np.int64)
+            offsets[1:] = np.cumsum([os.path.getsize(path) for path in paths])
+
+            if compression_kwargs:
+                # small chunks, so that reading an image only decompresses its neighbourhood
+                compression_kwargs["chunks"] = (min(1 << 18, max(int(offsets[-1]), 1)),)
+            images = h5.create_dataset(
+                "images", shape=(int(offsets[-1]),), dtype="uint8", **compression_kwargs
+            )
+
+            # write in large contiguous pieces instead of once per image
+            buffer, buffer_start = [], 0
+            for i, path in enumerate(tqdm(paths, desc="Processing images")):
+                with open(path, "rb") as fid_img:
+                    buffer.append(fid_img.read())
+                if offsets[i + 1] - buffer_start >= 1 << 26 or i == len(paths) - 1:
+                    images[buffer_start : offsets[i + 1]] = np.frombuffer(
+                        b"".join(buffer), dtype="uint8"
+                    )
+                    buffer, buffer_start = [], offsets[i + 1]
+
+            h5.create_dataset("offsets", data=offsets)
+
+        # embedded index, so that readers don't need to walk every group
+        index = h5.create_group("index")
+        index.create_dataset("classes", data=classes, dtype=h5py.string_dtype())
+        index.create_dataset("image_names", data=image_names, dtype=h5py.string_dtype())
+        index.create_dataset("labels", data=np.array(labels, dtype=np.int64))
+        h5.attrs["layout"] = layout
@@ -0,0 +1,154 @@
+# Copyright 2023 solo-learn development team.
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in
+# the Software without restriction, including without limitation the rights to use,
+# copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the
+# Software, and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all copies
+# or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR
+# PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE
+# FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR
+# OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+
+from typing import Any, Callable, Dict, Iterator, Optional
+
+import torch
+from torch.utils.data import DataLoader, default_collate
+
+
+def _apply_to_tensors(data: Any, fn: Callable) -> Any:
+    if isinstance(data, torch.Tensor):
+        return fn(data)
+    if isinstance(data, (list, tuple)):
+        return type(data)(_apply_to_tensors(d, fn) for d in data)
+    if isinstance(data, dict):
+        return {k: _apply_to_tensors(v, fn) for k, v in data.items()}
+    return data
+
+
+def _to_channels_last(x: torch.Tensor) -> torch.Tensor:
+    if x.dim() == 4 and x.is_floating_point():
+        return x.contiguous(memory_format=torch.channels_last)
+    return x
+
+
+class ChannelsLastCollate:
+    def __init__(self, collate_fn: Optional[Callable] = None, pin_memory: bool = False):
+        """Collate function that returns the batches of images in the channels last format,
+        so that the training step does not need to convert them.
+
+        Pinned memory can not be shared between processes, so pin_memory should only be set
+        when collating in the main process (num_workers=0). Otherwise, the DataLoader pins the
+        batches itself, keeping their memory format.
+
+        Args:
+            collate_fn (Optional[Callable]): base collate function.
+                Defaults to torch's default_collate.
+            pin_memory (bool): whether to pin the collated tensors. Defaults to False.
+        """
+
+        self.collate_fn = collate_fn or default_collate
+        self.pin_memory = pin_memory
+
+    def __call__(self, batch):
+        batch = _apply_to_tensors(self.collate_fn(batch), _to_channels_last)
+        if self.pin_memory:
+            batch = _apply_to_tensors(batch, lambda x: x.pin_memory())
+        return batch
+
+
+def dataloader_kwargs(
+    num_workers: int,
+    pin_memory: bool = True,
+    persistent_workers: bool = False,
+    prefetch_factor: Optional[int] = None,
+    channels_last: bool = False,
+    collate_fn: Optional[Callable] = None,
+    worker_init_fn: Optional[Callable] = None,
+) -> Dict[str, Any]:
+    """Builds the keyword arguments of a DataLoader from the data.loader options. The options
+    that only make sense with worker processes are dropped when num_workers is 0.
+
+    Args:
+        num_workers (int): number of workers.
+        pin_memory (bool): whether to pin the batches. Defaults to True.
+        persistent_workers (bool): whether to keep the workers alive between epochs instead of
+            re-creating them (and the per worker state of the dataset) at every epoch.
+            Defaults to False.
+        prefetch_factor (Optional[int]): number of batches loaded in advance by each worker.
+            Defaults to None (torch's default).
+        channels_last (bool): whether to collate the images in the channels last format.
+            Defaults to False.
+        collate_fn (Optional[Callable]): collate function. Defaults to None.
+        worker_init_fn (Optional[Callable]): function called in each worker on startup.
+            Defaults to None.
+
+    Returns:
+        Dict[str, Any]: the DataLoader keyword arguments.
+    """
+
+    if channels_last:
+        collate_fn = ChannelsLastCollate(collate_fn, pin_memory=pin_memory and num_workers == 0)
+
+    kwargs = dict(
+        num_workers=num_workers,
+        pin_memory=pin_memory,
+        collate_fn=collate_fn,
+        worker_init_fn=worker_init_fn,
+    )
+    if num_workers > 0:
+        kwargs["persistent_workers"] = persistent_workers
+        if prefetch_factor is not None:
+            kwargs["prefetch_factor"] = prefetch_factor
+    return kwargs
+
+
+class CUDAPrefetcher:
+    def __init__(self, loader: DataLoader, device: Optional[torch.device] = None):
+        """Wraps a dataloader to copy the next batch to the GPU on a side CUDA stream while the
+        current one is being used, overlapping the host to device copies with compute. Mostly
+        useful for manual loops, since Lightning already does the transfers of its loaders.
+
+        Args:
+            loader (DataLoader): dataloader, ideally with pinned memory.
+            device (Optional[torch.device]): target device. Defaults to the current device.
+        """
+
+        self.loader = loader
+        self.device = device if device is not None else torch.device("cuda")
+
+    def __len__(self) -> int:
+        return len(self.loader)
+
+    def _to_device(self, batch: Any) -> Any:
+        return _apply_to_tensors(batch, lambda x: x.to(self.device, non_blocking=True))
+
+    def __iter__(self) -> Iterator[Any]:
+        stream = torch.cuda.Stream(device=self.device)
+        loader_iter = iter(self.loader)
+
+        def preload():
+            try:
+                batch = next(loader_iter)
+            except StopIteration:
+                return None
+            with torch.cuda.stream(stream):
+                return self._to_device(batch)
+
+        next_batch = preload()
+        while next_batch is not None:
+            current_stream = torch.cuda.current_stream(self.device)
+            current_stream.wait_stream(stream)
+            batch = next_batch
+            # the tensors are used in the current stream, so their memory can not be
+            # reused by the side stream until the current stream is done with them
+            _apply_to_tensors(batch, lambda x: x.record_stream(current_stream))
+            next_batch = preload()
+            yield batch
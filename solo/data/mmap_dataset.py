@@ -0,0 +1,170 @@
+# Copyright 2023 solo-learn development team.
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in
+# the Software without restriction, including without limitation the rights to use,
+# copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the
+# Software, and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all copies
+# or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR
+# PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE
+# FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR
+# OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+
+
+import os
+from functools import partial
+from multiprocessing import Pool
+from pathlib import Path
+from typing import Callable, List, Optional, Tuple, Union
+
+import numpy as np
+from PIL import Image
+from torch.utils.data import Dataset
+from torchvision.datasets.folder import IMG_EXTENSIONS, make_dataset, pil_loader
+from torchvision.transforms import functional as F
+from tqdm import tqdm
+
+IMAGES_FILE = "images.npy"
+TARGETS_FILE = "targets.npy"
+CLASSES_FILE = "classes.txt"
+
+
+class MMapDataset(Dataset):
+    def __init__(
+        self,
+        root: Union[str, Path],
+        transform: Optional[Callable] = None,
+    ):
+        """Dataset of decoded images stored in a single memory-mapped uint8 array.
+        The folder is generated by `scripts/utils/convert_imgfolder_to_mmap.py` and contains:
+            images.npy: uint8 array of shape (N, size, size, 3).
+            targets.npy: int64 array with the class index of each image.
+            classes.txt: one class name per line, sorted.
+
+        Images are never copied into the process memory. The array is only opened lazily
+        (once per worker) and pages are shared through the OS page cache between all
+        workers and ranks of the same node.
+
+        Args:
+            root (Union[str, Path]): path of the folder generated by the converter.
+            transform (Callable): pipeline of transformations. Defaults to None.
+        """
+
+        self.root = root
+        self.transform = transform
+        self.images = None
+
+        with open(os.path.join(root, CLASSES_FILE)) as f:
+            self.classes = [line.strip() for line in f if line.strip()]
+        self.class_to_idx = {cls_name: i for i, cls_name in enumerate(self.classes)}
+
+        # a single array instead of per-sample python objects, whose reference counts would
+        # make the forked workers copy the pages that hold them
+        self.targets = np.load(os.path.join(root, TARGETS_FILE)).astype(np.int64, copy=False)
+
+    @property
+    def samples(self) -> List[Tuple[int, int]]:
+        """List of (row in the array, class index) tuples, only materialized on request."""
+
+        return list(enumerate(self.targets.tolist()))
+
+    def __getstate__(self):
+        # never pickle the memory map itself, otherwise the whole array would be
+        # serialized when the dataset is sent to spawned workers
+        state = self.__dict__.copy()
+        state["images"] = None
+        return state
+
+    def __getitem__(self, index: int):
+        if self.images is None:
+            self.images = np.load(os.path.join(self.root, IMAGES_FILE), mmap_mode="r")
+
+        y = int(self.targets[index])
+
+        x = Image.fromarray(self.images[index])
+        if self.transform:
+            x = self.transform(x)
+
+        return x, y
+
+    def __len__(self):
+        return len(self.targets)
+
+
+def _load_and_resize(path: str, size: int) -> np.ndarray:
+    """Decodes an image, resizes its shorter side to size and takes the central crop.
+
+    Args:
+        path (str): path of the image.
+        size (int): output resolution.
+
+    Returns:
+        np.ndarray: uint8 array of shape (size, size, 3).
+    """
+
+    img = pil_loader(path)
+    img = F.center_crop(F.resize(img, size), size)
+    return np.asarray(img, dtype=np.uint8)
+
+
+def convert_imgfolder_to_mmap(
+    folder_path: Union[str, Path],
+    output_path: Union[str, Path],
+    size: int = 256,
+    num_workers: int = 8,
+) -> Tuple[int, int]:
+    """Decodes an image folder into a memory-mappable dataset folder for MMapDataset.
+
+    Args:
+        folder_path (Union[str, Path]): path to the image folder (one subfolder per class).
+        output_path (Union[str, Path]): output folder.
+        size (int): resolution of the stored images. Defaults to 256.
+        num_workers (int): number of decoding processes, 0 decodes in the current process.
+            Defaults to 8.
+
+    Returns:
+        Tuple[int, int]: number of images and number of classes.
+    """
+
+    classes = sorted(d.name for d in os.scandir(folder_path) if d.is_dir())
+    class_to_idx = {cls_name: i for i, cls_name in enumerate(classes)}
+    samples = make_dataset(str(folder_path), class_to_idx, extensions=IMG_EXTENSIONS)
+    paths = [path for path, _ in samples]
+
+    os.makedirs(output_path, exist_ok=True)
+    images = np.lib.format.open_memmap(
+        os.path.join(output_path, IMAGES_FILE),
+        mode="w+",
+        dtype=np.uint8,
+        shape=(len(samples), size, size, 3),
+    )
+
+    load_fn = partial(_load_and_resize, size=size)
+    pbar = tqdm(total=len(paths), desc="Decoding images")
+    if num_workers > 0:
+        with Pool(num_workers) as pool:
+            for i, img in enumerate(pool.imap(load_fn, paths, chunksize=64)):
+                images[i] = img
+                pbar.update()
+    else:
+        for i, path in enumerate(paths):
+            images[i] = load_fn(path)
+            pbar.update()
+    pbar.close()
+    images.flush()
+    del images
+
+    np.save(
+        os.path.join(output_path, TARGETS_FILE), np.array([y for _, y in samples], dtype=np.int64)
+    )
+    with open(os.path.join(output_path, CLASSES_FILE), "w") as f:
+        f.write("\n".join(classes) + "\n")
+
+    return len(samples), len(classes)
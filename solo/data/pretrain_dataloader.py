@@ -17,20 +17,29 @@
 # OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
 # DEALINGS IN THE SOFTWARE.
 
+import math
 import os
 import random
 from pathlib import Path
-from typing import Callable, List, Optional, Sequence, Type, Union
+from typing import Callable, List, Optional, Sequence, Tuple, Type, Union
 
 import torch
 import torchvision
 from PIL import Image, ImageFilter, ImageOps
 from timm.data.constants import IMAGENET_DEFAULT_MEAN, IMAGENET_DEFAULT_STD
-from torch.utils.data import DataLoader
+from torch.utils.data import DataLoader, Sampler
 from torch.utils.data.dataset import Dataset
 from torchvision import transforms
-from torchvision.datasets import STL10, ImageFolder
+from torchvision.datasets import STL10
+from torchvision.ops import roi_align
+from torchvision.transforms import functional as TF
+from solo.data.batched_augmentations import BatchedAugmentation
+from solo.data.compact_dataset import CompactImageFolder
+from solo.data.loader import dataloader_kwargs
+from solo.data.mmap_dataset import MMapDataset
 from solo.data.ram_dataset import RAMImageFolder
+from solo.data.subset import IndexedSubset, stratified_subset
+from solo.losses.mae import normalize_patches, patchify
 
 try:
     from solo.data.h5_dataset import H5Dataset
@@ -55,6 +64,12 @@ def dataset_with_index(DatasetClass: Type[Dataset]) -> Type[Dataset]:
             data = super().__getitem__(index)
             return (index, *data)
 
+        if hasattr(DatasetClass, "__getitems__"):
+
+            def __getitems__(self, indices):
+                data = super().__getitems__(indices)
+                return [(index, *d) for index, d in zip(indices, data)]
+
     return DatasetWithIndex
 
 
@@ -176,6 +191,215 @@ class FullTransformPipeline:
         return "\n".join([str(transform) for transform in self.transforms])
 
 
+class MAETargetPipeline:
+    def __init__(
+        self, transform: Callable, num_large_crops: int, patch_size: int, norm_pix_loss: bool
+    ) -> None:
+        """Wraps a transformation pipeline to also return the reconstruction targets of MAE for
+        the large crops, so that they are patchified (and normalized) by the data loading workers
+        instead of in the training step. The targets are appended after all the crops.
+
+        Args:
+            transform (Callable): transformation pipeline that generates the crops.
+            num_large_crops (int): number of large crops (the first ones) to compute targets for.
+            patch_size (int): size of each patch.
+            norm_pix_loss (bool): whether to normalize the pixels of each patch with their
+                respective mean and std.
+        """
+
+        self.transform = transform
+        self.num_large_crops = num_large_crops
+        self.patch_size = patch_size
+        self.norm_pix_loss = norm_pix_loss
+
+    def __call__(self, x: Image) -> List[torch.Tensor]:
+        """Applies the transforms and computes the targets of the large crops.
+
+        Args:
+            x (Image): an image in the PIL.Image format.
+
+        Returns:
+            List[torch.Tensor]: the crops followed by the targets of the large crops.
+        """
+
+        crops = self.transform(x)
+        targets = patchify(torch.stack(crops[: self.num_large_crops]), self.patch_size)
+        if self.norm_pix_loss:
+            targets = normalize_patches(targets)
+        return crops + list(targets.unbind(0))
+
+    def __repr__(self) -> str:
+        return f"{self.transform}\n+ {self.num_large_crops} x [MAE targets (patch size {self.patch_size})]"
+
+
+class MultiCropGenerator:
+    def __init__(
+        self,
+        crop_sizes: Sequence[int],
+        num_crops: Sequence[int],
+        scales: Sequence[Tuple[float, float]],
+        mean: Optional[Sequence[float]] = None,
+        std: Optional[Sequence[float]] = None,
+        ratio: Tuple[float, float] = (3.0 / 4.0, 4.0 / 3.0),
+    ):
+        """Generates all the random resized crops of an image from a single decoded tensor.
+        The image is converted to a tensor once, the crop boxes of every crop are sampled in one
+        vectorized call and the crops of each size are cropped and resized together with
+        roi_align. Since roi_align averages ceil(box / crop) samples per output pixel, the
+        downscaling is antialiased, but the interpolation is bilinear instead of bicubic.
+
+        Args:
+            crop_sizes (Sequence[int]): size of the crops of each group.
+            num_crops (Sequence[int]): number of crops of each group.
+            scales (Sequence[Tuple[float, float]]): range of the area of the crops of each group
+                relative to the area of the image.
+            mean (Optional[Sequence[float]]): mean used to normalize the crops. If None, the
+                crops are returned as uint8 tensors, e.g. to be augmented by a
+                BatchedAugmentation. Defaults to None.
+            std (Optional[Sequence[float]]): std used to normalize the crops. Defaults to None.
+            ratio (Tuple[float, float]): range of the aspect ratio of the crops.
+                Defaults to (3 / 4, 4 / 3).
+        """
+
+        assert len(crop_sizes) == len(num_crops) == len(scales)
+        assert (mean is None) == (std is None)
+
+        self.crop_sizes = list(crop_sizes)
+        self.num_crops = list(num_crops)
+        self.scales = torch.tensor([scale for scale, n in zip(scales, num_crops) for _ in range(n)])
+        self.log_ratio = (math.log(ratio[0]), math.log(ratio[1]))
+        self.ratio = ratio
+
+        self.mean = self.std = None
+        if mean is not None:
+            self.mean = torch.tensor(mean).view(1, 3, 1, 1) * 255
+            self.std = torch.tensor(std).view(1, 3, 1, 1) * 255
+
+    def sample_boxes(self, height: int, width: int, attempts: int = 10) -> torch.Tensor:
+        """Samples the boxes of all the crops at once, following the same procedure as
+        torchvision's RandomResizedCrop.get_params.
+
+        Args:
+            height (int): height of the image.
+            width (int): width of the image.
+            attempts (int): number of candidate boxes per crop. Defaults to 10.
+
+        Returns:
+            torch.Tensor: boxes with shape (num_crops, 4) in the (x1, y1, x2, y2) format.
+        """
+
+        n = self.scales.size(0)
+        area = height * width
+
+        scale = torch.rand(n, attempts)
+        scale = self.scales[:, :1] + scale * (self.scales[:, 1:] - self.scales[:, :1])
+        log_ratio = torch.empty(n, attempts).uniform_(*self.log_ratio)
+        aspect_ratio = torch.exp(log_ratio)
+
+        w = torch.round(torch.sqrt(area * scale * aspect_ratio))
+        h = torch.round(torch.sqrt(area * scale / aspect_ratio))
+        valid = (w > 0) & (h > 0) & (w <= width) & (h <= height)
+
+        # first valid attempt of each crop
+        first = torch.argmax(valid.int(), dim=1, keepdim=True)
+        w = w.gather(1, first).squeeze(1)
+        h = h.gather(1, first).squeeze(1)
+        found = valid.any(dim=1)
+
+        # fallback to the central crop
+        in_ratio = width / height
+        if in_ratio < self.ratio[0]:
+            fallback_w, fallback_h = width, round(width / self.ratio[0])
+        elif in_ratio > self.ratio[1]:
+            fallback_w, fallback_h = round(height * self.ratio[1]), height
+        else:
+            fallback_w, fallback_h = width, height
+        w = torch.where(found, w, torch.full_like(w, fallback_w))
+        h = torch.where(found, h, torch.full_like(h, fallback_h))
+
+        x1 = torch.floor(torch.rand(n) * (width - w + 1))
+        y1 = torch.floor(torch.rand(n) * (height - h + 1))
+        x1 = torch.where(found, x1, torch.div(width - w, 2, rounding_mode="floor"))
+        y1 = torch.where(found, y1, torch.div(height - h, 2, rounding_mode="floor"))
+        return torch.stack((x1, y1, x1 + w, y1 + h), dim=1)
+
+    def __call__(self, x: Union[Image.Image, torch.Tensor]) -> List[torch.Tensor]:
+        """Generates all the crops of an image.
+
+        Args:
+            x (Union[Image.Image, torch.Tensor]): an image in the PIL.Image format or as a uint8
+                tensor with shape (3, H, W).
+
+        Returns:
+            List[torch.Tensor]: the crops, uint8 if no normalization was given.
+        """
+
+        if not isinstance(x, torch.Tensor):
+            x = TF.pil_to_tensor(x)
+        x = x.unsqueeze(0).float()
+
+        boxes = self.sample_boxes(x.size(2), x.size(3))
+        boxes = torch.cat((torch.zeros(boxes.size(0), 1), boxes), dim=1)
+
+        out = []
+        for crop_size, group_boxes in zip(self.crop_sizes, boxes.split(self.num_crops)):
+            crops = roi_align(x, group_boxes, crop_size, sampling_ratio=-1, aligned=True)
+            if self.mean is None:
+                crops = crops.round_().clamp_(0, 255).to(torch.uint8)
+            else:
+                crops.sub_(self.mean).div_(self.std)
+            out.extend(crops.unbind(0))
+        return out
+
+    def __repr__(self) -> str:
+        return "\n".join(
+            f"{n} x [decode-once random resized crop {size} (scale {tuple(scale[0].tolist())})]"
+            for size, n, scale in zip(
+                self.crop_sizes, self.num_crops, self.scales.split(self.num_crops)
+            )
+        )
+
+
+def get_mean_std(dataset: str, cfg) -> Tuple[Sequence[float], Sequence[float]]:
+    """Returns the normalization mean and std of a dataset. Custom datasets use the values
+    of the augmentation Cfg node if present, otherwise the ImageNet ones.
+
+    Args:
+        dataset (str): the name of the dataset.
+        cfg: augmentation Cfg node.
+
+    Returns:
+        Tuple[Sequence[float], Sequence[float]]: mean and std.
+    """
+
+    MEANS_N_STD = {
+        "cifar10": ((0.4914, 0.4822, 0.4465), (0.2470, 0.2435, 0.2616)),
+        "cifar100": ((0.5071, 0.4865, 0.4409), (0.2673, 0.2564, 0.2762)),
+        "stl10": ((0.4914, 0.4823, 0.4466), (0.247, 0.243, 0.261)),
+        "imagenet100": (IMAGENET_DEFAULT_MEAN, IMAGENET_DEFAULT_STD),
+        "imagenet": (IMAGENET_DEFAULT_MEAN, IMAGENET_DEFAULT_STD),
+        "imagenette": (IMAGENET_DEFAULT_MEAN, IMAGENET_DEFAULT_STD),
+        "tiny-imagenet": ((0.480, 0.448, 0.398), (0.277, 0.269, 0.282)),
+    }
+
+    return MEANS_N_STD.get(
+        dataset, (cfg.get("mean", IMAGENET_DEFAULT_MEAN), cfg.get("std", IMAGENET_DEFAULT_STD))
+    )
+
+
+def _build_crop_transform(cfg) -> Callable:
+    if cfg.rrc.enabled:
+        return transforms.RandomResizedCrop(
+            cfg.crop_size,
+            scale=(cfg.rrc.crop_min_scale, cfg.rrc.crop_max_scale),
+            interpolation=transforms.InterpolationMode.BICUBIC,
+        )
+    return transforms.Resize(
+        cfg.crop_size,
+        interpolation=transforms.InterpolationMode.BICUBIC,
+    )
+
+
 def build_transform_pipeline(dataset, cfg):
     """Creates a pipeline of transformations given a dataset and an augmentation Cfg node.
     The node needs to be in the following format:
@@ -204,36 +428,9 @@ def build_transform_pipeline(dataset, cfg):
             prob: float
     """
 
-    MEANS_N_STD = {
-        "cifar10": ((0.4914, 0.4822, 0.4465), (0.2470, 0.2435, 0.2616)),
-        "cifar100": ((0.5071, 0.4865, 0.4409), (0.2673, 0.2564, 0.2762)),
-        "stl10": ((0.4914, 0.4823, 0.4466), (0.247, 0.243, 0.261)),
-        "imagenet100": (IMAGENET_DEFAULT_MEAN, IMAGENET_DEFAULT_STD),
-        "imagenet": (IMAGENET_DEFAULT_MEAN, IMAGENET_DEFAULT_STD),
-        "imagenette": (IMAGENET_DEFAULT_MEAN, IMAGENET_DEFAULT_STD),
-        "tiny-imagenet": ((0.480, 0.448, 0.398), (0.277, 0.269, 0.282)),
-    }
-
-    mean, std = MEANS_N_STD.get(
-        dataset, (cfg.get("mean", IMAGENET_DEFAULT_MEAN), cfg.get("std", IMAGENET_DEFAULT_STD))
-    )
+    mean, std = get_mean_std(dataset, cfg)
 
-    augmentations = []
-    if cfg.rrc.enabled:
-        augmentations.append(
-            transforms.RandomResizedCrop(
-                cfg.crop_size,
-                scale=(cfg.rrc.crop_min_scale, cfg.rrc.crop_max_scale),
-                interpolation=transforms.InterpolationMode.BICUBIC,
-            ),
-        )
-    else:
-        augmentations.append(
-            transforms.Resize(
-                cfg.crop_size,
-                interpolation=transforms.InterpolationMode.BICUBIC,
-            ),
-        )
+    augmentations = [_build_crop_transform(cfg)]
 
     if cfg.color_jitter.prob:
         augmentations.append(
@@ -272,6 +469,71 @@ def build_transform_pipeline(dataset, cfg):
     return augmentations
 
 
+def build_batched_transform_pipeline(dataset, cfg) -> Tuple[Callable, BatchedAugmentation]:
+    """Creates the batched alternative of build_transform_pipeline, with the same Cfg node.
+    The per-sample transformation only crops (or resizes) the image and converts it to a uint8
+    tensor, so that the data loading workers do no photometric work per image. Everything else
+    (color jitter, grayscale, gaussian blur, solarization, equalization, horizontal flip and
+    normalization) is done by the returned BatchedAugmentation on whole collated batches.
+
+    Returns:
+        Tuple[Callable, BatchedAugmentation]: per-sample transformation and the augmentation of
+            the batches of crops that it generates.
+    """
+
+    mean, std = get_mean_std(dataset, cfg)
+
+    transform = transforms.Compose([_build_crop_transform(cfg), transforms.PILToTensor()])
+    augmentation = BatchedAugmentation(
+        mean,
+        std,
+        color_jitter_prob=cfg.color_jitter.prob,
+        brightness=cfg.color_jitter.brightness,
+        contrast=cfg.color_jitter.contrast,
+        saturation=cfg.color_jitter.saturation,
+        hue=cfg.color_jitter.hue,
+        grayscale_prob=cfg.grayscale.prob,
+        gaussian_blur_prob=cfg.gaussian_blur.prob,
+        solarization_prob=cfg.solarization.prob,
+        equalization_prob=cfg.equalization.prob,
+        horizontal_flip_prob=cfg.horizontal_flip.prob,
+    )
+    return transform, augmentation
+
+
+def prepare_multicrop_generator(
+    dataset: str, cfgs: Sequence, normalize: bool = False
+) -> MultiCropGenerator:
+    """Creates a MultiCropGenerator for a list of augmentation Cfg nodes, in the same format as
+    in build_transform_pipeline. Only the random resized crop of each node is done by the
+    generator, so either the rest of the augmentations need to be applied afterwards by
+    BatchedAugmentations or they must all be disabled.
+
+    Args:
+        dataset (str): the name of the dataset.
+        cfgs (Sequence): augmentation Cfg nodes.
+        normalize (bool): whether to normalize the crops instead of returning them as uint8
+            tensors. Defaults to False.
+
+    Returns:
+        MultiCropGenerator: the crop generator.
+    """
+
+    assert all(cfg.rrc.enabled for cfg in cfgs), "Crops can only be generated with rrc enabled."
+
+    mean = std = None
+    if normalize:
+        mean, std = get_mean_std(dataset, cfgs[0])
+
+    return MultiCropGenerator(
+        crop_sizes=[cfg.crop_size for cfg in cfgs],
+        num_crops=[cfg.num_crops for cfg in cfgs],
+        scales=[(cfg.rrc.crop_min_scale, cfg.rrc.crop_max_scale) for cfg in cfgs],
+        mean=mean,
+        std=std,
+    )
+
+
 def prepare_n_crop_transform(
     transforms: List[Callable], num_crops_per_aug: List[int]
 ) -> NCropAugmentation:
@@ -301,6 +563,7 @@ def prepare_datasets(
     no_labels: Optional[Union[str, Path]] = False,
     download: bool = True,
     data_fraction: float = -1.0,
+    ram_cache_dir: Optional[str] = None,
 ) -> Dataset:
     """Prepares the desired dataset.
 
@@ -309,10 +572,12 @@ def prepare_datasets(
         transform (Callable): a transformation.
         train_dir (Optional[Union[str, Path]]): training data path. Defaults to None.
         data_format (Optional[str]): format of the data. Defaults to "image_folder".
-            Possible values are "image_folder", "h5", and "ram_image_folder".
+            Possible values are "image_folder", "h5", "ram_image_folder" and "npy_mmap".
         no_labels (Optional[bool]): if the custom dataset has no labels.
         data_fraction (Optional[float]): percentage of data to use. Use all data when set to -1.0.
             Defaults to -1.0.
+        ram_cache_dir (Optional[str]): folder where the "ram_image_folder" format caches the
+            decoded images. Defaults to None (no cache).
     Returns:
         Dataset: the desired dataset with transformations.
     """
@@ -343,42 +608,60 @@ def prepare_datasets(
             assert _h5_available
             train_dataset = dataset_with_index(H5Dataset)(dataset, train_data_path, transform)
         elif data_format == "ram_image_folder":
-            train_dataset = dataset_with_index(RAMImageFolder)(train_data_path, transform)
+            train_dataset = dataset_with_index(RAMImageFolder)(
+                train_data_path, transform, cache_dir=ram_cache_dir
+            )
+        elif data_format == "npy_mmap":
+            train_dataset = dataset_with_index(MMapDataset)(train_data_path, transform)
         else:
-            train_dataset = dataset_with_index(ImageFolder)(train_data_path, transform)
+            train_dataset = dataset_with_index(CompactImageFolder)(train_data_path, transform)
 
     elif dataset == "custom":
         if no_labels:
             dataset_class = CustomDatasetWithoutLabels
+        elif data_format == "npy_mmap":
+            dataset_class = MMapDataset
         else:
-            dataset_class = ImageFolder
+            dataset_class = CompactImageFolder
 
         train_dataset = dataset_with_index(dataset_class)(train_data_path, transform)
 
     if data_fraction > 0:
-        assert data_fraction < 1, "Only use data_fraction for values smaller than 1."
-        data = train_dataset.samples
-        files = [f for f, _ in data]
-        labels = [l for _, l in data]
-
-        from sklearn.model_selection import train_test_split
-
-        files, _, labels, _ = train_test_split(
-            files, labels, train_size=data_fraction, stratify=labels, random_state=42
-        )
-        train_dataset.samples = [tuple(p) for p in zip(files, labels)]
+        train_dataset = stratified_subset(train_dataset, data_fraction, subset_class=IndexedSubset)
 
     return train_dataset
 
 
 def prepare_dataloader(
-    train_dataset: Dataset, batch_size: int = 64, num_workers: int = 4
+    train_dataset: Dataset,
+    batch_size: int = 64,
+    num_workers: int = 4,
+    collate_fn: Optional[Callable] = None,
+    pin_memory: bool = True,
+    persistent_workers: bool = False,
+    prefetch_factor: Optional[int] = None,
+    channels_last: bool = False,
+    worker_init_fn: Optional[Callable] = None,
+    sampler: Optional[Sampler] = None,
 ) -> DataLoader:
     """Prepares the training dataloader for pretraining.
     Args:
         train_dataset (Dataset): the name of the dataset.
         batch_size (int, optional): batch size. Defaults to 64.
         num_workers (int, optional): number of workers. Defaults to 4.
+        collate_fn (Optional[Callable], optional): collate function, e.g. a
+            BatchedAugmentationCollate. Defaults to None (torch's default collate).
+        pin_memory (bool, optional): whether to pin the batches. Defaults to True.
+        persistent_workers (bool, optional): whether to keep the workers alive between epochs.
+            Defaults to False.
+        prefetch_factor (Optional[int], optional): number of batches loaded in advance by each
+            worker. Defaults to None (torch's default).
+        channels_last (bool, optional): whether to collate the crops in the channels last
+            format. Defaults to False.
+        worker_init_fn (Optional[Callable], optional): function called in each worker on
+            startup. Defaults to None.
+        sampler (Optional[Sampler], optional): sampler of the training samples. Shuffles the
+            dataset when None. Defaults to None.
     Returns:
         DataLoader: the training dataloader with the desired dataset.
     """
@@ -386,9 +669,17 @@ def prepare_dataloader(
     train_loader = DataLoader(
         train_dataset,
         batch_size=batch_size,
-        shuffle=True,
-        num_workers=num_workers,
-        pin_memory=True,
+        shuffle=sampler is None,
+        sampler=sampler,
         drop_last=True,
+        **dataloader_kwargs(
+            num_workers,
+            pin_memory=pin_memory,
+            persistent_workers=persistent_workers,
+            prefetch_factor=prefetch_factor,
+            channels_last=channels_last,
+            collate_fn=collate_fn,
+            worker_init_fn=worker_init_fn,
+        ),
     )
     return train_loader
@@ -5,13 +5,78 @@ from torchvision.datasets import VisionDataset
 
 from PIL import Image
 
+import hashlib
 import os
 import os.path
 import sys
+import tempfile
+import time
 import tqdm
+from functools import partial
+from multiprocessing import Pool
+
+import numpy as np
+import torch.distributed as dist
 
 from torchvision.datasets.folder import has_file_allowed_extension, is_image_file, make_dataset, pil_loader, accimage_loader, default_loader, IMG_EXTENSIONS
 
+# decoding buffer of the current preloading worker, see _init_decoding_worker
+_decoding_buffer = None
+
+
+def _image_shape(path, loader):
+    """Returns the (height, width, channels) of an image after loading."""
+    if loader in (default_loader, pil_loader):
+        # only the header is read, the default loaders convert images to RGB
+        with Image.open(path) as img:
+            return img.height, img.width, 3
+    shape = np.asarray(loader(path)).shape
+    return shape if len(shape) == 3 else (*shape, 1)
+
+
+def _wait_for_file(path, poll_interval=5):
+    """Waits until another process creates a file."""
+    while not os.path.isfile(path):
+        time.sleep(poll_interval)
+
+
+def _init_decoding_worker(buffer_path):
+    global _decoding_buffer
+    _decoding_buffer = np.load(buffer_path, mmap_mode="r+")
+
+
+def _decode_into_buffer(task, loader):
+    """Decodes an image directly into its slice of the shared decoding buffer."""
+    path, start, end = task
+    _decoding_buffer[start:end] = np.asarray(loader(path), dtype=np.uint8).reshape(-1)
+
+
+class DecodedImages:
+    """Sequence of decoded images stored back to back in a single flat uint8 array.
+
+    Keeping a single array instead of one PIL object per image avoids the per-object
+    overhead and keeps the memory shared between forked workers, since reading a sample
+    never touches the reference count of an object per image.
+
+    Args:
+        pixels (np.ndarray): flat uint8 array with all the images.
+        shapes (np.ndarray): (N, 3) array with the (height, width, channels) of each image.
+    """
+
+    def __init__(self, pixels, shapes):
+        self.pixels = pixels
+        self.shapes = shapes
+        self.offsets = np.concatenate([[0], np.cumsum(np.prod(shapes, axis=1, dtype=np.int64))])
+
+    def __getitem__(self, index):
+        h, w, c = self.shapes[index]
+        img = self.pixels[self.offsets[index] : self.offsets[index + 1]].reshape(h, w, c)
+        return Image.fromarray(img[..., 0] if c == 1 else img)
+
+    def __len__(self):
+        return len(self.shapes)
+
+
 class RAMDatasetFolder(VisionDataset):
     """A generic data loader where the samples are arranged in this way: ::
 
@@ -22,7 +87,7 @@ class RAMDatasetFolder(VisionDataset):
         root/class_y/123.ext
         root/class_y/nsdf3.ext
         root/class_y/asd932_.ext
-    
+
     This data loader loads all samples into memory on initialization, instead
     of loading samples on iteration over the dataset.
 
@@ -39,17 +104,23 @@ class RAMDatasetFolder(VisionDataset):
         is_valid_file (callable, optional): A function that takes path of an Image file
             and check if the file is a valid_file (used to check of corrupt files)
             both extensions and is_valid_file should not be passed.
+        num_workers (int, optional): Number of processes used to decode the images.
+            Defaults to the number of CPUs, 0 decodes in the current process.
+        cache_dir (string, optional): Folder where the decoded dataset is cached, keyed
+            by the list of files and their modification times. The cache is built by the
+            local rank 0 while the other ranks wait for it. Defaults to None (no cache).
 
      Attributes:
         classes (list): List of the class names.
         class_to_idx (dict): Dict with items (class_name, class_index).
         samples (list): List of (sample path, class_index) tuples.
-        images (list): List of pre-loaded PIL images.
+        images (DecodedImages): Pre-loaded images, indexing returns PIL images.
         targets (list): The class_index value for each image in the dataset.
     """
 
     def __init__(self, root, loader, extensions=None, transform=None,
-                 target_transform=None, is_valid_file=None):
+                 target_transform=None, is_valid_file=None, num_workers=None,
+                 cache_dir=None):
         super(RAMDatasetFolder, self).__init__(root, transform=transform,
                                                target_transform=target_transform)
         classes, class_to_idx = self._find_classes(self.root)
@@ -60,6 +131,8 @@ class RAMDatasetFolder(VisionDataset):
 
         self.loader = loader
         self.extensions = extensions
+        self.num_workers = os.cpu_count() if num_workers is None else num_workers
+        self.cache_dir = cache_dir
 
         self.classes = classes
         self.class_to_idx = class_to_idx
@@ -92,22 +165,108 @@ class RAMDatasetFolder(VisionDataset):
         class_to_idx = {classes[i]: i for i in range(len(classes))}
         return classes, class_to_idx
 
+    def _cache_key(self):
+        """
+        Hashes the list of files with their modification times and sizes, so that any
+        change to the folder invalidates the cached decoded dataset.
+        """
+        h = hashlib.sha1(getattr(self.loader, "__qualname__", repr(self.loader)).encode())
+        for path, _ in self.samples:
+            stat = os.stat(path)
+            h.update(f"{path}\t{stat.st_mtime_ns}\t{stat.st_size}\n".encode())
+        return h.hexdigest()
+
+    def _decode_all(self, buffer_path):
+        """
+        Decodes all images in parallel directly into a memory-mapped file.
+
+        Args:
+            buffer_path (string): Path of the .npy file to decode into.
+
+        Returns:
+            np.ndarray: (N, 3) array with the shape of each image.
+        """
+        paths = [path for path, _ in self.samples]
+        shape_fn = partial(_image_shape, loader=self.loader)
+        decode_fn = partial(_decode_into_buffer, loader=self.loader)
+
+        def run(pool, fn, tasks, desc):
+            it = pool.imap(fn, tasks, chunksize=64) if pool is not None else map(fn, tasks)
+            return list(tqdm.tqdm(it, total=len(tasks), desc=desc))
+
+        if self.num_workers > 0:
+            with Pool(self.num_workers) as pool:
+                shapes = run(pool, shape_fn, paths, "Reading image sizes")
+        else:
+            shapes = run(None, shape_fn, paths, "Reading image sizes")
+        shapes = np.array(shapes, dtype=np.int64)
+
+        offsets = np.concatenate([[0], np.cumsum(np.prod(shapes, axis=1))])
+        buffer = np.lib.format.open_memmap(buffer_path, mode="w+", dtype=np.uint8, shape=(int(offsets[-1]),))
+        del buffer
+
+        tasks = list(zip(paths, offsets[:-1].tolist(), offsets[1:].tolist()))
+        if self.num_workers > 0:
+            with Pool(self.num_workers, initializer=_init_decoding_worker, initargs=(buffer_path,)) as pool:
+                run(pool, decode_fn, tasks, "Pre-loading dataset")
+        else:
+            _init_decoding_worker(buffer_path)
+            run(None, decode_fn, tasks, "Pre-loading dataset")
+        return shapes
+
     def load_all(self):
         """
         Preload all images without transformations into memory.
         Transformations are to be applied when accessing the dataset.
+        Images are decoded in parallel and, if cache_dir is set, the decoded dataset
+        is stored on disk so that following runs only need to read it back.
+        The decoded images are memory-mapped, so they are held once per node and shared with
+        forked dataloader workers instead of being copied into each process.
 
         Throws:
             MemoryError: when the dataset cannot fit in memory.
         """
-        self.images = []
+        if self.cache_dir is not None:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            key = self._cache_key()
+            pixels_path = os.path.join(self.cache_dir, f"{key}.npy")
+            shapes_path = os.path.join(self.cache_dir, f"{key}_shapes.npy")
+            distributed = dist.is_available() and dist.is_initialized()
+            if not os.path.isfile(pixels_path):
+                if int(os.environ.get("LOCAL_RANK", 0)) == 0:
+                    # write to temporary files first, other nodes may be filling the same cache
+                    suffix = f".{os.getpid()}.tmp"
+                    shapes = self._decode_all(pixels_path + suffix)
+                    with open(shapes_path + suffix, "wb") as f:
+                        np.save(f, shapes)
+                    os.replace(shapes_path + suffix, shapes_path)
+                    # the pixels file is moved last and marks the cache as complete
+                    os.replace(pixels_path + suffix, pixels_path)
+                elif not distributed:
+                    # the process group does not exist yet (e.g. torchrun), so the other
+                    # ranks wait for the cache file instead of decoding the same images
+                    _wait_for_file(pixels_path)
+            if distributed:
+                dist.barrier()
+            shapes = np.load(shapes_path)
+        else:
+            fd, pixels_path = tempfile.mkstemp(
+                suffix=".npy", dir="/dev/shm" if os.path.isdir("/dev/shm") else None
+            )
+            os.close(fd)
+            shapes = self._decode_all(pixels_path)
+
         try:
-            for sample in tqdm.tqdm(self.samples, desc='Pre-loading dataset'):
-                path, _ = sample
-                self.images.append(self.loader(path))
+            # the decoded images are mapped instead of copied, so all the ranks and workers of a
+            # node share the same pages of the page cache (or of /dev/shm)
+            self.images = DecodedImages(np.load(pixels_path, mmap_mode="r"), shapes)
         except MemoryError:
             raise MemoryError("Dataset cannot fit in memory! Please run "
                               "without --ram-dataset.")
+        finally:
+            if self.cache_dir is None:
+                # the mapping keeps the unlinked file alive until the dataset is released
+                os.remove(pixels_path)
 
     def __getitem__(self, index):
         """
@@ -155,19 +314,27 @@ class RAMImageFolder(RAMDatasetFolder):
         loader (callable, optional): A function to load an image given its path.
         is_valid_file (callable, optional): A function that takes path of an Image file
             and check if the file is a valid_file (used to check of corrupt files)
+        num_workers (int, optional): Number of processes used to decode the images.
+            Defaults to the number of CPUs, 0 decodes in the current process.
+        cache_dir (string, optional): Folder where the decoded dataset is cached, keyed
+            by the list of files and their modification times. The cache is built by the
+            local rank 0 while the other ranks wait for it. Defaults to None (no cache).
 
      Attributes:
         classes (list): List of the class names.
         class_to_idx (dict): Dict with items (class_name, class_index).
         imgs (list): List of (image path, class_index) tuples.
-        loaded_imgs (list): List of pre-loaded PIL images.
+        loaded_imgs (DecodedImages): Pre-loaded images, indexing returns PIL images.
     """
 
     def __init__(self, root, transform=None, target_transform=None,
-                 loader=default_loader, is_valid_file=None):
+                 loader=default_loader, is_valid_file=None, num_workers=None,
+                 cache_dir=None):
         super(RAMImageFolder, self).__init__(root, loader, IMG_EXTENSIONS if is_valid_file is None else None,
                                              transform=transform,
                                              target_transform=target_transform,
-                                             is_valid_file=is_valid_file)
+                                             is_valid_file=is_valid_file,
+                                             num_workers=num_workers,
+                                             cache_dir=cache_dir)
         self.imgs = self.samples
         self.loaded_imgs = self.images
@@ -0,0 +1,146 @@
+# Copyright 2023 solo-learn development team.
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in
+# the Software without restriction, including without limitation the rights to use,
+# copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the
+# Software, and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all copies
+# or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR
+# PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE
+# FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR
+# OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+
+import math
+from typing import Any, Dict, Iterator, Optional
+
+import torch
+import torch.distributed as dist
+from torch.utils.data import Dataset, Sampler
+
+
+class ResumableDistributedSampler(Sampler):
+    def __init__(
+        self,
+        dataset: Dataset,
+        shuffle: bool = True,
+        seed: int = 0,
+        drop_last: bool = False,
+        num_replicas: Optional[int] = None,
+        rank: Optional[int] = None,
+    ):
+        """Distributed sampler that can resume an epoch from the middle. As torch's
+        DistributedSampler, the permutation of each epoch only depends on the seed and the
+        epoch, so that only the epoch and the position in it need to be stored to resume.
+
+        The number of replicas and the rank are resolved lazily, when iterating, because the
+        dataloaders are built before the distributed processes are initialized. So, when used
+        with Lightning, the Trainer should be created with use_distributed_sampler=False.
+
+        __len__ always returns the length of a full epoch, so that Lightning's batch counters
+        stay correct, but a resumed epoch only yields the samples after the stored position.
+
+        Args:
+            dataset (Dataset): dataset to sample from.
+            shuffle (bool): whether to shuffle the indices. Defaults to True.
+            seed (int): random seed of the permutations. Defaults to 0.
+            drop_last (bool): whether to drop the tail of the data to make it evenly divisible
+                across the replicas, instead of padding it. Defaults to False.
+            num_replicas (Optional[int]): number of processes. Defaults to the world size.
+            rank (Optional[int]): rank of the current process. Defaults to the current rank.
+        """
+
+        self.dataset = dataset
+        self.shuffle = shuffle
+        self.seed = seed
+        self.drop_last = drop_last
+        self._num_replicas = num_replicas
+        self._rank = rank
+
+        self.epoch = 0
+        # position, in samples of this replica, from which the next iteration starts
+        self.position = 0
+        # position from which the current iteration started
+        self.epoch_start_position = 0
+
+    @property
+    def num_replicas(self) -> int:
+        if self._num_replicas is not None:
+            return self._num_replicas
+        return dist.get_world_size() if dist.is_available() and dist.is_initialized() else 1
+
+    @property
+    def rank(self) -> int:
+        if self._rank is not None:
+            return self._rank
+        return dist.get_rank() if dist.is_available() and dist.is_initialized() else 0
+
+    def __len__(self) -> int:
+        if self.drop_last:
+            return len(self.dataset) // self.num_replicas
+        return math.ceil(len(self.dataset) / self.num_replicas)
+
+    def set_epoch(self, epoch: int):
+        """Sets the epoch of the next iteration. Changing the epoch discards the stored
+        position, which only applies to the epoch it was stored for.
+
+        Args:
+            epoch (int): the epoch.
+        """
+
+        if epoch != self.epoch:
+            self.position = 0
+        self.epoch = epoch
+
+    def __iter__(self) -> Iterator[int]:
+        n = len(self.dataset)
+        if self.shuffle:
+            generator = torch.Generator()
+            generator.manual_seed(self.seed + self.epoch)
+            indices = torch.randperm(n, generator=generator)
+        else:
+            indices = torch.arange(n)
+
+        num_samples = len(self)
+        total_size = num_samples * self.num_replicas
+        if total_size > n:
+            indices = torch.cat((indices, indices[: total_size - n]))
+        indices = indices[self.rank : total_size : self.num_replicas]
+
+        # the stored position is only used once
+        self.epoch_start_position = min(self.position, num_samples)
+        self.position = 0
+        return iter(indices[self.epoch_start_position :].tolist())
+
+    def state_dict(self, num_consumed: int = 0) -> Dict[str, Any]:
+        """Returns the state of the sampler.
+
+        Args:
+            num_consumed (int): number of samples of the current iteration already consumed by
+                the training. Defaults to 0.
+
+        Returns:
+            Dict[str, Any]: the epoch and the position to resume from.
+        """
+
+        return {
+            "epoch": self.epoch,
+            "position": self.epoch_start_position + num_consumed,
+            "seed": self.seed,
+            "num_replicas": self.num_replicas,
+        }
+
+    def load_state_dict(self, state_dict: Dict[str, Any]):
+        assert state_dict["seed"] == self.seed, "Can not resume with a different seed."
+        assert (
+            state_dict["num_replicas"] == self.num_replicas
+        ), "Can not resume with a different number of processes."
+
+        self.epoch = state_dict["epoch"]
+        self.position = state_dict["position"]
@@ -0,0 +1,129 @@
+# Copyright 2023 solo-learn development team.
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in
+# the Software without restriction, including without limitation the rights to use,
+# copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the
+# Software, and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all copies
+# or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR
+# PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE
+# FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR
+# OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+
+from typing import List, Optional, Type
+
+import numpy as np
+from torch.utils.data import Dataset, Subset
+
+
+def get_targets(dataset: Dataset) -> Optional[np.ndarray]:
+    """Returns the class index of each sample of a dataset without loading any sample.
+    Supports the torchvision datasets (targets or labels) and all the datasets of solo.
+
+    Args:
+        dataset (Dataset): the dataset.
+
+    Returns:
+        Optional[np.ndarray]: the class index of each sample or None if they are not known.
+    """
+
+    for attr in ["targets", "labels"]:
+        targets = getattr(dataset, attr, None)
+        if targets is not None:
+            return np.asarray(targets)
+    return None
+
+
+def stratified_subset_indices(
+    targets: Optional[np.ndarray],
+    fraction: float,
+    seed: int = 42,
+    num_samples: Optional[int] = None,
+) -> np.ndarray:
+    """Samples a fraction of the samples of each class, in a vectorized way. The number of
+    samples of each class is rounded down and the remaining samples are given to the classes
+    with the largest remainders, so that exactly int(fraction * n) samples are selected, as
+    expected by compute_dataset_size.
+
+    Args:
+        targets (Optional[np.ndarray]): class index of each sample. If None, the samples are
+            selected uniformly at random.
+        fraction (float): fraction of samples to keep.
+        seed (int): random seed. Defaults to 42.
+        num_samples (Optional[int]): number of samples, only needed when targets is None.
+
+    Returns:
+        np.ndarray: sorted indices of the selected samples.
+    """
+
+    assert 0 < fraction < 1, "Only use data_fraction for values between 0 and 1."
+
+    rng = np.random.default_rng(seed)
+    if targets is None:
+        n_keep = int(num_samples * fraction)
+        return np.sort(rng.permutation(num_samples)[:n_keep])
+
+    targets = np.asarray(targets)
+    n = len(targets)
+
+    classes, inverse, counts = np.unique(targets, return_inverse=True, return_counts=True)
+    exact = counts * fraction
+    n_per_class = np.floor(exact).astype(np.int64)
+    remaining = int(n * fraction) - n_per_class.sum()
+    if remaining > 0:
+        n_per_class[np.argsort(n_per_class - exact, kind="stable")[:remaining]] += 1
+
+    # random order within each class, then keep the first samples of each class
+    perm = rng.permutation(n)
+    order = perm[np.argsort(inverse[perm], kind="stable")]
+    starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+    group = inverse[order]
+    rank = np.arange(n) - starts[group]
+    return np.sort(order[rank < n_per_class[group]])
+
+
+class IndexedSubset(Subset):
+    """Subset of a dataset that returns the index of each sample as its first element, e.g.
+    wrapped with dataset_with_index. The index is replaced by the index in the subset, so
+    that methods with per sample memories can keep using the size of the dataset."""
+
+    def __getitem__(self, index: int):
+        _, *data = self.dataset[self.indices[index]]
+        return (index, *data)
+
+    def __getitems__(self, indices: List[int]):
+        rows = [self.indices[index] for index in indices]
+        if hasattr(self.dataset, "__getitems__"):
+            data = self.dataset.__getitems__(rows)
+        else:
+            data = [self.dataset[row] for row in rows]
+        return [(index, *d[1:]) for index, d in zip(indices, data)]
+
+
+def stratified_subset(
+    dataset: Dataset, fraction: float, seed: int = 42, subset_class: Type[Subset] = Subset
+) -> Subset:
+    """Keeps a stratified fraction of a dataset, as an index Subset of it.
+
+    Args:
+        dataset (Dataset): the dataset.
+        fraction (float): fraction of samples to keep.
+        seed (int): random seed. Defaults to 42.
+        subset_class (Type[Subset]): Subset class, IndexedSubset for datasets that return their
+            indexes. Defaults to Subset.
+
+    Returns:
+        Subset: the subset.
+    """
+
+    indices = stratified_subset_indices(
+        get_targets(dataset), fraction, seed=seed, num_samples=len(dataset)
+    )
+    return subset_class(dataset, indices.tolist())
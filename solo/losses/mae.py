@@ -41,36 +41,69 @@ def patchify(imgs: torch.Tensor, patch_size: int) -> torch.Tensor:
     return x
 
 
+def normalize_patches(patches: torch.Tensor) -> torch.Tensor:
+    """Normalizes the pixels of each patch with their respective mean and std.
+
+    Args:
+        patches (torch.Tensor): [..., pixels * pixels * 3] Tensor containing patchified images.
+
+    Returns:
+        torch.Tensor: Tensor of the same shape with the normalized patches.
+    """
+
+    var, mean = torch.var_mean(patches, dim=-1, keepdim=True)
+    return (patches - mean) * torch.rsqrt(var + 1.0e-6)
+
+
 def mae_loss_func(
     imgs: torch.Tensor,
     pred: torch.Tensor,
     mask: torch.Tensor,
     patch_size: int,
     norm_pix_loss: bool = True,
+    ids_masked: torch.Tensor = None,
+    target: torch.Tensor = None,
 ) -> torch.Tensor:
     """Computes MAE's loss given batch of images, the decoder predictions, the input mask and respective patch size.
     Adapted from https://github.com/facebookresearch/mae.
 
+    If ids_masked is given, pred only contains the predictions of the masked patches, so only
+    their targets are gathered (and normalized) and the loss is averaged over them directly.
+    The targets can also be precomputed (e.g. by the data loading workers, see
+    MAETargetPipeline), in which case imgs is not used.
+
     Args:
         imgs (torch.Tensor): [N, 3, H, W] Tensor containing the original images.
-        pred (torch.Tensor): [N, Tokens, pixels * pixels * 3] Tensor containing the predicted patches.
+        pred (torch.Tensor): [N, Tokens, pixels * pixels * 3] Tensor containing the predicted patches
+            or [N, Masked, pixels * pixels * 3] if ids_masked is given.
         mask (torch.Tensor): [N, Tokens] Tensor representing a binary mask, where value 1 means masked.
         patch_size (int): size of each patch.
         norm_pix_loss (bool): whether to normalize the pixels of each patch with their respective mean and std.
+        ids_masked (torch.Tensor, optional): [N, Masked] Tensor with the indexes of the masked
+            patches predicted in pred. Defaults to None.
+        target (torch.Tensor, optional): [N, Tokens, pixels * pixels * 3] Tensor containing the
+            precomputed patchified targets, already normalized if norm_pix_loss. Defaults to None.
 
     Returns:
         torch.Tensor: MAE's loss.
     """
 
-    target = patchify(imgs, patch_size)
+    precomputed = target is not None
+    if not precomputed:
+        target = patchify(imgs, patch_size)
+    if ids_masked is not None:
+        target = torch.gather(
+            target, dim=1, index=ids_masked.unsqueeze(-1).expand(-1, -1, target.size(-1))
+        )
 
-    if norm_pix_loss:
-        mean = target.mean(dim=-1, keepdim=True)
-        var = target.var(dim=-1, keepdim=True)
-        target = (target - mean) / (var + 1.0e-6) ** 0.5
+    if norm_pix_loss and not precomputed:
+        target = normalize_patches(target)
 
     loss = (pred - target) ** 2
     loss = loss.mean(dim=-1)  # [N, L], mean loss per patch
 
+    if ids_masked is not None:
+        return loss.mean()  # only masked patches were predicted
+
     loss = (loss * mask).sum() / mask.sum()  # mean loss on removed patches
     return loss
@@ -1,50 +1,468 @@
+from typing import Dict
+
 import numpy as np
 import torch
-from solo.utils.embedding_propagation import get_similarity_matrix, get_laplacian, get_distance_matrix, get_disparity_matrix
+import torch.distributed as dist
+from torch.utils.checkpoint import checkpoint
+from solo.utils.embedding_propagation import (
+    estimate_laplacian_energy,
+    get_distance_matrix,
+    get_laplacian,
+    get_similarity_matrix,
+    get_smallest_eigenvalues,
+)
+from solo.utils.misc import concat_all_gather_no_grad, gather, get_rank
 
 class ManifoldRegularizer():
-    def __init__(self, scale_euclidean_distance: bool = False, return_metrics: bool = False):
+    def __init__(
+        self,
+        scale_euclidean_distance: bool = False,
+        return_metrics: bool = False,
+        distributed: bool = False,
+        knn: int = 0,
+        metrics_frequency: int = 1,
+        spectral_solver: str = "lanczos",
+        num_eigenvalues: int = 2,
+        num_probes: int = 8,
+        lanczos_steps: int = 20,
+        chunk_size: int = 0,
+    ):
+        """Computes the MAGMA manifold regularization term between two layer representations.
+
+        Args:
+            scale_euclidean_distance (bool): whether to scale the squared distances by sqrt(c).
+                Defaults to False.
+            return_metrics (bool): whether to compute spectral metrics of the laplacian.
+                Defaults to False.
+            distributed (bool): whether to build the graph over the global batch gathered from
+                all processes. Each process only computes the row-block of the laplacian
+                quadratic form that corresponds to its local samples, so the full N x N
+                matrix is never materialized (see batched_manifold_regularizer_loss).
+                Spectral metrics are not computed in this mode.
+                Defaults to False.
+            knn (int): if positive, builds a sparse graph that only keeps the knn nearest
+                neighbours of each sample (symmetrized as (W + W.T) / 2) instead of the dense
+                graph, so that the differentiable part of the loss costs O(b * knn * c).
+                Spectral metrics are not computed in this mode. Defaults to 0.
+            metrics_frequency (int): spectral metrics are only computed once every
+                metrics_frequency calls. Defaults to 1.
+            spectral_solver (str): "lanczos" computes the smallest eigenvalues with LOBPCG and
+                estimates the laplacian energy with stochastic Lanczos quadrature, "eigvalsh"
+                computes the full spectrum exactly. Defaults to "lanczos".
+            num_eigenvalues (int): number of smallest eigenvalues to compute. Defaults to 2.
+            num_probes (int): number of Hutchinson probes for the energy estimate. Defaults to 8.
+            lanczos_steps (int): number of Lanczos steps for the energy estimate. Defaults to 20.
+            chunk_size (int): if positive, the dense loss is computed over row blocks of
+                chunk_size samples with activation checkpointing, so that neither the forward
+                nor the backward keep more than a (chunk_size, b) block of the graph alive.
+                The calls that compute spectral metrics still build the full laplacian.
+                Defaults to 0.
+        """
+        assert spectral_solver in ["eigvalsh", "lanczos"]
+        assert num_eigenvalues >= 2
+
         self.scale_euclidean_distance = scale_euclidean_distance
         self.return_metrics = return_metrics
+        self.distributed = distributed
+        self.knn = knn
+        self.metrics_frequency = max(1, metrics_frequency)
+        self.spectral_solver = spectral_solver
+        self.num_eigenvalues = num_eigenvalues
+        self.num_probes = num_probes
+        self.lanczos_steps = lanczos_steps
+        self.chunk_size = chunk_size
+        self.num_calls = 0
         self.last_laplacian_matrix = None
         self.last_similarity_matrix = None
 
+    def _should_compute_metrics(self) -> bool:
+        """Checks if the spectral metrics are due for the current call and advances the counter."""
+
+        compute = self.return_metrics and self.num_calls % self.metrics_frequency == 0
+        self.num_calls += 1
+        return compute
+
+    @torch.no_grad()
+    def spectral_metrics(self, laplacian: torch.Tensor, weights_matrix: torch.Tensor) -> Dict[str, torch.Tensor]:
+        """Computes spectral metrics of a laplacian (n, n) or of a stack of laplacians (l, n, n).
+        All values are kept on the device of the laplacian. The matrices are kept (detached) to
+        compute their difference to the ones of the next call to this method.
+
+        Args:
+            laplacian (torch.Tensor): symmetric normalized laplacian(s).
+            weights_matrix (torch.Tensor): similarity matrix (matrices) of the graph.
+
+        Returns:
+            Dict[str, torch.Tensor]: dict with the metrics.
+        """
+
+        eigvals = get_smallest_eigenvalues(laplacian, k=self.num_eigenvalues, solver=self.spectral_solver)
+        if self.spectral_solver == "eigvalsh":
+            laplacian_energy = (torch.linalg.eigvalsh(laplacian.float()) - 1).abs().sum(dim=-1)
+        else:
+            laplacian_energy = estimate_laplacian_energy(
+                laplacian, num_probes=self.num_probes, lanczos_steps=self.lanczos_steps
+            )
+
+        metrics = {
+            "Second smallest eigenvalue": eigvals[..., 1],
+            "Spectral gap": eigvals[..., 1] - eigvals[..., 0],
+            "Laplacian energy": laplacian_energy,
+        }
+
+        if self.last_laplacian_matrix is not None and self.last_laplacian_matrix.shape == laplacian.shape:
+            metrics["Laplacian difference"] = torch.linalg.norm(
+                laplacian - self.last_laplacian_matrix, dim=(-2, -1)
+            )
+        if self.last_similarity_matrix is not None and self.last_similarity_matrix.shape == weights_matrix.shape:
+            metrics["Similarity difference"] = torch.linalg.norm(
+                weights_matrix - self.last_similarity_matrix, dim=(-2, -1)
+            )
+
+        self.last_laplacian_matrix = laplacian.detach()
+        self.last_similarity_matrix = weights_matrix.detach()
+        return metrics
+
     def manifold_regularizer_loss(self, x: torch.Tensor, y: torch.Tensor, rbf_scale=1.0, fixed_gamma=None):
+        if self.distributed or self.knn > 0:
+            regularizer_loss_terms, metrics = self.batched_manifold_regularizer_loss(
+                x.unsqueeze(0), y, rbf_scale=rbf_scale, fixed_gamma=fixed_gamma
+            )
+            return regularizer_loss_terms[0], {"gamma": metrics["gamma"][0]}
+
+        compute_metrics = self._should_compute_metrics()
+        if self.chunk_size > 0 and not compute_metrics:
+            return self._chunked_manifold_regularizer_loss(x, y, rbf_scale=rbf_scale, fixed_gamma=fixed_gamma)
+
         weights_matrix, gamma = get_similarity_matrix(x, rbf_scale=rbf_scale, scaling_factor=self.scale_euclidean_distance, fixed_gamma=fixed_gamma)
         laplacian = get_laplacian(weights_matrix, normalized=True)
         metrics = {}
         metrics['gamma'] = gamma
-        if self.return_metrics:
-            with torch.no_grad():
-                sorted_eigvals = torch.linalg.eigvals(laplacian).real.cpu().numpy()
-                sorted_eigvals.sort()
-                second_smallest_eigenvalue = sorted_eigvals[1]
-                spectral_gap = sorted_eigvals[1] - sorted_eigvals[0]
-                laplacian_energy = sum(abs(x - 1) for x in sorted_eigvals)
-
-                metrics = {
-                    "Second smallest eigenvalue": second_smallest_eigenvalue,
-                    "Spectral gap": spectral_gap,
-                    "Laplacian energy": laplacian_energy,
-                }
-
-                if self.last_laplacian_matrix is not None:
-                    laplacian_diff = torch.linalg.norm(
-                        laplacian - self.last_laplacian_matrix
-                    )
-                    metrics["Laplacian difference"] = laplacian_diff
-
-                if self.last_similarity_matrix is not None:
-                    similarity_diff = torch.linalg.norm(
-                        weights_matrix - self.last_similarity_matrix
-                    )
-                    metrics["Similarity difference"] = similarity_diff
-
-
-        regularizer_loss_term = torch.trace(y.T @ laplacian @ y) / (x.shape[0] ** 2)
-
-        self.last_laplacian_matrix = laplacian
-        self.last_similarity_matrix = weights_matrix
+        if compute_metrics:
+            metrics.update(self.spectral_metrics(laplacian, weights_matrix))
+
+        # trace(y.T @ L @ y) without building the (d, d) product just to read its diagonal
+        regularizer_loss_term = ((laplacian @ y) * y).sum() / (x.shape[0] ** 2)
 
         return regularizer_loss_term, metrics
-    
\ No newline at end of file
+
+    def _block_distances(self, x_block: torch.Tensor, x: torch.Tensor, start: int) -> torch.Tensor:
+        """Squared distances between a row block of x starting at start and all rows of x, with
+        the entries of the global diagonal zeroed as in get_similarity_matrix."""
+
+        sq_dist = get_distance_matrix(x_block, x)
+        if self.scale_euclidean_distance:
+            sq_dist = sq_dist / np.sqrt(x.size(1))
+        rows = torch.arange(x_block.size(0), device=x.device)
+        diagonal = torch.zeros_like(sq_dist, dtype=torch.bool)
+        diagonal[rows, rows + start] = True
+        return sq_dist.masked_fill(diagonal, 0), diagonal
+
+    def _block_distance_stats(self, x_block: torch.Tensor, x: torch.Tensor, start: int) -> torch.Tensor:
+        sq_dist, _ = self._block_distances(x_block, x, start)
+        sq_dist = sq_dist.double()
+        return torch.stack([(sq_dist != 0).sum().double(), sq_dist.sum(), sq_dist.pow(2).sum()])
+
+    def _block_weights(
+        self, x_block: torch.Tensor, x: torch.Tensor, start: int, gamma: torch.Tensor, rbf_scale: float
+    ) -> torch.Tensor:
+        sq_dist, diagonal = self._block_distances(x_block, x, start)
+        weights = torch.exp(-sq_dist / gamma * rbf_scale)
+        return weights.masked_fill(diagonal, 0)
+
+    def _block_quadratic_form(
+        self,
+        x_block: torch.Tensor,
+        x: torch.Tensor,
+        start: int,
+        gamma: torch.Tensor,
+        rbf_scale: float,
+        y_block: torch.Tensor,
+        y: torch.Tensor,
+        isqrt_block: torch.Tensor,
+        isqrt: torch.Tensor,
+    ) -> torch.Tensor:
+        weights = self._block_weights(x_block, x, start, gamma, rbf_scale)
+        normalized = weights * isqrt_block[:, None] * isqrt[None, :]
+        # rows of trace(y.T @ (I - S) @ y) that belong to the block
+        return (y_block * y_block).sum() - ((normalized @ y) * y_block).sum()
+
+    def _chunked_manifold_regularizer_loss(self, x: torch.Tensor, y: torch.Tensor, rbf_scale=1.0, fixed_gamma=None):
+        """Computes the same loss as the dense path over row blocks of chunk_size samples. The
+        bandwidth, the degrees and the quadratic form each take a pass over the blocks, and every
+        block is checkpointed, so its (chunk_size, b) slice of the graph is recomputed in the
+        backward instead of being stored. The gradient flows through the bandwidth and the
+        degrees exactly as in the dense path.
+
+        Args:
+            x (torch.Tensor): representations used to build the graph (b, c).
+            y (torch.Tensor): representations that are regularized (b, d).
+            rbf_scale (float): scale of the rbf kernel. Defaults to 1.0.
+            fixed_gamma (float): fixed bandwidth of the rbf kernel. Defaults to None.
+
+        Returns:
+            Tuple[torch.Tensor, Dict[str, torch.Tensor]]: the loss and the bandwidth.
+        """
+
+        b = x.size(0)
+        starts = range(0, b, self.chunk_size)
+        blocks = [slice(start, start + self.chunk_size) for start in starts]
+
+        # std of the nonzero distances from their count, sum and sum of squares
+        count, total, total_sq = sum(
+            checkpoint(self._block_distance_stats, x[block], x, start, use_reentrant=False)
+            for start, block in zip(starts, blocks)
+        )
+        gamma = ((total_sq - total**2 / count) / (count - 1)).sqrt().float()
+        bandwidth = fixed_gamma if fixed_gamma else gamma
+
+        degrees = torch.cat(
+            [
+                checkpoint(
+                    lambda x_block, x, start, bandwidth: self._block_weights(
+                        x_block, x, start, bandwidth, rbf_scale
+                    ).sum(dim=-1),
+                    x[block],
+                    x,
+                    start,
+                    bandwidth,
+                    use_reentrant=False,
+                )
+                for start, block in zip(starts, blocks)
+            ]
+        )
+        isqrt = 1.0 / torch.sqrt(1e-4 + degrees)
+
+        regularizer_loss_term = sum(
+            checkpoint(
+                self._block_quadratic_form,
+                x[block],
+                x,
+                start,
+                bandwidth,
+                rbf_scale,
+                y[block],
+                y,
+                isqrt[block],
+                isqrt,
+                use_reentrant=False,
+            )
+            for start, block in zip(starts, blocks)
+        ) / (b**2)
+
+        return regularizer_loss_term, {"gamma": gamma}
+
+    def batched_manifold_regularizer_loss(
+        self,
+        xs: torch.Tensor,
+        y: torch.Tensor,
+        rbf_scale=1.0,
+        fixed_gamma=None,
+        xs_queue: torch.Tensor = None,
+        y_queue: torch.Tensor = None,
+    ):
+        """Computes the regularizer of several layers w.r.t. the same target representation in a
+        single vectorized pass, building all similarity matrices and laplacians with batched
+        matrix multiplications instead of one set of kernels per layer.
+
+        In distributed mode, the graph is built over the batch gathered from all processes.
+        Each process only computes the b x N row-block of the laplacian quadratic form that
+        corresponds to its local samples and the bandwidth (gamma) and node degrees are shared
+        across processes, so the result matches the single process loss on the whole batch.
+        The returned values are rescaled such that averaging them across processes (which DDP
+        implicitly does for the gradients) yields trace(y.T @ L @ y) / N^2.
+
+        Representations of previous batches (e.g. from a memory bank) can be added to the graph
+        as extra nodes through xs_queue and y_queue. They are treated as constants: only the
+        rows of the current batch are computed, the degrees of the queued nodes only account for
+        their edges to the current batch and the edges between queued nodes, which carry no
+        gradient, are left out of the graph. The loss is still normalized by the total number of
+        nodes, N = n + q.
+
+        Spectral metrics (see spectral_metrics) are computed for all layers at once when due,
+        except in distributed mode or when a queue is used.
+
+        Args:
+            xs (torch.Tensor): [l, b, c] stack of the representations of each layer.
+            y (torch.Tensor): [b, d] target representations that are regularized.
+            rbf_scale (float): scale of the rbf kernel. Defaults to 1.0.
+            fixed_gamma (float): optional fixed bandwidth. Defaults to None.
+            xs_queue (torch.Tensor): optional [l, q, c] queued representations of each layer,
+                shared by all processes. Defaults to None.
+            y_queue (torch.Tensor): optional [q, d] queued target representations.
+                Defaults to None.
+
+        Returns:
+            Tuple[torch.Tensor, Dict]: [l] tensor with the loss of each layer and a dict
+                with [l] tensors of gammas and, when computed, of the spectral metrics.
+        """
+
+        _, b, c = xs.size()
+        if self.distributed:
+            xs_all = gather(xs, dim=1)
+            y_all = gather(y)
+            offset = get_rank() * b if dist.is_available() and dist.is_initialized() else 0
+        else:
+            xs_all, y_all, offset = xs, y, 0
+        n = xs_all.size(1)
+
+        # queued nodes are appended after the nodes of the (global) batch
+        if xs_queue is not None:
+            xs_all = torch.cat([xs_all, xs_queue.detach().to(xs_all.dtype)], dim=1)
+            y_all = torch.cat([y_all, y_queue.detach().to(y_all.dtype)])
+        num_nodes = xs_all.size(1)
+
+        if self.knn > 0:
+            return self._knn_manifold_regularizer_loss(
+                xs, y, xs_all, y_all, offset, n, rbf_scale=rbf_scale, fixed_gamma=fixed_gamma
+            )
+
+        self_mask = torch.zeros(b, num_nodes, dtype=torch.bool, device=xs.device)
+        self_mask[torch.arange(b, device=xs.device), torch.arange(offset, offset + b, device=xs.device)] = True
+        sq_dist = get_distance_matrix(xs, xs_all).masked_fill(self_mask, 0)
+        if self.scale_euclidean_distance:
+            sq_dist = sq_dist / np.sqrt(c)
+
+        # per layer std of the non-zero distances, reduced over all processes if distributed
+        mask = (sq_dist != 0).to(sq_dist.dtype)
+        count = self._reduce(mask.sum(dim=(1, 2)))
+        mean = self._reduce((sq_dist * mask).sum(dim=(1, 2))) / count
+        sq_dev = self._reduce((((sq_dist - mean[:, None, None]) * mask) ** 2).sum(dim=(1, 2)))
+        gamma = (sq_dev / (count - 1)).sqrt()
+        if fixed_gamma:
+            sq_dist = sq_dist / fixed_gamma
+        else:
+            sq_dist = sq_dist / gamma[:, None, None]
+
+        weights = torch.exp(-sq_dist * rbf_scale)
+        weights = weights * (~self_mask).float()
+
+        # symmetric normalization with the degrees of all nodes in the graph
+        isqrt_diag = 1.0 / torch.sqrt(1e-4 + weights.sum(dim=-1))
+        isqrt_diag_all = gather(isqrt_diag, dim=1) if self.distributed else isqrt_diag
+        if num_nodes > n:
+            isqrt_diag_queue = 1.0 / torch.sqrt(1e-4 + self._reduce(weights[:, :, n:].sum(dim=1)))
+            isqrt_diag_all = torch.cat([isqrt_diag_all, isqrt_diag_queue], dim=1)
+        normalized_weights = weights * isqrt_diag[:, :, None] * isqrt_diag_all[:, None, :]
+
+        # (local row-block of) trace(y.T @ (I - S) @ y) for every layer
+        quadratic_form = (y * y).sum() - (y * (normalized_weights @ y_all)).sum(dim=(1, 2))
+        if num_nodes > n:
+            # the edges to the queue are only computed from the batch side, so they are counted
+            # twice, and the squared norms of the queued nodes are shared among the processes
+            queue_edges = (y * (normalized_weights[:, :, n:] @ y_all[n:])).sum(dim=(1, 2))
+            quadratic_form = quadratic_form - queue_edges + (y_all[n:] ** 2).sum() * b / n
+        regularizer_loss_terms = quadratic_form * n / (b * num_nodes**2)
+
+        metrics = {"gamma": gamma}
+        if self._should_compute_metrics() and not self.distributed and num_nodes == n:
+            laplacian = torch.eye(b, device=xs.device) - normalized_weights
+            metrics.update(self.spectral_metrics(laplacian, weights))
+
+        return regularizer_loss_terms, metrics
+
+    def _knn_manifold_regularizer_loss(
+        self,
+        xs: torch.Tensor,
+        y: torch.Tensor,
+        xs_all: torch.Tensor,
+        y_all: torch.Tensor,
+        offset: int,
+        num_batch_nodes: int,
+        rbf_scale=1.0,
+        fixed_gamma=None,
+        max_distance_matrix_size: int = int(2**24),
+    ):
+        """Computes the regularizer over a sparse k-nearest-neighbour graph. The neighbours and
+        the bandwidth (from all pairwise distances, as in the dense graph) are found without
+        gradients, in chunks of rows so that at most max_distance_matrix_size distances are
+        materialized at once. Only the b x k selected edges are then recomputed with gradients
+        and the normalized laplacian is applied as a sparse operator through gathers and
+        scatters. Since (W + W.T) / 2 is symmetric, the quadratic form only needs the directed
+        edges, while the degrees account for the edges pointing to each node.
+
+        Args:
+            xs (torch.Tensor): [l, b, c] stack of the (local) representations of each layer.
+            y (torch.Tensor): [b, d] (local) target representations.
+            xs_all (torch.Tensor): [l, n, c] representations of all the nodes of the graph.
+            y_all (torch.Tensor): [n, d] target representations of all the nodes of the graph.
+            offset (int): index of the first local sample among all the nodes.
+            num_batch_nodes (int): number of nodes that belong to the (global) batch, the
+                remaining ones are queued nodes without outgoing edges.
+            rbf_scale (float): scale of the rbf kernel. Defaults to 1.0.
+            fixed_gamma (float): optional fixed bandwidth. Defaults to None.
+            max_distance_matrix_size (int): maximum number of distances computed at once
+                during the neighbour search. Defaults to 2**24.
+
+        Returns:
+            Tuple[torch.Tensor, Dict]: [l] tensor with the loss of each layer and a dict
+                with the [l] tensor of gammas.
+        """
+
+        l, b, c = xs.size()
+        n = num_batch_nodes
+        num_nodes = xs_all.size(1)
+        k = min(self.knn, num_nodes - 1)
+        chunk_size = max(1, max_distance_matrix_size // (l * num_nodes))
+        scale = np.sqrt(c) if self.scale_euclidean_distance else 1.0
+
+        with torch.no_grad():
+            indices = []
+            stats = torch.zeros(3, l, dtype=torch.float64, device=xs.device)
+            for start in range(0, b, chunk_size):
+                end = min(start + chunk_size, b)
+                sq_dist = get_distance_matrix(xs[:, start:end], xs_all) / scale
+                rows = torch.arange(end - start, device=xs.device)
+                sq_dist[:, rows, rows + offset + start] = 0
+
+                mask = sq_dist != 0
+                nonzero = sq_dist.double() * mask
+                stats += torch.stack([mask.sum(dim=(1, 2)), nonzero.sum(dim=(1, 2)), (nonzero**2).sum(dim=(1, 2))])
+
+                sq_dist[:, rows, rows + offset + start] = float("inf")
+                indices.append(sq_dist.topk(k, dim=-1, largest=False).indices)
+            indices = torch.cat(indices, dim=1)
+
+            if self.distributed:
+                stats = concat_all_gather_no_grad(stats.unsqueeze(0)).sum(dim=0)
+            count, total, total_sq = stats
+            gamma = ((total_sq - total**2 / count) / (count - 1)).sqrt().float()
+
+        # differentiable weights of the selected edges
+        flat_indices = indices.reshape(l, b * k)
+        neighbours = torch.gather(xs_all, 1, flat_indices.unsqueeze(-1).expand(-1, -1, c)).view(l, b, k, c)
+        sq_dist = ((xs.unsqueeze(2).float() - neighbours.float()) ** 2).sum(dim=-1) / scale
+        if fixed_gamma:
+            sq_dist = sq_dist / fixed_gamma
+        else:
+            sq_dist = sq_dist / gamma[:, None, None]
+        weights = torch.exp(-sq_dist * rbf_scale)
+
+        # degrees of the symmetrized graph: outgoing plus incoming edges (from all processes)
+        incoming = torch.zeros(l, num_nodes, dtype=weights.dtype, device=xs.device)
+        incoming = self._reduce(incoming.scatter_add(1, flat_indices, weights.view(l, b * k)))
+        degrees = 0.5 * (weights.sum(dim=-1) + incoming[:, offset : offset + b])
+        isqrt_diag = 1.0 / torch.sqrt(1e-4 + degrees)
+        isqrt_diag_all = gather(isqrt_diag, dim=1) if self.distributed else isqrt_diag
+        if num_nodes > n:
+            isqrt_diag_queue = 1.0 / torch.sqrt(1e-4 + 0.5 * incoming[:, n:])
+            isqrt_diag_all = torch.cat([isqrt_diag_all, isqrt_diag_queue], dim=1)
+        isqrt_diag_neighbours = torch.gather(isqrt_diag_all, 1, flat_indices).view(l, b, k)
+
+        # (local share of) trace(y.T @ (I - S) @ y) for every layer
+        y_neighbours = y_all[flat_indices].view(l, b, k, -1)
+        similarities = (y.unsqueeze(1) * y_neighbours).sum(dim=-1)
+        normalized_weights = weights * isqrt_diag[:, :, None] * isqrt_diag_neighbours
+        quadratic_form = (y * y).sum() - (normalized_weights * similarities).sum(dim=(1, 2))
+        if num_nodes > n:
+            quadratic_form = quadratic_form + (y_all[n:] ** 2).sum() * b / n
+        regularizer_loss_terms = quadratic_form * n / (b * num_nodes**2)
+
+        return regularizer_loss_terms, {"gamma": gamma}
+
+    def _reduce(self, tensor: torch.Tensor) -> torch.Tensor:
+        """Sums a tensor over all processes (with gradients) when in distributed mode."""
+
+        if self.distributed:
+            return gather(tensor.unsqueeze(0)).sum(dim=0)
+        return tensor
@@ -149,10 +149,20 @@ class BaseMethod(pl.LightningModule):
             knn_eval:
                 enabled (bool): enables online knn evaluation while training.
                 k (int): the number of neighbors to use for knn.
+                streaming (bool): streams the train features with a running top-k instead of
+                    computing the full distance matrix. Defaults to False.
+                offload_train_features (bool): stores the train features in float16 on the
+                    cpu. Requires sharded when distributed. Defaults to False.
+                sharded (bool): keeps the train features on the process that saw them and
+                    only merges the top-k candidates across processes. Defaults to False.
             performance:
                 disable_channel_last (bool). Disables channel last conversion operation which
                 speeds up training considerably. Defaults to False.
                 https://pytorch.org/tutorials/intermediate/memory_format_tutorial.html#converting-existing-models
+                fuse_large_crops (bool): forwards all large crops in a single pass by
+                    concatenating them along the batch dimension. Only meant for methods whose
+                    backbone does not mix samples (e.g. ViTs in MAE), as batch statistics would
+                    be computed over all crops at once. Defaults to False.
             accumulate_grad_batches (Union[int, None]): number of batches for gradient accumulation.
             num_large_crops (int): number of big crops.
             num_small_crops (int): number of small crops .
@@ -254,10 +264,20 @@ class BaseMethod(pl.LightningModule):
         self.knn_eval: bool = cfg.knn_eval.enabled
         self.knn_k: int = cfg.knn_eval.k
         if self.knn_eval:
-            self.knn = WeightedKNNClassifier(k=self.knn_k, distance_fx=cfg.knn_eval.distance_func)
+            self.knn = WeightedKNNClassifier(
+                k=self.knn_k,
+                distance_fx=cfg.knn_eval.distance_func,
+                streaming=cfg.knn_eval.streaming,
+                offload_train_features=cfg.knn_eval.offload_train_features,
+                sharded=cfg.knn_eval.sharded,
+            )
 
         # for performance
         self.no_channel_last = cfg.performance.disable_channel_last
+        self.fuse_large_crops = cfg.performance.fuse_large_crops
+
+        # batched augmentations of the crops applied on the training device, if any
+        self.batched_augmentation = None
 
         # keep track of validation metrics
         self.validation_step_outputs = []
@@ -298,12 +318,20 @@ class BaseMethod(pl.LightningModule):
         cfg.knn_eval.enabled = omegaconf_select(cfg, "knn_eval.enabled", False)
         cfg.knn_eval.k = omegaconf_select(cfg, "knn_eval.k", 20)
         cfg.knn_eval.distance_func = omegaconf_select(cfg, "knn_eval.distance_func", "euclidean")
+        cfg.knn_eval.streaming = omegaconf_select(cfg, "knn_eval.streaming", False)
+        cfg.knn_eval.offload_train_features = omegaconf_select(
+            cfg, "knn_eval.offload_train_features", False
+        )
+        cfg.knn_eval.sharded = omegaconf_select(cfg, "knn_eval.sharded", False)
 
         # default parameters for performance optimization
         cfg.performance = omegaconf_select(cfg, "performance", {})
         cfg.performance.disable_channel_last = omegaconf_select(
             cfg, "performance.disable_channel_last", False
         )
+        cfg.performance.fuse_large_crops = omegaconf_select(
+            cfg, "performance.fuse_large_crops", False
+        )
 
         # default empty parameters for method-specific kwargs
         cfg.method_kwargs = omegaconf_select(cfg, "method_kwargs", {})
@@ -416,6 +444,22 @@ class BaseMethod(pl.LightningModule):
         except:
             optimizer.zero_grad()
 
+    def on_after_batch_transfer(self, batch: Any, dataloader_idx: int) -> Any:
+        """Applies the batched augmentations, if any, to the crops of the training batches once
+        they are on the training device.
+
+        Args:
+            batch (Any): the transferred batch.
+            dataloader_idx (int): index of the dataloader.
+
+        Returns:
+            Any: the (augmented) batch.
+        """
+
+        if self.batched_augmentation is not None and self.trainer.training:
+            batch[1] = self.batched_augmentation(batch[1])
+        return batch
+
     def forward(self, X) -> Dict:
         """Basic forward method. Children methods should call this function,
         modify the ouputs (without deleting anything) and return it.
@@ -509,8 +553,20 @@ class BaseMethod(pl.LightningModule):
         # check that we received the desired number of crops
         assert len(X) == self.num_crops
 
-        outs = [self.base_training_step(x, targets) for x in X[: self.num_large_crops]]
-        outs = {k: [out[k] for out in outs] for k in outs[0].keys()}
+        if self.fuse_large_crops and self.num_large_crops > 1:
+            # single pass over all large crops, whose outputs are then split per crop
+            fused_outs = self.base_training_step(
+                torch.cat(X[: self.num_large_crops]), targets.repeat(self.num_large_crops)
+            )
+            outs = {
+                k: list(v.chunk(self.num_large_crops))
+                if isinstance(v, torch.Tensor) and v.dim() > 0
+                else [v] * self.num_large_crops
+                for k, v in fused_outs.items()
+            }
+        else:
+            outs = [self.base_training_step(x, targets) for x in X[: self.num_large_crops]]
+            outs = {k: [out[k] for out in outs] for k in outs[0].keys()}
 
         if self.multicrop:
             multicrop_outs = [self.multicrop_forward(x) for x in X[self.num_large_crops :]]
@@ -533,7 +589,7 @@ class BaseMethod(pl.LightningModule):
         if self.knn_eval:
             targets = targets.repeat(self.num_large_crops)
             mask = targets != -1
-            self.knn(
+            self.knn.update(
                 train_features=torch.cat(outs["feats"][: self.num_large_crops])[mask].detach(),
                 train_targets=targets[mask],
             )
@@ -582,7 +638,7 @@ class BaseMethod(pl.LightningModule):
         out = self.base_validation_step(X, targets)
 
         if self.knn_eval and not self.trainer.sanity_checking:
-            self.knn(test_features=out.pop("feats").detach(), test_targets=targets.detach())
+            self.knn.update(test_features=out.pop("feats").detach(), test_targets=targets.detach())
 
         metrics = {
             "batch_size": batch_size,
@@ -87,6 +87,11 @@ class LinearModel(pl.LightningModule):
 
             finetune (bool): whether or not to finetune the backbone. Defaults to False.
 
+            cached_features:
+                enabled (bool): whether the batches contain features extracted beforehand by
+                    the frozen backbone instead of images, so that the backbone is not run
+                    again at every epoch. Defaults to False.
+
             performance:
                 disable_channel_last (bool). Disables channel last conversion operation which
                 speeds up training considerably. Defaults to False.
@@ -156,6 +161,12 @@ class LinearModel(pl.LightningModule):
             for param in self.backbone.parameters():
                 param.requires_grad = False
 
+        # if training on features extracted beforehand
+        self.cached_features: bool = cfg.cached_features.enabled
+        if self.cached_features:
+            assert not self.finetune, "Cached features can only be used with a frozen backbone."
+            assert self.mixup_func is None, "Mixup/cutmix can not be applied to cached features."
+
         # keep track of validation metrics
         self.validation_step_outputs = []
 
@@ -181,6 +192,10 @@ class LinearModel(pl.LightningModule):
         # whether or not to finetune the backbone
         cfg.finetune = omegaconf_select(cfg, "finetune", False)
 
+        # whether or not to train on cached features
+        cfg.cached_features = omegaconf_select(cfg, "cached_features", {})
+        cfg.cached_features.enabled = omegaconf_select(cfg, "cached_features.enabled", False)
+
         # default for acc grad batches
         cfg.accumulate_grad_batches = omegaconf_select(cfg, "accumulate_grad_batches", 1)
 
@@ -288,12 +303,18 @@ class LinearModel(pl.LightningModule):
         """Performs forward pass of the frozen backbone and the linear layer for evaluation.
 
         Args:
-            X (torch.tensor): a batch of images in the tensor format.
+            X (torch.tensor): a batch of images in the tensor format, or a batch of features
+                if training on cached features.
 
         Returns:
             Dict[str, Any]: a dict containing features and logits.
         """
 
+        if self.cached_features:
+            # features are stored in float16
+            feats = X.float()
+            return {"logits": self.classifier(feats), "feats": feats}
+
         if not self.no_channel_last:
             X = X.to(memory_format=torch.channels_last)
 
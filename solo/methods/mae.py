@@ -91,7 +91,7 @@ class MAEDecoder(nn.Module):
             nn.init.constant_(m.bias, 0)
             nn.init.constant_(m.weight, 1.0)
 
-    def forward(self, x, ids_restore):
+    def forward(self, x, ids_restore, ids_masked=None):
         # embed tokens
         x = self.decoder_embed(x)
 
@@ -109,12 +109,16 @@ class MAEDecoder(nn.Module):
         x = self.decoder_blocks(x)
         x = self.decoder_norm(x)
 
-        # predictor projection
-        x = self.decoder_pred(x)
-
         # remove cls token
         x = x[:, 1:, :]
 
+        # only predict the pixels of the masked patches
+        if ids_masked is not None:
+            x = torch.gather(x, dim=1, index=ids_masked.unsqueeze(-1).expand(-1, -1, x.shape[2]))
+
+        # predictor projection
+        x = self.decoder_pred(x)
+
         return x
 
 
@@ -133,6 +137,12 @@ class MAE(BaseMethod):
                 decoder_num_heads (int) number of heads for the decoder
                 norm_pix_loss (bool): whether to normalize the pixels of each patch with their
                     respective mean and std for the loss. Defaults to False.
+                decoder_masked_only (bool): whether the decoder only predicts (and the loss is
+                    only computed on) the masked patches. Defaults to False.
+            data:
+                precompute_mae_targets (bool): whether the data loading workers append the
+                    patchified (and normalized) reconstruction targets of the large crops after
+                    the crops (see MAETargetPipeline). Defaults to False.
         """
 
         super().__init__(cfg)
@@ -141,6 +151,8 @@ class MAE(BaseMethod):
 
         self.mask_ratio: float = cfg.method_kwargs.mask_ratio
         self.norm_pix_loss: bool = cfg.method_kwargs.norm_pix_loss
+        self.decoder_masked_only: bool = cfg.method_kwargs.decoder_masked_only
+        self.precompute_mae_targets: bool = cfg.data.precompute_mae_targets
 
         # gather backbone info from timm
         self._vit_embed_dim: int = self.backbone.pos_embed.size(-1)
@@ -187,6 +199,12 @@ class MAE(BaseMethod):
             "method_kwargs.norm_pix_loss",
             False,
         )
+        cfg.method_kwargs.decoder_masked_only = omegaconf_select(
+            cfg, "method_kwargs.decoder_masked_only", False
+        )
+        cfg.data.precompute_mae_targets = omegaconf_select(
+            cfg, "data.precompute_mae_targets", False
+        )
 
         return cfg
 
@@ -219,8 +237,14 @@ class MAE(BaseMethod):
 
         out = {}
         if self.training:
-            feats, patch_feats, mask, ids_restore = self.backbone(X, self.mask_ratio)
-            pred = self.decoder(patch_feats, ids_restore)
+            feats, patch_feats, mask, ids_restore, _ = self.backbone(X, self.mask_ratio)
+            if self.decoder_masked_only:
+                # visible patches come first in the shuffled order (after the cls token)
+                ids_masked = torch.argsort(ids_restore, dim=1)[:, patch_feats.size(1) - 1 :]
+                pred = self.decoder(patch_feats, ids_restore, ids_masked)
+                out.update({"ids_masked": ids_masked})
+            else:
+                pred = self.decoder(patch_feats, ids_restore)
             out.update({"mask": mask, "pred": pred})
         else:
             feats = self.backbone(X)
@@ -241,21 +265,30 @@ class MAE(BaseMethod):
             torch.Tensor: total loss composed of MAE and classification loss.
         """
 
+        mae_targets = None
+        if self.precompute_mae_targets:
+            # the targets patchified by the data loading workers are appended after the crops
+            mae_targets = torch.cat(batch[1][self.num_crops :])
+            batch = [batch[0], batch[1][: self.num_crops], batch[2]]
+
         out = super().training_step(batch, batch_idx)
         class_loss = out["loss"]
 
         patch_size = self._vit_patch_size
         imgs = batch[1]
-        reconstruction_loss = 0
-        for i in range(self.num_large_crops):
-            reconstruction_loss += mae_loss_func(
-                imgs[i],
-                out["pred"][i],
-                out["mask"][i],
-                patch_size,
-                norm_pix_loss=self.norm_pix_loss,
-            )
-        reconstruction_loss /= self.num_large_crops
+        # all large crops have the same number of masked patches, so the loss over the
+        # concatenated crops is the average of the per-crop losses
+        reconstruction_loss = mae_loss_func(
+            torch.cat(imgs[: self.num_large_crops]) if mae_targets is None else None,
+            torch.cat(out["pred"][: self.num_large_crops]),
+            torch.cat(out["mask"][: self.num_large_crops]),
+            patch_size,
+            norm_pix_loss=self.norm_pix_loss,
+            ids_masked=torch.cat(out["ids_masked"][: self.num_large_crops])
+            if self.decoder_masked_only
+            else None,
+            target=mae_targets,
+        )
 
         metrics = {
             "train_reconstruction_loss": reconstruction_loss,
@@ -27,9 +27,9 @@ from solo.losses.mae import mae_loss_func
 from solo.methods.base import BaseMethod
 from solo.losses.manifold_regularizer import ManifoldRegularizer
 from solo.utils.embedding_propagation import get_similarity_matrix, get_laplacian
-from solo.utils.misc import generate_2d_sincos_pos_embed, omegaconf_select
+from solo.utils.misc import gather, generate_2d_sincos_pos_embed, omegaconf_select
 from solo.utils.weight_schedulers import TriangleScheduler, WarmupScheduler, StepScheduler, ConstantScheduler, IntervalScheduler
-from solo.utils.metrics import weighted_mean, tensor_mean, get_heatmap
+from solo.utils.metrics import weighted_mean
 from timm.models.vision_transformer import Block
 from solo.methods.u_mae import uniformity_loss
 
@@ -105,7 +105,7 @@ class MAEDecoder(nn.Module):
             nn.init.constant_(m.bias, 0)
             nn.init.constant_(m.weight, 1.0)
 
-    def forward(self, x, ids_restore):
+    def forward(self, x, ids_restore, ids_masked=None):
         # embed tokens
         x = self.decoder_embed(x)
 
@@ -127,12 +127,16 @@ class MAEDecoder(nn.Module):
         x = self.decoder_blocks(x)
         x = self.decoder_norm(x)
 
-        # predictor projection
-        x = self.decoder_pred(x)
-
         # remove cls token
         x = x[:, 1:, :]
 
+        # only predict the pixels of the masked patches
+        if ids_masked is not None:
+            x = torch.gather(x, dim=1, index=ids_masked.unsqueeze(-1).expand(-1, -1, x.shape[2]))
+
+        # predictor projection
+        x = self.decoder_pred(x)
+
         return x
 
 
@@ -151,6 +155,26 @@ class MAE_REG(BaseMethod):
                 decoder_num_heads (int) number of heads for the decoder
                 norm_pix_loss (bool): whether to normalize the pixels of each patch with their
                     respective mean and std for the loss. Defaults to False.
+                decoder_masked_only (bool): whether the decoder only predicts (and the loss is
+                    only computed on) the masked patches. Defaults to False.
+                distributed_graph (bool): whether to build the regularizer graph over the
+                    batch gathered from all processes. Defaults to False.
+                graph_knn (int): if positive, the regularizer uses a sparse graph with this
+                    many nearest neighbours per sample instead of the dense graph. Defaults to 0.
+                graph_chunk_size (int): if positive, the dense regularizer is computed over
+                    checkpointed row blocks of this many samples to bound its memory.
+                    Defaults to 0.
+                laplacian_metrics_frequency (int): log spectral metrics of the laplacians every
+                    this many steps, 0 disables them. Defaults to 0.
+                laplacian_metrics_solver (str): "lanczos" (k smallest eigenvalues and estimated
+                    energy) or "eigvalsh" (exact full spectrum). Defaults to "lanczos".
+                reg_queue_size (int): size of a queue with the (detached) layer representations
+                    of previous batches that are added to the regularizer graph, 0 disables it.
+                    Defaults to 0.
+            data:
+                precompute_mae_targets (bool): whether the data loading workers append the
+                    patchified (and normalized) reconstruction targets of the large crops after
+                    the crops (see MAETargetPipeline). Defaults to False.
         """
 
         super().__init__(cfg)
@@ -159,6 +183,8 @@ class MAE_REG(BaseMethod):
 
         self.mask_ratio: float = cfg.method_kwargs.mask_ratio
         self.norm_pix_loss: bool = cfg.method_kwargs.norm_pix_loss
+        self.decoder_masked_only: bool = cfg.method_kwargs.decoder_masked_only
+        self.precompute_mae_targets: bool = cfg.data.precompute_mae_targets
         self.layers = cfg.method_kwargs.layers
 
         # Scheduler params
@@ -180,8 +206,36 @@ class MAE_REG(BaseMethod):
         self.scale_euclidean_distance = cfg.method_kwargs.scale_euclidean_distance
         self.rbf_scale = cfg.method_kwargs.rbf_scale
         self.fixed_gamma = cfg.method_kwargs.fixed_gamma
+        self.distributed_graph = cfg.method_kwargs.distributed_graph
+
+        self.manifold_regularizer = ManifoldRegularizer(
+            scale_euclidean_distance=self.scale_euclidean_distance,
+            return_metrics=cfg.method_kwargs.laplacian_metrics_frequency > 0,
+            distributed=self.distributed_graph,
+            knn=cfg.method_kwargs.graph_knn,
+            chunk_size=cfg.method_kwargs.graph_chunk_size,
+            metrics_frequency=cfg.method_kwargs.laplacian_metrics_frequency,
+            spectral_solver=cfg.method_kwargs.laplacian_metrics_solver,
+        )
 
-        self.manifold_regularizer = ManifoldRegularizer(scale_euclidean_distance=self.scale_euclidean_distance, return_metrics=False)
+        # all layers are regularized w.r.t. the same target layer
+        self.target_layer = len(self.backbone.blocks) - 1
+        if len(self.layers) == 2:
+            self.target_layer = self.layers[-1]
+        self.reg_layers = [layer for layer in self.layers if layer != self.target_layer]
+        if self.reg_layers:
+            self.backbone.set_tapped_blocks(self.reg_layers + [self.target_layer])
+
+        # queue of representations of previous batches for the regularizer graph
+        self.reg_queue_size = cfg.method_kwargs.reg_queue_size
+        if self.reg_queue_size > 0:
+            self.register_buffer(
+                "reg_queue",
+                torch.zeros(len(self.reg_layers), self.reg_queue_size, self._vit_embed_dim),
+            )
+            self.register_buffer("reg_queue_target", torch.zeros(self.reg_queue_size, self._vit_embed_dim))
+            self.register_buffer("reg_queue_ptr", torch.zeros(1, dtype=torch.long))
+            self.register_buffer("reg_queue_len", torch.zeros(1, dtype=torch.long))
 
         self.uniformity_weight = cfg.method_kwargs.uniformity_weight
 
@@ -225,6 +279,12 @@ class MAE_REG(BaseMethod):
             "method_kwargs.norm_pix_loss",
             False,
         )
+        cfg.method_kwargs.decoder_masked_only = omegaconf_select(
+            cfg, "method_kwargs.decoder_masked_only", False
+        )
+        cfg.data.precompute_mae_targets = omegaconf_select(
+            cfg, "data.precompute_mae_targets", False
+        )
         cfg.method_kwargs.layers = omegaconf_select(cfg, "method_kwargs.layers", [])
         cfg.method_kwargs.scheduler = omegaconf_select(
             cfg, "method_kwargs.scheduler", {"name": "constant", "weight": 1.0}
@@ -234,6 +294,12 @@ class MAE_REG(BaseMethod):
         cfg.method_kwargs.uniformity_weight = omegaconf_select(cfg, "method_kwargs.uniformity_weight", 0)
         cfg.method_kwargs.rbf_scale = omegaconf_select(cfg, "method_kwargs.rbf_scale", 1)
         cfg.method_kwargs.fixed_gamma = omegaconf_select(cfg, "method_kwargs.fixed_gamma", None)
+        cfg.method_kwargs.distributed_graph = omegaconf_select(cfg, "method_kwargs.distributed_graph", False)
+        cfg.method_kwargs.graph_knn = omegaconf_select(cfg, "method_kwargs.graph_knn", 0)
+        cfg.method_kwargs.graph_chunk_size = omegaconf_select(cfg, "method_kwargs.graph_chunk_size", 0)
+        cfg.method_kwargs.laplacian_metrics_frequency = omegaconf_select(cfg, "method_kwargs.laplacian_metrics_frequency", 0)
+        cfg.method_kwargs.laplacian_metrics_solver = omegaconf_select(cfg, "method_kwargs.laplacian_metrics_solver", "lanczos")
+        cfg.method_kwargs.reg_queue_size = omegaconf_select(cfg, "method_kwargs.reg_queue_size", 0)
 
         cfg.method_kwargs.disparity_loss_gamma = omegaconf_select(cfg, "method_kwargs.disparity_loss_gamma", None)
         cfg.method_kwargs.disparity_loss_rbf_scale = omegaconf_select(cfg, "method_kwargs.disparity_loss_rbf_scale", 1)
@@ -286,6 +352,30 @@ class MAE_REG(BaseMethod):
         ]
         return super().learnable_params + extra_learnable_params
 
+    @torch.no_grad()
+    def dequeue_and_enqueue(self, xs: torch.Tensor, y: torch.Tensor):
+        """Adds new samples to the regularizer queue and removes the oldest ones.
+
+        Args:
+            xs (torch.Tensor): [l, b, c] stack of the representations of the regularized layers.
+            y (torch.Tensor): [b, c] representations of the target layer.
+        """
+
+        xs = gather(xs, dim=1)
+        y = gather(y)
+
+        batch_size = y.shape[0]
+
+        ptr = int(self.reg_queue_ptr)  # type: ignore
+        assert self.reg_queue_size % batch_size == 0
+
+        self.reg_queue[:, ptr : ptr + batch_size, :] = xs
+        self.reg_queue_target[ptr : ptr + batch_size, :] = y
+        ptr = (ptr + batch_size) % self.reg_queue_size
+
+        self.reg_queue_ptr[0] = ptr  # type: ignore
+        self.reg_queue_len[0] = min(int(self.reg_queue_len) + batch_size, self.reg_queue_size)
+
     def forward(self, X: torch.Tensor) -> Dict[str, Any]:
         """Performs forward pass of the online backbone, projector and predictor.
 
@@ -301,30 +391,22 @@ class MAE_REG(BaseMethod):
             X = X.to(memory_format=torch.channels_last)
         out = {}
 
-        handles = []
-        if self.training:
-            for number, block in enumerate(self.backbone.blocks):
-
-                def hook_fn(module, input, output, number=number):
-                    mean_token_representation = output[:, 1:, :].mean(dim=1)
-                    out.update({f"mean_block_{number}": mean_token_representation})
-                    out.update({f"cls_block_{number}": output[:, 0, :]})
-
-                handle = block.register_forward_hook(hook_fn)
-                handles.append(handle)
-
         if self.training:
-            feats, patch_feats, mask, ids_restore = self.backbone(X, self.mask_ratio)
-            pred = self.decoder(patch_feats, ids_restore)
+            feats, patch_feats, mask, ids_restore, block_feats = self.backbone(X, self.mask_ratio)
+            if self.decoder_masked_only:
+                # visible patches come first in the shuffled order (after the cls token)
+                ids_masked = torch.argsort(ids_restore, dim=1)[:, patch_feats.size(1) - 1 :]
+                pred = self.decoder(patch_feats, ids_restore, ids_masked)
+                out.update({"ids_masked": ids_masked})
+            else:
+                pred = self.decoder(patch_feats, ids_restore)
             out.update({"mask": mask, "pred": pred})
+            out.update({f"mean_block_{number}": feat for number, feat in block_feats.items()})
         else:
             feats = self.backbone(X)
 
         logits = self.classifier(feats.detach())
         out.update({"logits": logits, "feats": feats})
-
-        for handle in handles:
-            handle.remove()
         return out
 
     def training_step(self, batch: Sequence[Any], batch_idx: int) -> torch.Tensor:
@@ -339,42 +421,63 @@ class MAE_REG(BaseMethod):
             torch.Tensor: total loss composed of MAE and classification loss.
         """
 
+        mae_targets = None
+        if self.precompute_mae_targets:
+            # the targets patchified by the data loading workers are appended after the crops
+            mae_targets = torch.cat(batch[1][self.num_crops :])
+            batch = [batch[0], batch[1][: self.num_crops], batch[2]]
+
         out = super().training_step(batch, batch_idx)
         class_loss = out["loss"]
         metrics = {}
 
         patch_size = self._vit_patch_size
         imgs = batch[1]
-        reconstruction_loss = 0
         regularizer_loss = 0
         # disparity_loss = 0
-        for i in range(self.num_large_crops):
-            reconstruction_loss += mae_loss_func(
-                imgs[i],
-                out["pred"][i],
-                out["mask"][i],
-                patch_size,
-                norm_pix_loss=self.norm_pix_loss,
-            )
-        reconstruction_loss /= self.num_large_crops
+        # all large crops have the same number of masked patches, so the loss over the
+        # concatenated crops is the average of the per-crop losses
+        reconstruction_loss = mae_loss_func(
+            torch.cat(imgs[: self.num_large_crops]) if mae_targets is None else None,
+            torch.cat(out["pred"][: self.num_large_crops]),
+            torch.cat(out["mask"][: self.num_large_crops]),
+            patch_size,
+            norm_pix_loss=self.norm_pix_loss,
+            ids_masked=torch.cat(out["ids_masked"][: self.num_large_crops])
+            if self.decoder_masked_only
+            else None,
+            target=mae_targets,
+        )
 
-        last_block_number = len(self.backbone.blocks) - 1
-        if len(self.layers) == 2:
-            last_block_number = self.layers[-1]
-
-        for layer in self.layers:
-            if layer != last_block_number:
-                loss_term, laplacian_metrics = self.manifold_regularizer.manifold_regularizer_loss(
-                    out[f"mean_block_{layer}"][0],
-                    out[f"mean_block_{last_block_number}"][0],
-                    rbf_scale=self.rbf_scale,
-                    fixed_gamma=self.fixed_gamma,
-                )
+        last_block_number = self.target_layer
+
+        # all layers are regularized w.r.t. the same target in a single batched pass
+        reg_layers = self.reg_layers
+        if reg_layers:
+            xs = torch.stack([out[f"mean_block_{layer}"][0] for layer in reg_layers])
+            y = out[f"mean_block_{last_block_number}"][0]
+
+            xs_queue, y_queue = None, None
+            if self.reg_queue_size > 0 and int(self.reg_queue_len) > 0:
+                queue_len = int(self.reg_queue_len)
+                xs_queue, y_queue = self.reg_queue[:, :queue_len], self.reg_queue_target[:queue_len]
+
+            loss_terms, laplacian_metrics = self.manifold_regularizer.batched_manifold_regularizer_loss(
+                xs,
+                y,
+                rbf_scale=self.rbf_scale,
+                fixed_gamma=self.fixed_gamma,
+                xs_queue=xs_queue,
+                y_queue=y_queue,
+            )
+            if self.reg_queue_size > 0:
+                self.dequeue_and_enqueue(xs, y)
 
-                metrics.update({f"Layer{layer}_to_Layer{last_block_number}_regularization_loss": loss_term})
+            for i, layer in enumerate(reg_layers):
+                metrics.update({f"Layer{layer}_to_Layer{last_block_number}_regularization_loss": loss_terms[i]})
                 for key, value in laplacian_metrics.items():
-                    metrics[f"{key}_Layer{layer}"] = value
-                regularizer_loss += loss_term
+                    metrics[f"{key}_Layer{layer}"] = value[i]
+            regularizer_loss = loss_terms.sum()
 
 
         # Divide loss by the number of terms in the regularization loss
@@ -392,14 +495,12 @@ class MAE_REG(BaseMethod):
         
 
         regularizer_weight = self.reg_scheduler(self.current_epoch)
-        disparity_loss_weight = self.disparity_loss_scheduler(self.current_epoch)
         regularization_loss_scaled = regularizer_loss * regularizer_weight
         # disparity_loss_scaled = disparity_loss * disparity_loss_weight
         uniformity_loss_scaled = reg_uniformity_loss * self.uniformity_weight
         metrics.update(
             {
                 "train_regularizer_weight": regularizer_weight,
-                "train_dispartiy_weight": disparity_loss_weight,
                 "train_regularization_loss_scaled": regularization_loss_scaled,
                 # "train_disparity_loss_scaled": disparity_loss_scaled,
                 "uniformity_loss_scaled": uniformity_loss_scaled,
@@ -22,11 +22,12 @@ from typing import Any, Dict, List, Sequence
 import omegaconf
 import torch
 import torch.nn as nn
+from solo.backbones.vit.vit import BlockTap
 from solo.losses.simclr import simclr_loss_func
 from solo.losses.manifold_regularizer import ManifoldRegularizer
 from solo.utils.weight_schedulers import IntervalScheduler, StepScheduler, TriangleScheduler, WarmupScheduler, ConstantScheduler
 from solo.methods.base import BaseMethod
-from solo.utils.misc import omegaconf_select
+from solo.utils.misc import gather, omegaconf_select
 
 
 class SimCLR_REG(BaseMethod):
@@ -38,6 +39,20 @@ class SimCLR_REG(BaseMethod):
                 proj_output_dim (int): number of dimensions of the projected features.
                 proj_hidden_dim (int): number of neurons in the hidden layers of the projector.
                 temperature (float): temperature for the softmax in the contrastive loss.
+                distributed_graph (bool): whether to build the regularizer graph over the
+                    batch gathered from all processes. Defaults to False.
+                graph_knn (int): if positive, the regularizer uses a sparse graph with this
+                    many nearest neighbours per sample instead of the dense graph. Defaults to 0.
+                graph_chunk_size (int): if positive, the dense regularizer is computed over
+                    checkpointed row blocks of this many samples to bound its memory.
+                    Defaults to 0.
+                laplacian_metrics_frequency (int): log spectral metrics of the laplacians every
+                    this many steps, 0 disables them. Defaults to 0.
+                laplacian_metrics_solver (str): "lanczos" (k smallest eigenvalues and estimated
+                    energy) or "eigvalsh" (exact full spectrum). Defaults to "lanczos".
+                reg_queue_size (int): size of a queue with the (detached) layer representations
+                    of previous batches that are added to the regularizer graph, 0 disables it.
+                    Only supported for ViT backbones. Defaults to 0.
         """
 
         super().__init__(cfg)
@@ -51,13 +66,40 @@ class SimCLR_REG(BaseMethod):
         # Scheduler params
         self.configure_reg_scheduler(cfg.method_kwargs.reg_scheduler)
 
-        self.manifold_regularizer = ManifoldRegularizer(return_metrics=False)
+        self.manifold_regularizer = ManifoldRegularizer(
+            return_metrics=cfg.method_kwargs.laplacian_metrics_frequency > 0,
+            distributed=cfg.method_kwargs.distributed_graph,
+            knn=cfg.method_kwargs.graph_knn,
+            chunk_size=cfg.method_kwargs.graph_chunk_size,
+            metrics_frequency=cfg.method_kwargs.laplacian_metrics_frequency,
+            spectral_solver=cfg.method_kwargs.laplacian_metrics_solver,
+        )
 
         try:
             self.layers = cfg.method_kwargs.layers
         except:
             pass
 
+        # persistent tap of the regularized blocks and of the last one (ViT only)
+        self.block_tap = None
+        if not cfg.backbone.name.startswith("resnet"):
+            self.block_tap = BlockTap(self.backbone, [*self.layers, len(self.backbone.blocks) - 1])
+
+        # queue of representations of previous batches for the regularizer graph
+        self.reg_queue_size = cfg.method_kwargs.reg_queue_size
+        if self.reg_queue_size > 0:
+            assert not cfg.backbone.name.startswith(
+                "resnet"
+            ), "The regularizer queue only supports ViT backbones."
+            last_block_number = len(self.backbone.blocks) - 1
+            num_reg_layers = len([layer for layer in self.layers if layer != last_block_number])
+            self.register_buffer(
+                "reg_queue", torch.zeros(num_reg_layers, self.reg_queue_size, self.features_dim)
+            )
+            self.register_buffer("reg_queue_target", torch.zeros(self.reg_queue_size, self.features_dim))
+            self.register_buffer("reg_queue_ptr", torch.zeros(1, dtype=torch.long))
+            self.register_buffer("reg_queue_len", torch.zeros(1, dtype=torch.long))
+
         # projector
         self.projector = nn.Sequential(
             nn.Linear(self.features_dim, proj_hidden_dim),
@@ -87,6 +129,20 @@ class SimCLR_REG(BaseMethod):
         )
 
         cfg.method_kwargs.layers = omegaconf_select(cfg, "method_kwargs.layers", [])
+        cfg.method_kwargs.distributed_graph = omegaconf_select(
+            cfg, "method_kwargs.distributed_graph", False
+        )
+        cfg.method_kwargs.graph_knn = omegaconf_select(cfg, "method_kwargs.graph_knn", 0)
+        cfg.method_kwargs.graph_chunk_size = omegaconf_select(
+            cfg, "method_kwargs.graph_chunk_size", 0
+        )
+        cfg.method_kwargs.laplacian_metrics_frequency = omegaconf_select(
+            cfg, "method_kwargs.laplacian_metrics_frequency", 0
+        )
+        cfg.method_kwargs.laplacian_metrics_solver = omegaconf_select(
+            cfg, "method_kwargs.laplacian_metrics_solver", "lanczos"
+        )
+        cfg.method_kwargs.reg_queue_size = omegaconf_select(cfg, "method_kwargs.reg_queue_size", 0)
         cfg.method_kwargs.scheduler = omegaconf_select(
             cfg, "method_kwargs.scheduler", {"name": "constant", "weight": 1.0}
         )
@@ -138,6 +194,30 @@ class SimCLR_REG(BaseMethod):
         extra_learnable_params = [{"name": "projector", "params": self.projector.parameters()}]
         return super().learnable_params + extra_learnable_params
 
+    @torch.no_grad()
+    def dequeue_and_enqueue(self, xs: torch.Tensor, y: torch.Tensor):
+        """Adds new samples to the regularizer queue and removes the oldest ones.
+
+        Args:
+            xs (torch.Tensor): [l, b, c] stack of the representations of the regularized layers.
+            y (torch.Tensor): [b, c] representations of the target layer.
+        """
+
+        xs = gather(xs, dim=1)
+        y = gather(y)
+
+        batch_size = y.shape[0]
+
+        ptr = int(self.reg_queue_ptr)  # type: ignore
+        assert self.reg_queue_size % batch_size == 0
+
+        self.reg_queue[:, ptr : ptr + batch_size, :] = xs
+        self.reg_queue_target[ptr : ptr + batch_size, :] = y
+        ptr = (ptr + batch_size) % self.reg_queue_size
+
+        self.reg_queue_ptr[0] = ptr  # type: ignore
+        self.reg_queue_len[0] = min(int(self.reg_queue_len) + batch_size, self.reg_queue_size)
+
     def forward(self, X: torch.tensor) -> Dict[str, Any]:
         """Performs the forward pass of the backbone and the projector.
 
@@ -158,17 +238,12 @@ class SimCLR_REG(BaseMethod):
                     out['layer3'] = nn.functional.adaptive_avg_pool2d(output, (1,1)).flatten(1)
                 handle_3 = self.backbone.layer3.register_forward_hook(hook_fn_3)
                 handles.append(handle_3)
-            else:
-                for number, block in enumerate(self.backbone.blocks):
-                    def hook_fn(module, input, output, number=number):
-                        mean_token_representation = output[:, 1:, :].mean(dim=1)
-                        out.update({f"mean_block_{number}": mean_token_representation})
-                        out.update({f"cls_block_{number}": output[:, 0, :]})
-
-                    handle = block.register_forward_hook(hook_fn)
-                    handles.append(handle)
 
         out.update(super().forward(X))
+        if self.block_tap is not None:
+            block_feats = self.block_tap.pop()
+            if self.training:
+                out.update({f"mean_block_{number}": feat for number, feat in block_feats.items()})
 
         z = self.projector(out["feats"])
         out.update({"z": z})
@@ -237,15 +312,26 @@ class SimCLR_REG(BaseMethod):
             last_block_number = len(self.backbone.blocks) - 1
             if last_block_number in self.layers:
                 self.layers.remove(last_block_number)
-            for layer in self.layers:
-                if layer != last_block_number:
-                    loss_term, laplacian_metrics = self.manifold_regularizer.manifold_regularizer_loss(
-                        out[f"mean_block_{layer}"][0],
-                        out[f"mean_block_{last_block_number}"][0],
-                    )
+            if len(self.layers) > 0:
+                # all layers are regularized w.r.t. the same target in a single batched pass
+                xs = torch.stack([out[f"mean_block_{layer}"][0] for layer in self.layers])
+                y = out[f"mean_block_{last_block_number}"][0]
+
+                xs_queue, y_queue = None, None
+                if self.reg_queue_size > 0 and int(self.reg_queue_len) > 0:
+                    queue_len = int(self.reg_queue_len)
+                    xs_queue = self.reg_queue[:, :queue_len]
+                    y_queue = self.reg_queue_target[:queue_len]
+
+                loss_terms, laplacian_metrics = self.manifold_regularizer.batched_manifold_regularizer_loss(
+                    xs, y, xs_queue=xs_queue, y_queue=y_queue
+                )
+                if self.reg_queue_size > 0:
+                    self.dequeue_and_enqueue(xs, y)
+                for i, layer in enumerate(self.layers):
                     for key, value in laplacian_metrics.items():
-                        metrics[f"{key}_Layer{layer}"] = value
-                    regularizer_loss += loss_term
+                        metrics[f"{key}_Layer{layer}"] = value[i]
+                regularizer_loss = loss_terms.sum()
             # Divide loss by the number of terms in the regularization loss
             if len(self.layers) > 0:
                 regularizer_loss /= len(self.layers)
@@ -30,7 +30,7 @@ from solo.losses.manifold_regularizer import ManifoldRegularizer
 from solo.utils.embedding_propagation import get_similarity_matrix, get_laplacian
 from solo.utils.misc import generate_2d_sincos_pos_embed, omegaconf_select
 from solo.utils.weight_schedulers import TriangleScheduler, WarmupScheduler, StepScheduler, ConstantScheduler, IntervalScheduler
-from solo.utils.metrics import weighted_mean, tensor_mean, get_heatmap
+from solo.utils.metrics import weighted_mean
 from timm.models.vision_transformer import Block
 
 def uniformity_loss(features):
@@ -113,7 +113,7 @@ class MAEDecoder(nn.Module):
             nn.init.constant_(m.bias, 0)
             nn.init.constant_(m.weight, 1.0)
 
-    def forward(self, x, ids_restore):
+    def forward(self, x, ids_restore, ids_masked=None):
         # embed tokens
         x = self.decoder_embed(x)
 
@@ -135,12 +135,16 @@ class MAEDecoder(nn.Module):
         x = self.decoder_blocks(x)
         x = self.decoder_norm(x)
 
-        # predictor projection
-        x = self.decoder_pred(x)
-
         # remove cls token
         x = x[:, 1:, :]
 
+        # only predict the pixels of the masked patches
+        if ids_masked is not None:
+            x = torch.gather(x, dim=1, index=ids_masked.unsqueeze(-1).expand(-1, -1, x.shape[2]))
+
+        # predictor projection
+        x = self.decoder_pred(x)
+
         return x
 
 
@@ -159,6 +163,12 @@ class U_MAE(BaseMethod):
                 decoder_num_heads (int) number of heads for the decoder
                 norm_pix_loss (bool): whether to normalize the pixels of each patch with their
                     respective mean and std for the loss. Defaults to False.
+                decoder_masked_only (bool): whether the decoder only predicts (and the loss is
+                    only computed on) the masked patches. Defaults to False.
+            data:
+                precompute_mae_targets (bool): whether the data loading workers append the
+                    patchified (and normalized) reconstruction targets of the large crops after
+                    the crops (see MAETargetPipeline). Defaults to False.
         """
 
         super().__init__(cfg)
@@ -167,6 +177,8 @@ class U_MAE(BaseMethod):
 
         self.mask_ratio: float = cfg.method_kwargs.mask_ratio
         self.norm_pix_loss: bool = cfg.method_kwargs.norm_pix_loss
+        self.decoder_masked_only: bool = cfg.method_kwargs.decoder_masked_only
+        self.precompute_mae_targets: bool = cfg.data.precompute_mae_targets
         self.layers = cfg.method_kwargs.layers
 
         # Scheduler params
@@ -240,6 +252,12 @@ class U_MAE(BaseMethod):
             "method_kwargs.norm_pix_loss",
             False,
         )
+        cfg.method_kwargs.decoder_masked_only = omegaconf_select(
+            cfg, "method_kwargs.decoder_masked_only", False
+        )
+        cfg.data.precompute_mae_targets = omegaconf_select(
+            cfg, "data.precompute_mae_targets", False
+        )
         cfg.method_kwargs.layers = omegaconf_select(cfg, "method_kwargs.layers", [])
         cfg.method_kwargs.scheduler = omegaconf_select(
             cfg, "method_kwargs.scheduler", {"name": "constant", "weight": 1.0}
@@ -311,30 +329,21 @@ class U_MAE(BaseMethod):
             X = X.to(memory_format=torch.channels_last)
         out = {}
 
-        handles = []
         if self.training:
-            for number, block in enumerate(self.backbone.blocks):
-
-                def hook_fn(module, input, output, number=number):
-                    mean_token_representation = output[:, 1:, :].mean(dim=1)
-                    out.update({f"mean_block_{number}": mean_token_representation})
-                    out.update({f"cls_block_{number}": output[:, 0, :]})
-
-                handle = block.register_forward_hook(hook_fn)
-                handles.append(handle)
-
-        if self.training:
-            feats, patch_feats, mask, ids_restore = self.backbone(X, self.mask_ratio)
-            pred = self.decoder(patch_feats, ids_restore)
+            feats, patch_feats, mask, ids_restore, _ = self.backbone(X, self.mask_ratio)
+            if self.decoder_masked_only:
+                # visible patches come first in the shuffled order (after the cls token)
+                ids_masked = torch.argsort(ids_restore, dim=1)[:, patch_feats.size(1) - 1 :]
+                pred = self.decoder(patch_feats, ids_restore, ids_masked)
+                out.update({"ids_masked": ids_masked})
+            else:
+                pred = self.decoder(patch_feats, ids_restore)
             out.update({"mask": mask, "pred": pred})
         else:
             feats = self.backbone(X)
 
         logits = self.classifier(feats.detach())
         out.update({"logits": logits, "feats": feats})
-
-        for handle in handles:
-            handle.remove()
         return out
 
     def training_step(self, batch: Sequence[Any], batch_idx: int) -> torch.Tensor:
@@ -349,22 +358,31 @@ class U_MAE(BaseMethod):
             torch.Tensor: total loss composed of MAE and classification loss.
         """
 
+        mae_targets = None
+        if self.precompute_mae_targets:
+            # the targets patchified by the data loading workers are appended after the crops
+            mae_targets = torch.cat(batch[1][self.num_crops :])
+            batch = [batch[0], batch[1][: self.num_crops], batch[2]]
+
         out = super().training_step(batch, batch_idx)
         class_loss = out["loss"]
         metrics = {}
 
         patch_size = self._vit_patch_size
         imgs = batch[1]
-        reconstruction_loss = 0
-        for i in range(self.num_large_crops):
-            reconstruction_loss += mae_loss_func(
-                imgs[i],
-                out["pred"][i],
-                out["mask"][i],
-                patch_size,
-                norm_pix_loss=self.norm_pix_loss,
-            )
-        reconstruction_loss /= self.num_large_crops
+        # all large crops have the same number of masked patches, so the loss over the
+        # concatenated crops is the average of the per-crop losses
+        reconstruction_loss = mae_loss_func(
+            torch.cat(imgs[: self.num_large_crops]) if mae_targets is None else None,
+            torch.cat(out["pred"][: self.num_large_crops]),
+            torch.cat(out["mask"][: self.num_large_crops]),
+            patch_size,
+            norm_pix_loss=self.norm_pix_loss,
+            ids_masked=torch.cat(out["ids_masked"][: self.num_large_crops])
+            if self.decoder_masked_only
+            else None,
+            target=mae_targets,
+        )
 
         regularizer_loss = uniformity_loss(out['feats'][0])
 
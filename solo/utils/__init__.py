@@ -19,6 +19,7 @@
 
 from solo.utils import (
     checkpointer,
+    feature_store,
     knn,
     lars,
     metrics,
@@ -30,6 +31,7 @@ from solo.utils import (
 
 __all__ = [
     "checkpointer",
+    "feature_store",
     "knn",
     "misc",
     "lars",
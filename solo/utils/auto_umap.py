@@ -34,9 +34,9 @@ import umap
 from lightning.pytorch.callbacks import Callback
 from matplotlib import pyplot as plt
 from omegaconf import DictConfig
-from tqdm import tqdm
 
 import wandb
+from solo.utils.feature_store import extract_features
 from solo.utils.misc import gather, omegaconf_select
 
 
@@ -254,23 +254,21 @@ class OfflineUMAP:
             plot_path (str): path to save the figure.
         """
 
-        data = []
-        Y = []
+        features = extract_features(dataloader, model, device=device)
+        self.plot_features(features["feats"], features["targets"], plot_path)
 
-        # set module to eval model and collect all feature representations
-        model.eval()
-        with torch.no_grad():
-            for x, y in tqdm(dataloader, desc="Collecting features"):
-                x = x.to(device, non_blocking=True)
-                y = y.to(device, non_blocking=True)
+    def plot_features(self, features: torch.Tensor, targets: torch.Tensor, plot_path: str):
+        """Produces a UMAP visualization of already extracted features, e.g. loaded from a
+        feature store.
 
-                feats = model(x)
-                data.append(feats.cpu())
-                Y.append(y.cpu())
-        model.train()
+        Args:
+            features (torch.Tensor): features of each sample.
+            targets (torch.Tensor): target of each sample.
+            plot_path (str): path to save the figure.
+        """
 
-        data = torch.cat(data, dim=0).numpy()
-        Y = torch.cat(Y, dim=0)
+        data = features.float().numpy()
+        Y = targets
         num_classes = len(torch.unique(Y))
         Y = Y.numpy()
 
@@ -23,12 +23,13 @@ import random
 import string
 import time
 from pathlib import Path
-from typing import Optional, Union
+from typing import Any, Dict, Optional, Union
 
 import lightning.pytorch as pl
 from lightning.pytorch.callbacks import Callback
 from omegaconf import DictConfig, OmegaConf
 
+from solo.data.sampler import ResumableDistributedSampler
 from solo.utils.misc import omegaconf_select
 
 
@@ -39,6 +40,8 @@ class Checkpointer(Callback):
         logdir: Union[str, Path] = Path("trained_models"),
         frequency: int = 1,
         keep_prev: bool = False,
+        every_n_steps: int = 0,
+        sampler: Optional[ResumableDistributedSampler] = None,
     ):
         """Custom checkpointer callback that stores checkpoints in an easier to access way.
 
@@ -49,6 +52,11 @@ class Checkpointer(Callback):
             frequency (int, optional): number of epochs between each checkpoint. Defaults to 1.
             keep_prev (bool, optional): whether to keep previous checkpoints or not.
                 Defaults to False.
+            every_n_steps (int, optional): number of training steps between each mid-epoch
+                checkpoint. Defaults to 0 (disabled).
+            sampler (Optional[ResumableDistributedSampler], optional): sampler of the training
+                data, whose position is stored in the checkpoints so that a resumed run
+                continues the epoch where it stopped. Defaults to None.
         """
 
         super().__init__()
@@ -57,6 +65,13 @@ class Checkpointer(Callback):
         self.logdir = Path(logdir)
         self.frequency = frequency
         self.keep_prev = keep_prev
+        self.every_n_steps = every_n_steps
+        self.sampler = sampler
+
+        # number of samples of the current epoch consumed by the training
+        self.num_consumed = 0
+        # global step of the last mid-epoch checkpoint
+        self._last_saved_step = 0
 
     @staticmethod
     def add_and_assert_specific_cfg(cfg: DictConfig) -> DictConfig:
@@ -74,6 +89,7 @@ class Checkpointer(Callback):
         cfg.checkpoint.dir = omegaconf_select(cfg, "checkpoint.dir", default="trained_models")
         cfg.checkpoint.frequency = omegaconf_select(cfg, "checkpoint.frequency", default=1)
         cfg.checkpoint.keep_prev = omegaconf_select(cfg, "checkpoint.keep_prev", default=False)
+        cfg.checkpoint.every_n_steps = omegaconf_select(cfg, "checkpoint.every_n_steps", default=0)
 
         return cfg
 
@@ -130,16 +146,19 @@ class Checkpointer(Callback):
             json_path = self.path / "args.json"
             json.dump(args, open(json_path, "w"), default=lambda o: "<not serializable>")
 
-    def save(self, trainer: pl.Trainer):
+    def save(self, trainer: pl.Trainer, step: Optional[int] = None):
         """Saves current checkpoint.
 
         Args:
             trainer (pl.Trainer): pytorch lightning trainer object.
+            step (Optional[int]): global step of a mid-epoch checkpoint. Defaults to None.
         """
 
         if not trainer.sanity_checking:
             epoch = trainer.current_epoch  # type: ignore
             ckpt = self.path / self.ckpt_placeholder.format(epoch)
+            if step is not None:
+                ckpt = ckpt.with_name(f"{ckpt.stem}-step={step}.ckpt")
             trainer.save_checkpoint(ckpt)
 
             if (
@@ -162,6 +181,7 @@ class Checkpointer(Callback):
 
         self.initial_setup(trainer)
         self.save_args(trainer)
+        self._last_saved_step = trainer.global_step
 
     def on_train_epoch_end(self, trainer: pl.Trainer, _):
         """Tries to save current checkpoint at the end of each train epoch.
@@ -173,3 +193,31 @@ class Checkpointer(Callback):
         epoch = trainer.current_epoch  # type: ignore
         if epoch % self.frequency == 0:
             self.save(trainer)
+
+    def on_train_epoch_start(self, trainer: pl.Trainer, _):
+        self.num_consumed = 0
+
+    def on_train_batch_end(self, trainer: pl.Trainer, _, outputs, batch, batch_idx: int):
+        """Keeps track of the position in the epoch and saves the mid-epoch checkpoints.
+
+        Args:
+            trainer (pl.Trainer): pytorch lightning trainer object.
+        """
+
+        # batches are (indexes, crops, targets)
+        self.num_consumed += len(batch[0])
+
+        # with gradient accumulation, the global step stays the same for several batches
+        step = trainer.global_step
+        if self.every_n_steps and step != self._last_saved_step and step % self.every_n_steps == 0:
+            self.save(trainer, step=step)
+            self._last_saved_step = step
+
+    def state_dict(self) -> Dict[str, Any]:
+        if self.sampler is None:
+            return {}
+        return {"sampler": self.sampler.state_dict(self.num_consumed)}
+
+    def load_state_dict(self, state_dict: Dict[str, Any]):
+        if self.sampler is not None and "sampler" in state_dict:
+            self.sampler.load_state_dict(state_dict["sampler"])
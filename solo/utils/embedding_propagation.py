@@ -51,7 +51,7 @@ def get_cosine_similarity_matrix(x):
 
 def get_similarity_matrix(x, rbf_scale, scaling_factor=True, fixed_gamma=None):
     b, c = x.size()
-    sq_dist = ((x.view(b, 1, c) - x.view(1, b, c)) ** 2).sum(-1)
+    sq_dist = get_distance_matrix(x)
     if scaling_factor:
         sq_dist  = sq_dist / np.sqrt(c)
     mask = sq_dist != 0
@@ -65,9 +65,28 @@ def get_similarity_matrix(x, rbf_scale, scaling_factor=True, fixed_gamma=None):
     weights = weights * (~mask).float()
     return weights, gamma
 
-def get_distance_matrix(x):
-    b, c = x.size()
-    sq_dist = ((x.view(b, 1, c) - x.view(1, b, c)) ** 2).sum(-1)
+def get_distance_matrix(x, y=None):
+    """
+    Computes the squared euclidean distances between the rows of X (b, c) and the rows of Y (n, c)
+    through the Gram matrix, i.e. ||x||^2 + ||y||^2 - 2 * x @ y.T, which only allocates (b, n)
+    tensors instead of the (b, n, c) tensor of the broadcasted difference. The computation is done
+    in float32 as the expansion is sensitive to cancellation in half precision.
+    Stacks of inputs of shape (l, b, c) and (l, n, c) are also supported and produce (l, b, n).
+    If Y is not provided, computes the distances between the rows of X with a zeroed diagonal.
+    """
+    with torch.autocast(device_type=x.device.type, enabled=False):
+        x = x.float()
+        other = x if y is None else y.float()
+        sq_norms = x.pow(2).sum(dim=-1, keepdim=True)
+        if x.dim() == 2:
+            sq_dist = torch.addmm(sq_norms, x, other.T, alpha=-2)
+        else:
+            sq_dist = torch.baddbmm(sq_norms, x, other.transpose(1, 2), alpha=-2)
+        sq_dist = sq_dist + other.pow(2).sum(dim=-1).unsqueeze(-2)
+        sq_dist = sq_dist.clamp(min=0)
+    if y is None:
+        mask = torch.eye(sq_dist.size(-1), dtype=torch.bool, device=sq_dist.device)
+        sq_dist = sq_dist.masked_fill(mask, 0)
     return sq_dist
 
 def get_laplacian(weights, normalized=True):
@@ -81,6 +100,74 @@ def get_laplacian(weights, normalized=True):
         return torch.diag(weights.sum(dim=-1)) - weights
 
 
+@torch.no_grad()
+def get_smallest_eigenvalues(laplacian, k=2, solver="lanczos"):
+    """
+    Computes the k smallest eigenvalues of a symmetric laplacian (n, n) or of a stack of
+    laplacians (l, n, n). The "eigvalsh" solver computes the full spectrum with the symmetric
+    eigensolver, while the "lanczos" solver uses LOBPCG to only iterate the k requested eigenpairs,
+    falling back to the full spectrum when the matrix is too small or LOBPCG fails.
+    """
+    assert solver in ["eigvalsh", "lanczos"]
+    laplacian = laplacian.float()
+    n = laplacian.size(-1)
+    if solver == "lanczos" and n >= 3 * k:
+        try:
+            eigvals = [
+                torch.lobpcg(matrix, k=k, largest=False)[0].sort().values
+                for matrix in laplacian.view(-1, n, n)
+            ]
+            return torch.stack(eigvals).view(*laplacian.shape[:-2], k)
+        except RuntimeError:
+            pass
+    return torch.linalg.eigvalsh(laplacian)[..., :k]
+
+
+@torch.no_grad()
+def estimate_laplacian_energy(laplacian, num_probes=8, lanczos_steps=20):
+    """
+    Estimates the laplacian energy, sum_i |lambda_i - 1|, of a symmetric laplacian (n, n) or of a
+    stack of laplacians (l, n, n) with stochastic Lanczos quadrature: Hutchinson's trace estimator
+    with Rademacher probes where the quadratic forms z.T |L - I| z are approximated by a few Lanczos
+    steps (with full reorthogonalization). Costs O(num_probes * lanczos_steps * n^2) instead of the
+    O(n^3) of a full eigendecomposition.
+    """
+    laplacian = laplacian.float()
+    squeeze = laplacian.dim() == 2
+    if squeeze:
+        laplacian = laplacian.unsqueeze(0)
+    l, n, _ = laplacian.size()
+    steps = min(lanczos_steps, n)
+    shifted = laplacian - torch.eye(n, device=laplacian.device)
+
+    probes = torch.randint(0, 2, (l, n, num_probes), device=laplacian.device).float() * 2 - 1
+    v = probes / n**0.5
+    basis = [v]
+    alphas, betas = [], []
+    for j in range(steps):
+        w = shifted @ v
+        alpha = (w * v).sum(dim=1)
+        alphas.append(alpha)
+        if j == steps - 1:
+            break
+        q = torch.stack(basis, dim=-1)
+        w = w - torch.einsum("lnpj,lpj->lnp", q, torch.einsum("lnpj,lnp->lpj", q, w))
+        beta = w.norm(dim=1)
+        betas.append(beta)
+        v = w / beta.clamp(min=1e-10)[:, None, :]
+        basis.append(v)
+
+    # tridiagonal matrices (l, p, steps, steps) whose eigenpairs give the quadrature rule
+    tridiagonal = torch.diag_embed(torch.stack(alphas, dim=-1))
+    if betas:
+        betas = torch.stack(betas, dim=-1)
+        tridiagonal = tridiagonal + torch.diag_embed(betas, offset=1) + torch.diag_embed(betas, offset=-1)
+    nodes, vectors = torch.linalg.eigh(tridiagonal)
+    weights = vectors[..., 0, :] ** 2
+    energy = n * (weights * nodes.abs()).sum(dim=-1).mean(dim=-1)
+    return energy[0] if squeeze else energy
+
+
 def embedding_propagation(x, alpha, rbf_scale, norm_prop, propagator=None):
     if propagator is None:
         weights = get_similarity_matrix(x, rbf_scale)
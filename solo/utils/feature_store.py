@@ -0,0 +1,264 @@
+# Copyright 2023 solo-learn development team.
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in
+# the Software without restriction, including without limitation the rights to use,
+# copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the
+# Software, and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all copies
+# or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR
+# PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE
+# FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR
+# OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+
+import hashlib
+import json
+import os
+import shutil
+from pathlib import Path
+from typing import Any, Dict, Optional, Sequence, Union
+
+import numpy as np
+import torch
+import torch.nn as nn
+from torch.utils.data import DataLoader
+from tqdm import tqdm
+
+from solo.data.loader import CUDAPrefetcher
+
+
+def checkpoint_hash(path: Union[str, Path], chunk_size: int = 1 << 20) -> str:
+    """Computes the sha1 of the content of a checkpoint, so that features are invalidated when
+    the checkpoint changes but not when it is moved or renamed.
+
+    Args:
+        path (Union[str, Path]): path to the checkpoint.
+        chunk_size (int, optional): number of bytes read at once. Defaults to 1MB.
+
+    Returns:
+        str: hex digest of the checkpoint.
+    """
+
+    sha1 = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+def feature_store_key(
+    checkpoint: Union[str, Path],
+    dataset: str,
+    transform: Any,
+    split: str,
+    **extra: Any,
+) -> str:
+    """Builds the key of a set of features from everything that changes them.
+
+    Args:
+        checkpoint (Union[str, Path]): path to the checkpoint.
+        dataset (str): dataset name, including its data path when it has one.
+        transform (Any): transformation pipeline. Its repr identifies it.
+        split (str): dataset split, e.g. "train" or "val".
+        extra (Any): any other option that changes the features, e.g. the number of views.
+
+    Returns:
+        str: the key of the features.
+    """
+
+    description = {
+        "checkpoint": checkpoint_hash(checkpoint),
+        "dataset": dataset,
+        "transform": repr(transform),
+        "split": split,
+        **{k: repr(v) for k, v in extra.items()},
+    }
+    description = json.dumps(description, sort_keys=True).encode()
+    return f"{split}-{hashlib.sha1(description).hexdigest()[:16]}"
+
+
+@torch.no_grad()
+def extract_features(
+    loader: DataLoader,
+    model: nn.Module,
+    device: Optional[Union[str, torch.device]] = None,
+    amp: bool = True,
+    feature_keys: Sequence[str] = ("feats", "z"),
+    dtype: torch.dtype = torch.float16,
+) -> Dict[str, torch.Tensor]:
+    """Extracts features from a data loader using a model. The features of each batch are
+    moved to the cpu in a reduced precision, so that the device only holds a single batch.
+
+    Args:
+        loader (DataLoader): dataloader that yields batches of images and targets.
+        model (nn.Module): model that returns either a dict of outputs (e.g. a method) or a
+            tensor of features (e.g. a backbone). A tensor is stored as "feats".
+        device (Optional[Union[str, torch.device]], optional): device used to run the model.
+            Defaults to the gpu when available, otherwise the cpu.
+        amp (bool, optional): whether to run the model under float16 autocast. Only used on
+            the gpu. Defaults to True.
+        feature_keys (Sequence[str], optional): outputs of the model that are stored. The ones
+            that the model does not produce (e.g. "z" for MAE) are skipped.
+            Defaults to ("feats", "z").
+        dtype (torch.dtype, optional): dtype of the stored features. Defaults to torch.float16.
+
+    Returns:
+        Dict[str, torch.Tensor]: the features of each output and the "targets".
+    """
+
+    if device is None:
+        device = "cuda" if torch.cuda.is_available() else "cpu"
+    device = torch.device(device)
+    model = model.to(device)
+
+    if device.type == "cuda":
+        # the next batch is copied to the gpu while the current one is forwarded
+        batches = CUDAPrefetcher(loader, device)
+    else:
+        batches = loader
+
+    was_training = model.training
+    model.eval()
+    features = {}
+    targets = []
+    for x, y in tqdm(batches, desc="Extracting features"):
+        x = x.to(device, non_blocking=True)
+        with torch.autocast(device.type, enabled=amp and device.type == "cuda"):
+            outs = model(x)
+        if isinstance(outs, torch.Tensor):
+            outs = {"feats": outs}
+
+        for key in feature_keys:
+            if key in outs:
+                features.setdefault(key, []).append(outs[key].detach().to("cpu", dtype))
+        targets.append(y.cpu())
+    model.train(was_training)
+
+    features = {key: torch.cat(feats) for key, feats in features.items()}
+    features["targets"] = torch.cat(targets)
+    return features
+
+
+class FeatureStore:
+    def __init__(self, root: Union[str, Path]):
+        """On-disk store of extracted features. Each set of features is a directory with one
+        .npy file per output, which is memory-mapped when loaded, and a metadata file.
+
+        Args:
+            root (Union[str, Path]): directory of the store.
+        """
+
+        self.root = Path(root)
+
+    def path(self, key: str) -> Path:
+        return self.root / key
+
+    def __contains__(self, key: str) -> bool:
+        # the metadata is written last, so it only exists if the features are complete
+        return (self.path(key) / "meta.json").exists()
+
+    def save(
+        self,
+        key: str,
+        features: Dict[str, torch.Tensor],
+        metadata: Optional[Dict[str, Any]] = None,
+    ):
+        """Saves a set of features. Floating point features are stored in float16.
+
+        Args:
+            key (str): key of the features.
+            features (Dict[str, torch.Tensor]): features of each output and targets.
+            metadata (Optional[Dict[str, Any]], optional): json serializable information
+                stored with the features. Defaults to None.
+        """
+
+        path = self.path(key)
+        tmp_path = path.with_name(f"{path.name}.tmp{os.getpid()}")
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        tmp_path.mkdir(parents=True)
+
+        shapes = {}
+        for name, tensor in features.items():
+            tensor = tensor.detach().cpu()
+            if tensor.is_floating_point():
+                tensor = tensor.half()
+            array = np.lib.format.open_memmap(
+                tmp_path / f"{name}.npy",
+                mode="w+",
+                dtype=tensor.numpy().dtype,
+                shape=tuple(tensor.shape),
+            )
+            array[:] = tensor.numpy()
+            array.flush()
+            del array
+            shapes[name] = list(tensor.shape)
+
+        with open(tmp_path / "meta.json", "w") as f:
+            json.dump({"shapes": shapes, **(metadata or {})}, f, indent=4)
+
+        # replaces a previous (e.g. partially written) set of features with the same key
+        shutil.rmtree(path, ignore_errors=True)
+        os.replace(tmp_path, path)
+
+    def load(self, key: str) -> Dict[str, torch.Tensor]:
+        """Loads a set of features. The tensors are copy-on-write memory maps of the files, so
+        they are only read from disk when accessed.
+
+        Args:
+            key (str): key of the features.
+
+        Returns:
+            Dict[str, torch.Tensor]: features of each output and targets.
+        """
+
+        path = self.path(key)
+        with open(path / "meta.json") as f:
+            metadata = json.load(f)
+        return {
+            name: torch.from_numpy(np.load(path / f"{name}.npy", mmap_mode="c"))
+            for name in metadata["shapes"]
+        }
+
+
+def extract_or_load_features(
+    loader: DataLoader,
+    model: nn.Module,
+    store: Optional[FeatureStore] = None,
+    key: Optional[str] = None,
+    num_views: int = 1,
+    **kwargs,
+) -> Dict[str, torch.Tensor]:
+    """Loads the features from the store if they were already extracted. Otherwise, extracts
+    and saves them.
+
+    Args:
+        loader (DataLoader): dataloader that yields batches of images and targets.
+        model (nn.Module): model used to extract the features.
+        store (Optional[FeatureStore], optional): feature store. The features are always
+            extracted when None. Defaults to None.
+        key (Optional[str], optional): key of the features in the store. Defaults to None.
+        num_views (int, optional): number of passes over the loader, whose features are
+            concatenated. With random transformations, each pass extracts a different
+            augmented view of every sample. Defaults to 1.
+        kwargs: extra arguments of extract_features.
+
+    Returns:
+        Dict[str, torch.Tensor]: features of each output and targets.
+    """
+
+    if store is not None:
+        assert key is not None, "A key is needed to use the feature store."
+        if key in store:
+            return store.load(key)
+
+    views = [extract_features(loader, model, **kwargs) for _ in range(num_views)]
+    features = {name: torch.cat([view[name] for view in views]) for name in views[0]}
+    if store is not None:
+        store.save(key, features)
+    return features
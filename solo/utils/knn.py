@@ -17,9 +17,10 @@
 # OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
 # DEALINGS IN THE SOFTWARE.
 
-from typing import Tuple
+from typing import List, Optional, Tuple
 
 import torch
+import torch.distributed as dist
 import torch.nn.functional as F
 from torchmetrics.metric import Metric
 
@@ -33,6 +34,9 @@ class WeightedKNNClassifier(Metric):
         distance_fx: str = "cosine",
         epsilon: float = 0.00001,
         dist_sync_on_step: bool = False,
+        streaming: bool = False,
+        offload_train_features: bool = False,
+        sharded: bool = False,
     ):
         """Implements the weighted k-NN classifier used for evaluation.
 
@@ -48,6 +52,21 @@ class WeightedKNNClassifier(Metric):
                 euclidean distance. Defaults to 0.00001.
             dist_sync_on_step (bool, optional): whether to sync distributed values at every
                 step. Defaults to False.
+            streaming (bool, optional): whether to stream the train features in chunks while
+                keeping a running top-k per test sample, instead of concatenating all of them.
+                The sorted neighbors can then be reused for several k and temperatures (see
+                compute_neighbors). The train features are still stored on their device and
+                gathered across processes as in the default mode, so this alone does not
+                reduce memory; use offload_train_features or sharded for that.
+                Defaults to False.
+            offload_train_features (bool, optional): whether to store the train features in
+                float16 on the cpu instead of on their device. Implies streaming. When
+                distributed, requires sharded. Defaults to False.
+            sharded (bool, optional): whether each process keeps its own train features
+                instead of gathering the train features of all processes. Each process then
+                computes the top-k of all the (gathered) test features over its shard and only
+                these k candidates per test sample are gathered and merged. Implies streaming.
+                Defaults to False.
         """
 
         super().__init__(dist_sync_on_step=dist_sync_on_step, compute_on_step=False)
@@ -57,12 +76,19 @@ class WeightedKNNClassifier(Metric):
         self.max_distance_matrix_size = max_distance_matrix_size
         self.distance_fx = distance_fx
         self.epsilon = epsilon
+        self.streaming = streaming or offload_train_features or sharded
+        self.offload_train_features = offload_train_features
+        self.sharded = sharded
 
         self.add_state("train_features", default=[], persistent=False)
         self.add_state("train_targets", default=[], persistent=False)
         self.add_state("test_features", default=[], persistent=False)
         self.add_state("test_targets", default=[], persistent=False)
 
+        # local train features are not metric states, so that they are never synced
+        self._local_train_features: List[torch.Tensor] = []
+        self._local_train_targets: List[torch.Tensor] = []
+
     def update(
         self,
         train_features: torch.Tensor = None,
@@ -84,14 +110,263 @@ class WeightedKNNClassifier(Metric):
 
         if train_features is not None:
             assert train_features.size(0) == train_targets.size(0)
-            self.train_features.append(train_features.detach())
-            self.train_targets.append(train_targets.detach())
+            if self.offload_train_features:
+                self._local_train_features.append(train_features.detach().to("cpu", torch.half))
+                self._local_train_targets.append(train_targets.detach().cpu())
+            elif self.sharded:
+                self._local_train_features.append(train_features.detach())
+                self._local_train_targets.append(train_targets.detach())
+            else:
+                self.train_features.append(train_features.detach())
+                self.train_targets.append(train_targets.detach())
 
         if test_features is not None:
             assert test_features.size(0) == test_targets.size(0)
             self.test_features.append(test_features.detach())
             self.test_targets.append(test_targets.detach())
 
+    def forward(self, *args, **kwargs):
+        """Only updates the memory banks. Metric.forward also resets the metric to compute it
+        on the current batch, which would drop the local train features of all the previous
+        batches and search the neighbors of every batch.
+        """
+
+        self.update(*args, **kwargs)
+
+    def reset(self):
+        super().reset()
+        self._local_train_features = []
+        self._local_train_targets = []
+
+    def _similarities(self, features: torch.Tensor, train_features: torch.Tensor) -> torch.Tensor:
+        if self.distance_fx == "cosine":
+            return torch.mm(features, train_features.t())
+        elif self.distance_fx == "euclidean":
+            return 1 / (torch.cdist(features, train_features) + self.epsilon)
+        raise NotImplementedError
+
+    def _streaming_topk(
+        self,
+        test_features: torch.Tensor,
+        train_features: List[torch.Tensor],
+        train_targets: List[torch.Tensor],
+        k: int,
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        """Computes the top-k neighbors of all test features, streaming the train features
+        chunk by chunk and merging each chunk into a running top-k.
+
+        Args:
+            test_features (torch.Tensor): test features.
+            train_features (List[torch.Tensor]): chunks of train features.
+            train_targets (List[torch.Tensor]): targets of each chunk of train features.
+            k (int): number of neighbors.
+
+        Returns:
+            Tuple[torch.Tensor, torch.Tensor]: similarities and targets of the top-k neighbors
+                of each test sample, sorted by similarity.
+        """
+
+        num_test_images = test_features.size(0)
+        device = test_features.device
+        top_similarities = torch.full((num_test_images, k), -float("inf"), device=device)
+        top_targets = torch.zeros(num_test_images, k, dtype=torch.long, device=device)
+
+        for chunk_features, chunk_targets in zip(train_features, train_targets):
+            chunk_features = chunk_features.to(device, non_blocking=True).float()
+            chunk_targets = chunk_targets.to(device, non_blocking=True)
+            if self.distance_fx == "cosine":
+                chunk_features = F.normalize(chunk_features)
+
+            test_chunk_size = max(1, self.max_distance_matrix_size // chunk_features.size(0))
+            for idx in range(0, num_test_images, test_chunk_size):
+                end = min(idx + test_chunk_size, num_test_images)
+                similarities = self._similarities(test_features[idx:end], chunk_features)
+                similarities = torch.cat((top_similarities[idx:end], similarities), dim=1)
+                candidates = torch.cat(
+                    (top_targets[idx:end], chunk_targets.view(1, -1).expand(end - idx, -1)),
+                    dim=1,
+                )
+                similarities, indices = similarities.topk(k, largest=True, sorted=True)
+                top_similarities[idx:end] = similarities
+                top_targets[idx:end] = torch.gather(candidates, 1, indices)
+
+        return top_similarities, top_targets
+
+    @staticmethod
+    def _merge_topk(
+        similarities: torch.Tensor, neighbors: torch.Tensor, k: int
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        """Merges the top-k neighbors computed by each process over its shard of the train
+        features. Only the (num_test, k) candidates of each process are gathered.
+
+        Args:
+            similarities (torch.Tensor): local top-k similarities of all test samples.
+            neighbors (torch.Tensor): targets of the local top-k neighbors.
+            k (int): number of neighbors.
+
+        Returns:
+            Tuple[torch.Tensor, torch.Tensor]: global top-k similarities and neighbors.
+        """
+
+        world_size = dist.get_world_size()
+        gathered_similarities = [torch.empty_like(similarities) for _ in range(world_size)]
+        gathered_neighbors = [torch.empty_like(neighbors) for _ in range(world_size)]
+        dist.all_gather(gathered_similarities, similarities.contiguous())
+        dist.all_gather(gathered_neighbors, neighbors.contiguous())
+
+        similarities, indices = torch.cat(gathered_similarities, dim=1).topk(
+            k, largest=True, sorted=True
+        )
+        neighbors = torch.gather(torch.cat(gathered_neighbors, dim=1), 1, indices)
+        return similarities, neighbors
+
+    def _vote(
+        self,
+        similarities: torch.Tensor,
+        neighbors: torch.Tensor,
+        targets: torch.Tensor,
+        num_classes: int,
+        T: float,
+    ) -> Tuple[float, float]:
+        """Weights the votes of the neighbors and counts the correct top-1 and top-5
+        predictions of a chunk of test samples."""
+
+        batch_size, k = neighbors.shape
+        retrieval_one_hot = torch.zeros(batch_size * k, num_classes, device=neighbors.device)
+        retrieval_one_hot.scatter_(1, neighbors.reshape(-1, 1), 1)
+
+        if self.distance_fx == "cosine":
+            similarities = similarities.clone().div_(T).exp_()
+
+        probs = torch.sum(
+            torch.mul(
+                retrieval_one_hot.view(batch_size, -1, num_classes),
+                similarities.view(batch_size, -1, 1),
+            ),
+            1,
+        )
+        _, predictions = probs.sort(1, True)
+
+        # find the predictions that match the target
+        correct = predictions.eq(targets.data.view(-1, 1))
+        top1 = correct.narrow(1, 0, 1).sum().item()
+        # top5 does not make sense if k < 5
+        top5 = correct.narrow(1, 0, min(5, k, correct.size(-1))).sum().item()
+        return top1, top5
+
+    @torch.no_grad()
+    def accuracy_from_neighbors(
+        self,
+        similarities: torch.Tensor,
+        neighbors: torch.Tensor,
+        targets: torch.Tensor,
+        k: Optional[int] = None,
+        T: Optional[float] = None,
+    ) -> Tuple[float, float]:
+        """Computes the weighted k-NN accuracy @1 and @5 from precomputed neighbors, e.g. the
+        output of compute_neighbors. Since the neighbors are sorted by similarity, any k
+        smaller than the number of neighbors and any temperature can be evaluated without
+        searching the neighbors again.
+
+        Args:
+            similarities (torch.Tensor): similarities of the sorted top-K neighbors of each
+                test sample, before the temperature.
+            neighbors (torch.Tensor): targets of the top-K neighbors of each test sample.
+            targets (torch.Tensor): test targets.
+            k (Optional[int]): number of neighbors to use. Defaults to all of them.
+            T (Optional[float]): temperature. Defaults to the one of the classifier.
+
+        Returns:
+            Tuple[float, float]: k-NN accuracy @1 and @5.
+        """
+
+        k = neighbors.size(1) if k is None else min(k, neighbors.size(1))
+        T = self.T if T is None else T
+        similarities = similarities[:, :k]
+        neighbors = neighbors[:, :k]
+
+        num_classes = torch.unique(targets).numel()
+        num_test_images = targets.size(0)
+        # the distance matrix is never materialized, so only the votes need to fit
+        chunk_size = min(
+            max(1, self.max_distance_matrix_size // (k * num_classes)), num_test_images
+        )
+
+        top1, top5 = 0.0, 0.0
+        for idx in range(0, num_test_images, chunk_size):
+            chunk_top1, chunk_top5 = self._vote(
+                similarities[idx : idx + chunk_size],
+                neighbors[idx : idx + chunk_size],
+                targets[idx : idx + chunk_size],
+                num_classes,
+                T,
+            )
+            top1 += chunk_top1
+            top5 += chunk_top5
+
+        return top1 * 100.0 / num_test_images, top5 * 100.0 / num_test_images
+
+    def _train_features(self) -> Tuple[List[torch.Tensor], List[torch.Tensor], int, bool]:
+        distributed = dist.is_available() and dist.is_initialized() and dist.get_world_size() > 1
+        if self.offload_train_features or self.sharded:
+            assert (
+                self.sharded or not distributed
+            ), "Offloaded train features can only be used across processes when sharded."
+            train_features_list = self._local_train_features
+            train_targets_list = self._local_train_targets
+        else:
+            train_features_list = self.train_features
+            train_targets_list = self.train_targets
+
+        num_train_images = sum(targets.size(0) for targets in train_targets_list)
+        if self.sharded and distributed:
+            # local shards may have different sizes, or even be empty
+            num_train_images = torch.tensor(num_train_images, device=self.device)
+            dist.all_reduce(num_train_images)
+            num_train_images = num_train_images.item()
+
+        return train_features_list, train_targets_list, num_train_images, distributed
+
+    @torch.no_grad()
+    def compute_neighbors(
+        self, k: Optional[int] = None
+    ) -> Optional[Tuple[torch.Tensor, torch.Tensor, torch.Tensor]]:
+        """Streams the stored train features to find the top-k neighbors of every stored test
+        sample, without computing any accuracy, so that they can be reused with
+        accuracy_from_neighbors for several k and temperatures.
+
+        Args:
+            k (Optional[int]): number of neighbors. Defaults to the k of the classifier.
+
+        Returns:
+            Optional[Tuple[torch.Tensor, torch.Tensor, torch.Tensor]]: the similarities and the
+                targets of the sorted top-k neighbors of each test sample, and the test
+                targets. None if there are no train or test features.
+        """
+
+        (
+            train_features_list,
+            train_targets_list,
+            num_train_images,
+            distributed,
+        ) = self._train_features()
+
+        if not num_train_images or not self.test_features:
+            return None
+
+        test_features = torch.cat(self.test_features)
+        test_targets = torch.cat(self.test_targets)
+        if self.distance_fx == "cosine":
+            test_features = F.normalize(test_features)
+
+        k = min(self.k if k is None else k, num_train_images)
+        similarities, neighbors = self._streaming_topk(
+            test_features, train_features_list, train_targets_list, k
+        )
+        if self.sharded and distributed:
+            similarities, neighbors = self._merge_topk(similarities, neighbors, k)
+        return similarities, neighbors, test_targets
+
     @torch.no_grad()
     def compute(self) -> Tuple[float]:
         """Computes weighted k-NN accuracy @1 and @5. If cosine distance is selected,
@@ -103,12 +378,23 @@ class WeightedKNNClassifier(Metric):
             Tuple[float]: k-NN accuracy @1 and @5.
         """
 
+        if self.streaming:
+            out = self.compute_neighbors()
+            # if compute is called without any features
+            if out is None:
+                return -1, -1
+            top1, top5 = self.accuracy_from_neighbors(*out)
+            self.reset()
+            return top1, top5
+
+        train_features_list, train_targets_list, num_train_images, _ = self._train_features()
+
         # if compute is called without any features
-        if not self.train_features or not self.test_features:
+        if not num_train_images or not self.test_features:
             return -1, -1
 
-        train_features = torch.cat(self.train_features)
-        train_targets = torch.cat(self.train_targets)
+        train_features = torch.cat(train_features_list)
+        train_targets = torch.cat(train_targets_list)
         test_features = torch.cat(self.test_features)
         test_targets = torch.cat(self.test_targets)
 
@@ -117,9 +403,7 @@ class WeightedKNNClassifier(Metric):
             test_features = F.normalize(test_features)
 
         num_classes = torch.unique(test_targets).numel()
-        num_train_images = train_targets.size(0)
         num_test_images = test_targets.size(0)
-        num_train_images = train_targets.size(0)
         chunk_size = min(
             max(1, self.max_distance_matrix_size // num_train_images),
             num_test_images,
@@ -127,7 +411,6 @@ class WeightedKNNClassifier(Metric):
         k = min(self.k, num_train_images)
 
         top1, top5, total = 0.0, 0.0, 0
-        retrieval_one_hot = torch.zeros(k, num_classes).to(train_features.device)
         for idx in range(0, num_test_images, chunk_size):
             # get the features for test images
             features = test_features[idx : min((idx + chunk_size), num_test_images), :]
@@ -135,39 +418,17 @@ class WeightedKNNClassifier(Metric):
             batch_size = targets.size(0)
 
             # calculate the dot product and compute top-k neighbors
-            if self.distance_fx == "cosine":
-                similarities = torch.mm(features, train_features.t())
-            elif self.distance_fx == "euclidean":
-                similarities = 1 / (torch.cdist(features, train_features) + self.epsilon)
-            else:
-                raise NotImplementedError
-
+            similarities = self._similarities(features, train_features)
             similarities, indices = similarities.topk(k, largest=True, sorted=True)
             candidates = train_targets.view(1, -1).expand(batch_size, -1)
             retrieved_neighbors = torch.gather(candidates, 1, indices)
 
-            retrieval_one_hot.resize_(batch_size * k, num_classes).zero_()
-            retrieval_one_hot.scatter_(1, retrieved_neighbors.view(-1, 1), 1)
-
-            if self.distance_fx == "cosine":
-                similarities = similarities.clone().div_(self.T).exp_()
-
-            probs = torch.sum(
-                torch.mul(
-                    retrieval_one_hot.view(batch_size, -1, num_classes),
-                    similarities.view(batch_size, -1, 1),
-                ),
-                1,
+            chunk_top1, chunk_top5 = self._vote(
+                similarities, retrieved_neighbors, targets, num_classes, self.T
             )
-            _, predictions = probs.sort(1, True)
-
-            # find the predictions that match the target
-            correct = predictions.eq(targets.data.view(-1, 1))
-            top1 = top1 + correct.narrow(1, 0, 1).sum().item()
-            top5 = (
-                top5 + correct.narrow(1, 0, min(5, k, correct.size(-1))).sum().item()
-            )  # top5 does not make sense if k < 5
-            total += targets.size(0)
+            top1 += chunk_top1
+            top5 += chunk_top5
+            total += batch_size
 
         top1 = top1 * 100.0 / total
         top5 = top5 * 100.0 / total
@@ -29,6 +29,8 @@ import torch.nn as nn
 from omegaconf import OmegaConf
 from timm.models.helpers import group_parameters
 from timm.optim.optim_factory import _layer_map
+from solo.data.compact_dataset import CompactImageFolder
+from solo.data.mmap_dataset import MMapDataset
 
 
 try:
@@ -252,7 +254,8 @@ def compute_dataset_size(
             [cifar10, cifar100, stl10]. Defaults to None.
         train (Optional[bool]): train dataset flag. Defaults to True.
         data_path (Optional[str]): path to the folder. Defaults to None.
-        data_format (Optional[str]): format of the data, either "image_folder" or "h5".
+        data_format (Optional[str]): format of the data, either "image_folder", "h5"
+            or "npy_mmap".
             Defaults to "image_folder".
         no_labels (Optional[bool]): if the dataset has no labels. Defaults to False.
         data_fraction (Optional[float]): amount of data to use. Defaults to -1.
@@ -275,13 +278,15 @@ def compute_dataset_size(
         assert _h5_available
         size = len(H5Dataset(dataset, data_path))
 
+    if data_format == "npy_mmap":
+        size = len(MMapDataset(data_path))
+
     if size is None:
         if no_labels:
             size = len(os.listdir(data_path))
         else:
-            size = sum(
-                len(os.listdir(os.path.join(data_path, class_))) for class_ in os.listdir(data_path)
-            )
+            # reuses the cached scan of the folder
+            size = len(CompactImageFolder(data_path))
 
     if data_fraction != -1:
         size = int(size * data_fraction)
@@ -60,6 +60,7 @@ def test_linear_parse_cfg():
     assert not OmegaConf.is_missing(cfg, "data.val_path")
     assert not OmegaConf.is_missing(cfg, "data.format")
     assert not OmegaConf.is_missing(cfg, "data.fraction")
+    assert not OmegaConf.is_missing(cfg, "data.ram_cache_dir")
 
     # assert lightning config is there
     assert not OmegaConf.is_missing(cfg, "seed")
@@ -85,6 +86,11 @@ def test_linear_parse_cfg():
     assert not OmegaConf.is_missing(cfg, "mixup")
     assert not OmegaConf.is_missing(cfg, "cutmix")
 
+    assert not OmegaConf.is_missing(cfg, "cached_features.enabled")
+    assert not OmegaConf.is_missing(cfg, "cached_features.num_views")
+    assert not OmegaConf.is_missing(cfg, "cached_features.dir")
+    assert not OmegaConf.is_missing(cfg, "cached_features.extraction_batch_size")
+
     assert not OmegaConf.is_missing(cfg, "transformer_kwargs")
     assert not OmegaConf.is_missing(cfg, "transformer_kwargs.drop_path")
     assert not OmegaConf.is_missing(cfg, "transformer_kwargs.global_pool")
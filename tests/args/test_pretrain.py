@@ -80,6 +80,7 @@ def test_pretrain_parse_cfg():
     assert not OmegaConf.is_missing(cfg, "data.format")
     assert not OmegaConf.is_missing(cfg, "data.no_labels")
     assert not OmegaConf.is_missing(cfg, "data.fraction")
+    assert not OmegaConf.is_missing(cfg, "data.ram_cache_dir")
     assert not OmegaConf.is_missing(cfg, "debug_augmentations")
 
     # assert lightning config is there
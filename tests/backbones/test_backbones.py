@@ -41,6 +41,7 @@ from solo.backbones import (
     wide_resnet28w2,
     wide_resnet28w8,
 )
+from solo.backbones.vit.vit import BlockTap
 
 
 def test_backbones():
@@ -148,3 +149,30 @@ def test_backbones():
     dummy_data = torch.randn(6, 3, 224, 224)
     model = resnet50(method=None)
     assert isinstance(model(dummy_data), torch.Tensor)
+
+
+def test_vit_block_taps():
+    dummy_data = torch.randn(6, 3, 32, 32)
+
+    # taps computed inside the mae encoder
+    model = vit_tiny(method="mae", patch_size=8, img_size=32).eval()
+    model.set_tapped_blocks([11, 3])
+    torch.manual_seed(0)
+    feats, _, _, block_feats = model.forward_encoder(dummy_data, 0)
+    assert sorted(block_feats) == [3, 11]
+    assert block_feats[3].size() == (6, 192)
+    model.set_tapped_blocks([])
+    torch.manual_seed(0)
+    untapped_feats, _, _, untapped_block_feats = model.forward_encoder(dummy_data, 0)
+    assert torch.allclose(feats, untapped_feats, atol=1e-6) and untapped_block_feats == {}
+
+    # persistent hooks on the default vit
+    model = vit_tiny(method=None, patch_size=8, img_size=32).eval()
+    tap = BlockTap(model, [3, 11])
+    model(dummy_data)
+    block_feats = tap.pop()
+    assert sorted(block_feats) == [3, 11] and block_feats[11].size() == (6, 192)
+    assert tap.pop() == {}
+    tap.remove()
+    model(dummy_data)
+    assert tap.pop() == {}
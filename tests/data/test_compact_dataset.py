@@ -0,0 +1,73 @@
+# Copyright 2023 solo-learn development team.
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in
+# the Software without restriction, including without limitation the rights to use,
+# copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the
+# Software, and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all copies
+# or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR
+# PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE
+# FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR
+# OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+
+import os
+
+import numpy as np
+import pytest
+from PIL import Image
+from solo.data.compact_dataset import CompactImageFolder
+from solo.utils.misc import compute_dataset_size
+from torchvision.datasets import ImageFolder
+
+
+def _save_image(path):
+    im = np.random.rand(8, 8, 3) * 255
+    Image.fromarray(im.astype("uint8")).save(path)
+
+
+def test_compact_image_folder(tmp_path, monkeypatch):
+    folder = tmp_path / "images"
+    cache_dir = str(tmp_path / "cache")
+    for class_name in ["b", "a"]:
+        (folder / class_name / "nested").mkdir(parents=True)
+        for name in ["2.png", "10.jpg", "nested/1.png"]:
+            _save_image(folder / class_name / name)
+    (folder / "a" / "notes.txt").write_text("not an image")
+
+    dataset = CompactImageFolder(folder, transform=np.asarray, cache_dir=cache_dir)
+    reference = ImageFolder(str(folder), transform=np.asarray)
+    assert dataset.classes == reference.classes
+    assert dataset.class_to_idx == reference.class_to_idx
+    assert dataset.samples == reference.samples
+    assert len(dataset) == len(reference) == 6
+    for i in range(len(dataset)):
+        x, y = dataset[i]
+        x_ref, y_ref = reference[i]
+        assert y == y_ref
+        np.testing.assert_array_equal(x, x_ref)
+
+    # the manifest is reused without scanning the folder again
+    assert len(os.listdir(cache_dir)) == 1
+    with monkeypatch.context() as m:
+        m.setattr(CompactImageFolder, "_scan", lambda self: pytest.fail("folder was scanned"))
+        cached = CompactImageFolder(folder, cache_dir=cache_dir)
+        assert cached.samples == dataset.samples
+
+    assert compute_dataset_size(data_path=str(folder)) == 6
+    os.remove(CompactImageFolder(folder)._manifest_path)
+
+    # adding a file to a nested folder invalidates it
+    _save_image(folder / "b" / "nested" / "0.png")
+    assert len(CompactImageFolder(folder, cache_dir=cache_dir)) == 7
+
+    # subsets can still be assigned through samples
+    dataset.samples = dataset.samples[::2]
+    assert dataset.samples == reference.samples[::2]
+    assert dataset.targets.tolist() == [y for _, y in reference.samples[::2]]
@@ -0,0 +1,93 @@
+# Copyright 2023 solo-learn development team.
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in
+# the Software without restriction, including without limitation the rights to use,
+# copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the
+# Software, and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all copies
+# or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR
+# PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE
+# FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR
+# OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+
+import hashlib
+import os
+
+import h5py
+import numpy as np
+from PIL import Image
+from solo.data.h5_dataset import H5Dataset, convert_imgfolder_to_h5
+from solo.data.pretrain_dataloader import dataset_with_index
+from torch.utils.data import DataLoader
+
+
+def _make_folder(folder):
+    for class_name, sizes in [("a", [(40, 30), (20, 50)]), ("b", [(64, 64), (33, 47), (16, 16)])]:
+        (folder / class_name).mkdir(parents=True)
+        for i, (w, h) in enumerate(sizes):
+            im = np.random.rand(h, w, 3) * 255
+            Image.fromarray(im.astype("uint8")).save(folder / class_name / f"{i}.png")
+
+
+def test_h5_layouts(tmp_path):
+    folder = tmp_path / "images"
+    _make_folder(folder)
+
+    blob_path = str(tmp_path / "blob.h5")
+    groups_path = str(tmp_path / "groups.h5")
+    convert_imgfolder_to_h5(str(folder), blob_path, layout="blob")
+    convert_imgfolder_to_h5(str(folder), groups_path, layout="groups", compression="gzip")
+
+    # files without embedded index are walked once and cached under the home folder
+    legacy_path = str(tmp_path / "legacy.h5")
+    convert_imgfolder_to_h5(str(folder), legacy_path, layout="groups")
+    with h5py.File(legacy_path, "r+") as h5_file:
+        del h5_file["index"]
+        del h5_file.attrs["layout"]
+
+    blob = H5Dataset("imagenet", blob_path)
+    groups = H5Dataset("imagenet", groups_path)
+    legacy = H5Dataset("imagenet", legacy_path)
+    cache_file = os.path.join(
+        os.path.expanduser("~"),
+        ".cache",
+        "solo-learn",
+        "h5",
+        f"legacy-{hashlib.sha1(legacy_path.encode()).hexdigest()[:16]}.txt",
+    )
+    assert os.path.isfile(cache_file)
+    cached_legacy = H5Dataset("imagenet", legacy_path)
+    os.remove(cache_file)
+
+    assert blob.layout == "blob" and groups.layout == legacy.layout == "groups"
+    for dataset in [groups, legacy, cached_legacy]:
+        assert dataset.classes == blob.classes == ["a", "b"]
+        np.testing.assert_array_equal(dataset._data, blob._data)
+    assert blob._data["label"].tolist() == [0, 0, 1, 1, 1]
+
+    for i, (img_name, class_id, y, _) in enumerate(blob._data.tolist()):
+        for dataset in [blob, groups, legacy]:
+            x, target = dataset[i]
+            assert target == y
+            path = folder / blob.classes[class_id] / img_name.decode()
+            expected = Image.open(path).convert("RGB")
+            np.testing.assert_array_equal(np.asarray(x), np.asarray(expected))
+
+    # batched fetches return the same samples in the requested order
+    indices = [4, 1, 2, 1, 0]
+    batch = blob.__getitems__(indices)
+    for index, (x, y) in zip(indices, batch):
+        np.testing.assert_array_equal(np.asarray(x), np.asarray(blob[index][0]))
+        assert y == blob[index][1]
+
+    dataset = dataset_with_index(H5Dataset)("imagenet", blob_path, transform=np.asarray)
+    loader = DataLoader(dataset, batch_size=5, collate_fn=lambda batch: batch)
+    batch = next(iter(loader))
+    assert [index for index, _, _ in batch] == list(range(5))
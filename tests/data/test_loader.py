@@ -0,0 +1,91 @@
+# Copyright 2023 solo-learn development team.
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in
+# the Software without restriction, including without limitation the rights to use,
+# copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the
+# Software, and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all copies
+# or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR
+# PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE
+# FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR
+# OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+
+import torch
+from solo.data.classification_dataloader import prepare_dataloaders
+from solo.data.loader import ChannelsLastCollate, dataloader_kwargs
+from solo.data.pretrain_dataloader import prepare_dataloader
+from solo.data.sampler import ResumableDistributedSampler
+from torch.utils.data import SequentialSampler, TensorDataset
+
+
+def test_dataloader_kwargs():
+    kwargs = dataloader_kwargs(0, persistent_workers=True, prefetch_factor=4)
+    assert "persistent_workers" not in kwargs
+    assert "prefetch_factor" not in kwargs
+
+    kwargs = dataloader_kwargs(2, persistent_workers=True, prefetch_factor=4, channels_last=True)
+    assert kwargs["persistent_workers"]
+    assert kwargs["prefetch_factor"] == 4
+    assert isinstance(kwargs["collate_fn"], ChannelsLastCollate)
+    # pinning is left to the dataloader when collating in the workers
+    assert not kwargs["collate_fn"].pin_memory
+
+
+def test_channels_last_collate():
+    collate_fn = ChannelsLastCollate()
+    batch = collate_fn([(i, [torch.randn(3, 8, 8), torch.randn(3, 4, 4)], 0) for i in range(4)])
+    idxs, X, targets = batch
+    assert idxs.size() == targets.size() == (4,)
+    for x in X:
+        assert x.is_contiguous(memory_format=torch.channels_last)
+
+
+def test_loaders():
+    dataset = TensorDataset(torch.randn(10, 3, 8, 8), torch.zeros(10).long())
+
+    loader = prepare_dataloader(
+        dataset,
+        batch_size=4,
+        num_workers=0,
+        pin_memory=False,
+        channels_last=True,
+        sampler=SequentialSampler(dataset),
+    )
+    assert len(loader) == 2
+    x, _ = next(iter(loader))
+    assert x.is_contiguous(memory_format=torch.channels_last)
+    assert torch.equal(x, dataset.tensors[0][:4])
+
+    train_loader, val_loader = prepare_dataloaders(
+        dataset,
+        dataset,
+        batch_size=4,
+        num_workers=1,
+        pin_memory=False,
+        persistent_workers=True,
+        prefetch_factor=4,
+    )
+    assert train_loader.persistent_workers and val_loader.persistent_workers
+    assert train_loader.prefetch_factor == val_loader.prefetch_factor == 4
+    assert len(train_loader) == 2 and len(val_loader) == 3
+
+    # with Lightning's sampler injection disabled, each process only validates its shard
+    val_samplers = [
+        ResumableDistributedSampler(dataset, shuffle=False, num_replicas=2, rank=rank)
+        for rank in range(2)
+    ]
+    shards = [
+        prepare_dataloaders(
+            dataset, dataset, batch_size=4, num_workers=0, pin_memory=False, val_sampler=sampler
+        )[1]
+        for sampler in val_samplers
+    ]
+    assert [len(val_loader) for val_loader in shards] == [2, 2]
+    assert sorted(idx for sampler in val_samplers for idx in sampler) == list(range(10))
@@ -18,18 +18,30 @@
 # DEALINGS IN THE SOFTWARE.
 
 import numpy as np
+import torch
 from PIL import Image
+from solo.data.batched_augmentations import (
+    BatchedAugmentationCollate,
+    MultiCropBatchedAugmentation,
+)
+from solo.data.mmap_dataset import MMapDataset, convert_imgfolder_to_mmap
 from solo.data.pretrain_dataloader import (
     FullTransformPipeline,
+    MAETargetPipeline,
+    MultiCropGenerator,
     NCropAugmentation,
+    build_batched_transform_pipeline,
     build_transform_pipeline,
     prepare_dataloader,
     prepare_datasets,
+    prepare_multicrop_generator,
     prepare_n_crop_transform,
 )
 from torch.utils.data import DataLoader
 from torchvision.datasets.cifar import CIFAR10
 from omegaconf import OmegaConf
+from solo.losses.mae import normalize_patches, patchify
+from solo.utils.misc import compute_dataset_size
 
 
 def test_transforms():
@@ -124,6 +136,124 @@ def test_transforms():
     for crop, size in zip(crops, sizes):
         assert crop.size(1) == size
 
+    # reconstruction targets of mae for the large crops
+    for norm_pix_loss in [False, True]:
+        out = MAETargetPipeline(transform, 2, 16, norm_pix_loss)(im)
+        assert len(out) == 2 + 6 + 2
+        for crop, target in zip(out[:2], out[-2:]):
+            expected = patchify(crop.unsqueeze(0), 16)[0]
+            if norm_pix_loss:
+                expected = normalize_patches(expected)
+            assert target.size() == (14 * 14, 16 * 16 * 3)
+            assert torch.allclose(target, expected)
+
+
+def test_batched_transforms():
+    cfg = OmegaConf.create(
+        {
+            "crop_size": 32,
+            "rrc": {"enabled": True, "crop_min_scale": 0.08, "crop_max_scale": 1.0},
+            "color_jitter": {
+                "prob": 0.8,
+                "brightness": 0.5,
+                "contrast": 0.5,
+                "saturation": 0.4,
+                "hue": 0.2,
+            },
+            "grayscale": {"prob": 0.5},
+            "gaussian_blur": {"prob": 0.5},
+            "solarization": {"prob": 0.2},
+            "equalization": {"prob": 0.2},
+            "horizontal_flip": {"prob": 0.5},
+            "num_crops": 2,
+        }
+    )
+
+    im = np.random.rand(100, 100, 3) * 255
+    im = Image.fromarray(im.astype("uint8")).convert("RGB")
+
+    T, batched_aug = build_batched_transform_pipeline("cifar10", cfg)
+    crop = T(im)
+    assert crop.dtype == torch.uint8
+    assert crop.size() == (3, 32, 32)
+
+    collate_fn = BatchedAugmentationCollate(MultiCropBatchedAugmentation([batched_aug] * 2))
+    transform = prepare_n_crop_transform([T], num_crops_per_aug=[2])
+    batch = collate_fn([(i, transform(im), 0) for i in range(8)])
+    assert len(batch[1]) == 2
+    for X in batch[1]:
+        assert X.dtype == torch.float32
+        assert X.size() == (8, 3, 32, 32)
+        assert torch.isfinite(X).all()
+
+    # with no random augmentation, only the normalization is applied
+    cfg.color_jitter.prob = 0.0
+    cfg.grayscale.prob = 0.0
+    cfg.gaussian_blur.prob = 0.0
+    cfg.solarization.prob = 0.0
+    cfg.equalization.prob = 0.0
+    cfg.horizontal_flip.prob = 0.0
+    _, batched_aug = build_batched_transform_pipeline("cifar10", cfg)
+    x = torch.randint(0, 256, (4, 3, 32, 32), dtype=torch.uint8)
+    expected = (x.float() / 255 - batched_aug.mean) / batched_aug.std
+    assert torch.allclose(batched_aug(x), expected)
+
+    # always grayscale and flipped
+    cfg.grayscale.prob = 1.0
+    cfg.horizontal_flip.prob = 1.0
+    _, batched_aug = build_batched_transform_pipeline("custom", cfg)
+    out = batched_aug(x) * batched_aug.std + batched_aug.mean
+    assert torch.allclose(out[:, 0], out[:, 1], atol=1e-5)
+    assert torch.allclose(out[:, 1], out[:, 2], atol=1e-5)
+    gray = (0.299 * x[:, 0] + 0.587 * x[:, 1] + 0.114 * x[:, 2]).float() / 255
+    assert torch.allclose(out[:, 0], gray.flip(-1), atol=1e-5)
+
+
+def test_multicrop_generator():
+    cfg = OmegaConf.create(
+        {
+            "crop_size": 224,
+            "rrc": {"enabled": True, "crop_min_scale": 0.14, "crop_max_scale": 1.0},
+            "num_crops": 2,
+        }
+    )
+    cfg_small = OmegaConf.create(
+        {
+            "crop_size": 96,
+            "rrc": {"enabled": True, "crop_min_scale": 0.05, "crop_max_scale": 0.14},
+            "num_crops": 6,
+        }
+    )
+
+    im = np.random.rand(150, 200, 3) * 255
+    im = Image.fromarray(im.astype("uint8")).convert("RGB")
+
+    T = prepare_multicrop_generator("imagenet100", [cfg, cfg_small])
+    crops = T(im)
+    sizes = [224] * 2 + [96] * 6
+    assert len(crops) == len(sizes)
+    for crop, size in zip(crops, sizes):
+        assert crop.dtype == torch.uint8
+        assert crop.size() == (3, size, size)
+
+    boxes = T.sample_boxes(150, 200)
+    w = boxes[:, 2] - boxes[:, 0]
+    h = boxes[:, 3] - boxes[:, 1]
+    assert (boxes[:, :2] >= 0).all() and (boxes[:, 2] <= 200).all() and (boxes[:, 3] <= 150).all()
+    assert (w * h <= 150 * 200).all()
+
+    # a crop covering the whole of a constant image is constant
+    T = MultiCropGenerator([8], [1], [(1.0, 1.0)], ratio=(200 / 150, 200 / 150))
+    x = torch.full((3, 150, 200), 7, dtype=torch.uint8)
+    assert (T(x)[0] == 7).all()
+
+    # normalized crops
+    T = prepare_multicrop_generator("imagenet100", [cfg, cfg_small], normalize=True)
+    crops = T(im)
+    for crop, size in zip(crops, sizes):
+        assert crop.dtype == torch.float32
+        assert crop.size() == (3, size, size)
+
 
 def test_data():
     kwargs = dict(
@@ -174,3 +304,35 @@ def test_data():
 
     assert isinstance(train_loader, DataLoader)
     assert num_batches_train == len(train_loader)
+
+
+def test_npy_mmap(tmp_path):
+    folder = tmp_path / "images"
+    for class_name, sizes in [("a", [(40, 30), (20, 50)]), ("b", [(64, 64), (33, 47), (50, 20)])]:
+        (folder / class_name).mkdir(parents=True)
+        for i, (w, h) in enumerate(sizes):
+            im = np.random.rand(h, w, 3) * 255
+            Image.fromarray(im.astype("uint8")).save(folder / class_name / f"{i}.png")
+
+    output = tmp_path / "mmap"
+    num_images, num_classes = convert_imgfolder_to_mmap(folder, output, size=16, num_workers=0)
+    assert (num_images, num_classes) == (5, 2)
+    assert compute_dataset_size(data_path=output, data_format="npy_mmap") == 5
+
+    T = NCropAugmentation(lambda x: torch.from_numpy(np.asarray(x).copy()), 2)
+    train_dataset = prepare_datasets(
+        "imagenet100", T, train_data_path=output, data_format="npy_mmap"
+    )
+    assert isinstance(train_dataset, MMapDataset)
+    assert train_dataset.classes == ["a", "b"]
+    assert train_dataset.targets.tolist() == [0, 0, 1, 1, 1]
+
+    index, crops, y = train_dataset[3]
+    assert index == 3 and y == 1
+    assert len(crops) == 2 and crops[0].shape == (16, 16, 3) and crops[0].dtype == torch.uint8
+    assert train_dataset.images is not None
+    # the memory map is not pickled, workers open it themselves
+    assert train_dataset.__getstate__()["images"] is None
+
+    train_loader = prepare_dataloader(train_dataset, batch_size=2, num_workers=0)
+    assert len(train_loader) == 2
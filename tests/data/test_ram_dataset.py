@@ -0,0 +1,66 @@
+# Copyright 2023 solo-learn development team.
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in
+# the Software without restriction, including without limitation the rights to use,
+# copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the
+# Software, and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all copies
+# or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR
+# PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE
+# FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR
+# OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+
+import os
+
+import numpy as np
+from PIL import Image
+from solo.data.ram_dataset import RAMImageFolder
+
+
+def _make_folder(folder):
+    for class_name, sizes in [("a", [(40, 30), (20, 50)]), ("b", [(64, 64), (33, 47)])]:
+        (folder / class_name).mkdir(parents=True)
+        for i, (w, h) in enumerate(sizes):
+            im = np.random.rand(h, w, 3) * 255
+            Image.fromarray(im.astype("uint8")).save(folder / class_name / f"{i}.png")
+
+
+def test_ram_image_folder(tmp_path):
+    folder = tmp_path / "images"
+    cache_dir = tmp_path / "cache"
+    _make_folder(folder)
+
+    dataset = RAMImageFolder(str(folder), num_workers=2, cache_dir=str(cache_dir))
+    assert len(dataset) == 4
+    assert dataset.targets == [0, 0, 1, 1]
+    for i, (path, y) in enumerate(dataset.imgs):
+        x, target = dataset[i]
+        assert target == y
+        np.testing.assert_array_equal(np.asarray(x), np.asarray(Image.open(path).convert("RGB")))
+
+    # the decoded images are mapped from the cache instead of copied into the process
+    assert isinstance(dataset.loaded_imgs.pixels, np.memmap)
+
+    # the second run reads the decoded dataset from the cache
+    assert len(os.listdir(cache_dir)) == 2
+    cached = RAMImageFolder(str(folder), num_workers=0, cache_dir=str(cache_dir))
+    np.testing.assert_array_equal(cached.loaded_imgs.pixels, dataset.loaded_imgs.pixels)
+
+    # modifying a file invalidates the cache
+    Image.fromarray(np.zeros((8, 8, 3), dtype=np.uint8)).save(folder / "a" / "0.png")
+    modified = RAMImageFolder(str(folder), num_workers=0, cache_dir=str(cache_dir))
+    assert len(os.listdir(cache_dir)) == 4
+    assert modified[0][0].size == (8, 8)
+
+    # without cache, the mapped file is already unlinked but stays readable
+    uncached = RAMImageFolder(str(folder), num_workers=0, cache_dir=None)
+    assert isinstance(uncached.loaded_imgs.pixels, np.memmap)
+    assert not os.path.exists(uncached.loaded_imgs.pixels.filename)
+    np.testing.assert_array_equal(uncached.loaded_imgs.pixels, modified.loaded_imgs.pixels)
@@ -0,0 +1,62 @@
+# Copyright 2023 solo-learn development team.
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in
+# the Software without restriction, including without limitation the rights to use,
+# copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the
+# Software, and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all copies
+# or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR
+# PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE
+# FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR
+# OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+
+import torch
+from solo.data.sampler import ResumableDistributedSampler
+from torch.utils.data import TensorDataset
+
+
+def test_resumable_sampler():
+    dataset = TensorDataset(torch.arange(10))
+
+    samplers = [ResumableDistributedSampler(dataset, num_replicas=2, rank=r) for r in range(2)]
+    shards = [list(sampler) for sampler in samplers]
+    assert all(len(shard) == len(sampler) == 5 for shard, sampler in zip(shards, samplers))
+    assert sorted(shards[0] + shards[1]) == list(range(10))
+
+    # deterministic given the seed and the epoch
+    sampler = samplers[0]
+    assert list(sampler) == shards[0]
+    sampler.set_epoch(1)
+    epoch_1 = list(sampler)
+    assert epoch_1 != shards[0]
+
+    # padded to be evenly divisible
+    sampler = ResumableDistributedSampler(TensorDataset(torch.arange(9)), num_replicas=2, rank=1)
+    assert len(sampler) == len(list(sampler)) == 5
+
+    # resume in the middle of epoch 1
+    sampler = ResumableDistributedSampler(dataset, num_replicas=2, rank=0)
+    sampler.set_epoch(1)
+    iter(sampler)
+    state = sampler.state_dict(num_consumed=3)
+    assert state["epoch"] == 1 and state["position"] == 3
+
+    resumed = ResumableDistributedSampler(dataset, num_replicas=2, rank=0)
+    resumed.load_state_dict(state)
+    resumed.set_epoch(1)
+    assert len(resumed) == 5
+    assert list(resumed) == epoch_1[3:]
+    # the position is only used once
+    assert list(resumed) == epoch_1
+
+    # the position is discarded for other epochs
+    resumed.load_state_dict(state)
+    resumed.set_epoch(2)
+    assert len(list(resumed)) == 5
@@ -0,0 +1,71 @@
+# Copyright 2023 solo-learn development team.
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in
+# the Software without restriction, including without limitation the rights to use,
+# copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the
+# Software, and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all copies
+# or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR
+# PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE
+# FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR
+# OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+
+import numpy as np
+import torch
+from solo.data.pretrain_dataloader import dataset_with_index
+from solo.data.subset import (
+    IndexedSubset,
+    get_targets,
+    stratified_subset,
+    stratified_subset_indices,
+)
+from torch.utils.data import TensorDataset
+
+
+class LabeledTensorDataset(TensorDataset):
+    @property
+    def targets(self):
+        return self.tensors[1].tolist()
+
+
+def test_stratified_subset_indices():
+    targets = np.repeat(np.arange(4), [100, 50, 30, 7])
+
+    idxs = stratified_subset_indices(targets, 0.3)
+    assert len(idxs) == int(len(targets) * 0.3)
+    assert len(np.unique(idxs)) == len(idxs)
+    assert np.all(np.diff(idxs) > 0)
+    counts = np.bincount(targets[idxs], minlength=4)
+    assert np.all(np.abs(counts - np.array([100, 50, 30, 7]) * 0.3) < 1)
+
+    # seedable
+    assert np.array_equal(idxs, stratified_subset_indices(targets, 0.3))
+    assert not np.array_equal(idxs, stratified_subset_indices(targets, 0.3, seed=0))
+
+    # without labels
+    idxs = stratified_subset_indices(None, 0.25, num_samples=10)
+    assert len(idxs) == 2
+
+
+def test_stratified_subset():
+    dataset = LabeledTensorDataset(torch.randn(20, 3), torch.arange(20) % 2)
+    assert np.array_equal(get_targets(dataset), np.arange(20) % 2)
+    assert get_targets(TensorDataset(torch.randn(20, 3))) is None
+
+    subset = stratified_subset(dataset, 0.5)
+    assert len(subset) == 10
+    assert sum(y.item() for _, y in subset) == 5
+
+    # indexes refer to the subset
+    dataset = dataset_with_index(LabeledTensorDataset)(torch.randn(20, 3), torch.arange(20) % 2)
+    subset = stratified_subset(dataset, 0.5, subset_class=IndexedSubset)
+    assert [index for index, _, _ in subset] == list(range(10))
+    for index, x, _ in subset.__getitems__([3, 1]):
+        assert torch.equal(x, dataset[subset.indices[index]][1])
@@ -0,0 +1,43 @@
+# Copyright 2023 solo-learn development team.
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in
+# the Software without restriction, including without limitation the rights to use,
+# copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the
+# Software, and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all copies
+# or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR
+# PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE
+# FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR
+# OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+
+import torch
+from solo.losses import mae_loss_func
+
+
+def test_mae_loss():
+    b, tokens, patch_size = 8, 16, 8
+    imgs = torch.randn(b, 3, 32, 32)
+    pred = torch.randn(b, tokens, patch_size**2 * 3, requires_grad=True)
+
+    # 12 out of the 16 patches of each image are masked
+    ids_shuffle = torch.argsort(torch.rand(b, tokens), dim=1)
+    ids_masked = ids_shuffle[:, 4:]
+    mask = torch.zeros(b, tokens).scatter_(1, ids_masked, 1.0)
+
+    for norm_pix_loss in [False, True]:
+        loss = mae_loss_func(imgs, pred, mask, patch_size, norm_pix_loss=norm_pix_loss)
+        assert loss.requires_grad and loss > 0
+
+        # predicting only the masked patches gives the same loss
+        masked_pred = torch.gather(pred, 1, ids_masked.unsqueeze(-1).expand(-1, -1, pred.size(-1)))
+        masked_loss = mae_loss_func(
+            imgs, masked_pred, mask, patch_size, norm_pix_loss=norm_pix_loss, ids_masked=ids_masked
+        )
+        assert torch.allclose(loss, masked_loss, atol=1e-5)
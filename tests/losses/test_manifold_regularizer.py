@@ -0,0 +1,202 @@
+# Copyright 2023 solo-learn development team.
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in
+# the Software without restriction, including without limitation the rights to use,
+# copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the
+# Software, and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all copies
+# or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR
+# PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE
+# FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR
+# OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+
+import torch
+from solo.losses.manifold_regularizer import ManifoldRegularizer
+
+
+def test_manifold_regularizer_loss():
+    b, f = 32, 64
+    x = torch.randn(b, f).requires_grad_()
+    y = torch.randn(b, f).requires_grad_()
+
+    regularizer = ManifoldRegularizer()
+    loss, metrics = regularizer.manifold_regularizer_loss(x, y)
+    initial_loss = loss.item()
+    assert loss != 0
+    assert "gamma" in metrics
+
+    for _ in range(20):
+        loss, _ = regularizer.manifold_regularizer_loss(x, y)
+        loss.backward()
+
+        y.data.add_(-0.5 * y.grad)
+
+        x.grad = y.grad = None
+
+    assert loss < initial_loss
+
+
+def test_distributed_manifold_regularizer_loss():
+    b, f = 32, 64
+    x = torch.randn(b, f, requires_grad=True)
+    y = torch.randn(b, f, requires_grad=True)
+
+    for scale_euclidean_distance in [False, True]:
+        loss, metrics = ManifoldRegularizer(
+            scale_euclidean_distance=scale_euclidean_distance
+        ).manifold_regularizer_loss(x, y)
+        dist_loss, dist_metrics = ManifoldRegularizer(
+            scale_euclidean_distance=scale_euclidean_distance, distributed=True
+        ).manifold_regularizer_loss(x, y)
+        assert torch.allclose(loss, dist_loss, atol=1e-5)
+        assert torch.allclose(metrics["gamma"], dist_metrics["gamma"], atol=1e-4)
+
+    grad_x, grad_y = torch.autograd.grad(loss, (x, y))
+    dist_grad_x, dist_grad_y = torch.autograd.grad(dist_loss, (x, y))
+    assert torch.allclose(grad_x, dist_grad_x, atol=1e-5)
+    assert torch.allclose(grad_y, dist_grad_y, atol=1e-5)
+
+
+def test_chunked_manifold_regularizer_loss():
+    b, f = 30, 64
+    x = torch.randn(b, f, requires_grad=True)
+    y = torch.randn(b, f, requires_grad=True)
+
+    for scale_euclidean_distance in [False, True]:
+        for fixed_gamma in [None, 50.0]:
+            loss, metrics = ManifoldRegularizer(
+                scale_euclidean_distance=scale_euclidean_distance
+            ).manifold_regularizer_loss(x, y, fixed_gamma=fixed_gamma)
+            # 8 does not divide the batch, so the last block is smaller
+            chunked_loss, chunked_metrics = ManifoldRegularizer(
+                scale_euclidean_distance=scale_euclidean_distance, chunk_size=8
+            ).manifold_regularizer_loss(x, y, fixed_gamma=fixed_gamma)
+            assert torch.allclose(loss, chunked_loss, atol=1e-5)
+            assert torch.allclose(metrics["gamma"], chunked_metrics["gamma"], atol=1e-4)
+
+            grad_x, grad_y = torch.autograd.grad(loss, (x, y))
+            chunked_grad_x, chunked_grad_y = torch.autograd.grad(chunked_loss, (x, y))
+            assert torch.allclose(grad_x, chunked_grad_x, atol=1e-5)
+            assert torch.allclose(grad_y, chunked_grad_y, atol=1e-5)
+
+    # the calls that log spectral metrics still build the full laplacian
+    _, metrics = ManifoldRegularizer(return_metrics=True, chunk_size=8).manifold_regularizer_loss(
+        x, y
+    )
+    assert "Spectral gap" in metrics
+
+
+def test_manifold_regularizer_matches_dense():
+    b, f = 32, 64
+    x = torch.randn(b, f)
+    y = torch.randn(b, f)
+
+    sq_dist = ((x.view(b, 1, f) - x.view(1, b, f)) ** 2).sum(-1)
+    weights = torch.exp(-sq_dist / sq_dist[sq_dist != 0].std()) * (1 - torch.eye(b))
+    isqrt_diag = 1.0 / torch.sqrt(1e-4 + weights.sum(dim=-1))
+    laplacian = torch.eye(b) - weights * isqrt_diag[None, :] * isqrt_diag[:, None]
+    dense_loss = torch.trace(y.T @ laplacian @ y) / (b**2)
+
+    loss, _ = ManifoldRegularizer().manifold_regularizer_loss(x, y)
+    assert torch.allclose(loss, dense_loss, atol=1e-5)
+
+
+def test_batched_manifold_regularizer_loss():
+    l, b, f = 4, 32, 64
+    xs = torch.randn(l, b, f)
+    y = torch.randn(b, f)
+
+    for distributed in [False, True]:
+        regularizer = ManifoldRegularizer(scale_euclidean_distance=True, distributed=distributed)
+        losses, metrics = regularizer.batched_manifold_regularizer_loss(xs, y, rbf_scale=0.5)
+        assert losses.size() == (l,) and metrics["gamma"].size() == (l,)
+        for i in range(l):
+            loss, layer_metrics = ManifoldRegularizer(
+                scale_euclidean_distance=True
+            ).manifold_regularizer_loss(xs[i], y, rbf_scale=0.5)
+            assert torch.allclose(losses[i], loss, atol=1e-5)
+            assert torch.allclose(metrics["gamma"][i], layer_metrics["gamma"], atol=1e-4)
+
+
+def test_manifold_regularizer_metrics():
+    b, f = 32, 64
+    x = torch.randn(b, f)
+    y = torch.randn(b, f)
+
+    for solver in ["eigvalsh", "lanczos"]:
+        regularizer = ManifoldRegularizer(
+            return_metrics=True, metrics_frequency=2, spectral_solver=solver
+        )
+        _, metrics = regularizer.manifold_regularizer_loss(x, y)
+        for key in ["Second smallest eigenvalue", "Spectral gap", "Laplacian energy"]:
+            assert isinstance(metrics[key], torch.Tensor) and torch.isfinite(metrics[key])
+        _, metrics = regularizer.manifold_regularizer_loss(x, y)
+        assert "Spectral gap" not in metrics
+        _, metrics = regularizer.manifold_regularizer_loss(x, y)
+        assert torch.allclose(metrics["Laplacian difference"], torch.tensor(0.0))
+
+        losses, metrics = regularizer.batched_manifold_regularizer_loss(torch.stack([x, y]), y)
+        assert "Spectral gap" not in metrics
+        losses, metrics = regularizer.batched_manifold_regularizer_loss(torch.stack([x, y]), y)
+        assert metrics["Spectral gap"].size() == (2,)
+        assert metrics["Laplacian energy"].size() == (2,)
+
+
+def test_knn_manifold_regularizer_loss():
+    l, b, f = 3, 32, 64
+    xs = torch.randn(l, b, f, requires_grad=True)
+    y = torch.randn(b, f, requires_grad=True)
+
+    # keeping all neighbours recovers the dense graph
+    dense_losses, _ = ManifoldRegularizer().batched_manifold_regularizer_loss(xs, y)
+    knn_losses, _ = ManifoldRegularizer(knn=b - 1).batched_manifold_regularizer_loss(xs, y)
+    assert torch.allclose(dense_losses, knn_losses, atol=1e-5)
+
+    regularizer = ManifoldRegularizer(knn=5)
+    losses, metrics = regularizer.batched_manifold_regularizer_loss(xs, y)
+    assert losses.size() == (l,) and metrics["gamma"].size() == (l,)
+    loss, _ = regularizer.manifold_regularizer_loss(xs[0], y)
+    assert torch.allclose(loss, losses[0], atol=1e-5)
+
+    losses.sum().backward()
+    assert xs.grad is not None and y.grad is not None
+
+
+def test_queued_manifold_regularizer_loss():
+    l, b, q, f = 2, 16, 24, 32
+    xs = torch.randn(l, b, f, requires_grad=True)
+    y = torch.randn(b, f, requires_grad=True)
+    xs_queue = torch.randn(l, q, f)
+    y_queue = torch.randn(q, f)
+
+    losses, _ = ManifoldRegularizer().batched_manifold_regularizer_loss(
+        xs, y, fixed_gamma=2.0 * f, xs_queue=xs_queue, y_queue=y_queue
+    )
+    losses.sum().backward()
+    assert xs.grad is not None and y.grad is not None
+
+    # dense graph over batch + queue without the edges between queued samples
+    n = b + q
+    for i in range(l):
+        x_all = torch.cat([xs[i], xs_queue[i]]).detach()
+        y_all = torch.cat([y, y_queue]).detach()
+        weights = torch.exp(-torch.cdist(x_all, x_all) ** 2 / (2.0 * f))
+        weights.fill_diagonal_(0)
+        weights[b:, b:] = 0
+        isqrt_diag = 1.0 / torch.sqrt(1e-4 + weights.sum(dim=-1))
+        laplacian = torch.eye(n) - isqrt_diag[:, None] * weights * isqrt_diag[None, :]
+        expected = torch.trace(y_all.T @ laplacian @ y_all) / n**2
+        assert torch.allclose(losses[i], expected, atol=1e-5)
+
+    # the queue also extends the sparse graph
+    losses, _ = ManifoldRegularizer(knn=5).batched_manifold_regularizer_loss(
+        xs, y, xs_queue=xs_queue, y_queue=y_queue
+    )
+    assert losses.size() == (l,) and torch.isfinite(losses).all()
@@ -21,6 +21,7 @@ import pytest
 import torch
 import torch.nn as nn
 from solo.methods.linear import LinearModel
+from torch.utils.data import DataLoader, TensorDataset
 from torchvision.models import resnet18
 
 from .utils import (
@@ -98,3 +99,33 @@ def test_linear():
     model.extra_optimizer_args = {}
     optimizer = model.configure_optimizers()
     assert isinstance(optimizer, torch.optim.Optimizer)
+
+
+def test_linear_cached_features():
+    cfg = gen_base_cfg("none", batch_size=2, num_classes=100)
+    cfg.cached_features = {"enabled": True}
+
+    backbone = resnet18()
+    backbone.fc = nn.Identity()
+
+    model = LinearModel(backbone, cfg=cfg)
+
+    # batches contain features instead of images
+    feats = torch.randn(cfg.optimizer.batch_size, model.backbone.inplanes).half()
+    out = model(feats)
+    assert out["logits"].size() == (cfg.optimizer.batch_size, cfg.data.num_classes)
+    assert out["feats"].dtype == torch.float32
+
+    dataset = TensorDataset(
+        torch.randn(8, model.backbone.inplanes).half(),
+        torch.randint(0, cfg.data.num_classes, (8,)),
+    )
+    train_dl = DataLoader(dataset, batch_size=cfg.optimizer.batch_size)
+    val_dl = DataLoader(dataset, batch_size=cfg.optimizer.batch_size)
+    trainer = gen_trainer(cfg)
+    trainer.fit(model, train_dl, val_dl)
+
+    # the backbone can not be finetuned on cached features
+    cfg.finetune = True
+    with pytest.raises(AssertionError):
+        LinearModel(backbone, cfg=cfg)
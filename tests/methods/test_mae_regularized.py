@@ -0,0 +1,108 @@
+# Copyright 2023 solo-learn development team.
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in
+# the Software without restriction, including without limitation the rights to use,
+# copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the
+# Software, and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all copies
+# or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR
+# PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE
+# FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR
+# OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+
+import torch
+from solo.losses.mae import normalize_patches, patchify
+from solo.methods.mae_regularized import MAE_REG
+
+from .utils import gen_base_cfg, gen_batch
+
+
+def test_mae_regularized():
+    method_kwargs = {
+        "decoder_embed_dim": 128,
+        "decoder_depth": 2,
+        "decoder_num_heads": 4,
+        "mask_ratio": 0.75,
+        "norm_pix_loss": True,
+        "layers": [3, 6, 11],
+        "reg_scheduler": {"name": "constant", "weight": 1.0},
+    }
+    cfg = gen_base_cfg("mae", batch_size=4, num_classes=10, momentum=True)
+    cfg.method_kwargs = method_kwargs
+    cfg.data.dataset = "cifar10"
+    cfg.backbone = {"name": "vit_small", "kwargs": {"img_size": 32, "patch_size": 8}}
+
+    model = MAE_REG(cfg)
+
+    # test arguments
+    model.add_and_assert_specific_cfg(cfg)
+
+    # test parameters
+    assert model.learnable_params is not None
+
+    # test forward
+    batch, _ = gen_batch(cfg.optimizer.batch_size, cfg.data.num_classes, "cifar10")
+    out = model(batch[1][0])
+    assert (
+        "logits" in out
+        and isinstance(out["logits"], torch.Tensor)
+        and out["logits"].size() == (cfg.optimizer.batch_size, cfg.data.num_classes)
+    )
+    assert (
+        "pred" in out
+        and isinstance(out["pred"], torch.Tensor)
+        and out["pred"].size() == (cfg.optimizer.batch_size, 4 * 4, 8 * 8 * 3)
+    )
+    for layer in method_kwargs["layers"]:
+        assert out[f"mean_block_{layer}"].size() == (cfg.optimizer.batch_size, model.features_dim)
+
+    # test training step
+    model.log_dict = lambda *args, **kwargs: None
+    loss = model.training_step(batch, 0)
+    assert loss.requires_grad
+    loss.backward()
+    assert model.backbone.blocks[3].mlp.fc1.weight.grad is not None
+
+    # test that forwarding all large crops in a single pass gives the same loss
+    losses = []
+    for fuse_large_crops in [False, True]:
+        model.fuse_large_crops = fuse_large_crops
+        torch.manual_seed(0)
+        losses.append(model.training_step(batch, 0))
+    assert torch.allclose(losses[0], losses[1], atol=1e-5)
+
+    # test that only decoding the masked patches gives the same loss
+    model.fuse_large_crops = False
+    model.decoder_masked_only = True
+    torch.manual_seed(0)
+    out = model(batch[1][0])
+    assert out["pred"].size() == (cfg.optimizer.batch_size, 12, 8 * 8 * 3)
+    torch.manual_seed(0)
+    assert torch.allclose(model.training_step(batch, 0), losses[0], atol=1e-5)
+    model.decoder_masked_only = False
+
+    # test that the targets precomputed by the data loading workers give the same loss
+    model.precompute_mae_targets = True
+    targets = [normalize_patches(patchify(x, 8)) for x in batch[1][: model.num_large_crops]]
+    torch.manual_seed(0)
+    loss = model.training_step([batch[0], [*batch[1], *targets], batch[2]], 0)
+    assert torch.allclose(loss, losses[0], atol=1e-5)
+    model.precompute_mae_targets = False
+
+    # test training with the regularizer queue
+    cfg.method_kwargs.reg_queue_size = 2 * cfg.optimizer.batch_size
+    model = MAE_REG(cfg)
+    model.log_dict = lambda *args, **kwargs: None
+    for step in range(3):
+        loss = model.training_step(batch, step)
+        loss.backward()
+    assert model.reg_queue.size() == (2, 2 * cfg.optimizer.batch_size, model.features_dim)
+    assert int(model.reg_queue_len) == 2 * cfg.optimizer.batch_size
+    assert int(model.reg_queue_ptr) == cfg.optimizer.batch_size
@@ -0,0 +1,80 @@
+# Copyright 2023 solo-learn development team.
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in
+# the Software without restriction, including without limitation the rights to use,
+# copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the
+# Software, and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all copies
+# or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR
+# PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE
+# FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR
+# OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+
+import torch
+from solo.methods.vicreg_regularized import VICReg_REG
+
+from .utils import gen_base_cfg, gen_batch
+
+
+def test_vicreg_regularized():
+    method_kwargs = {
+        "proj_output_dim": 128,
+        "proj_hidden_dim": 256,
+        "sim_loss_weight": 25.0,
+        "var_loss_weight": 25.0,
+        "cov_loss_weight": 1.0,
+        "layers": [3, 6, 11],
+        "reg_scheduler": {"name": "constant", "weight": 1.0},
+    }
+    cfg = gen_base_cfg("vicreg-reg", batch_size=4, num_classes=10, momentum=True)
+    cfg.method_kwargs = method_kwargs
+    cfg.data.dataset = "cifar10"
+    cfg.backbone = {"name": "vit_small", "kwargs": {"img_size": 32, "patch_size": 8}}
+    cfg.method_kwargs.reg_queue_size = 2 * cfg.optimizer.batch_size
+
+    model = VICReg_REG(cfg)
+
+    # test arguments
+    model.add_and_assert_specific_cfg(cfg)
+
+    # test parameters
+    assert model.learnable_params is not None
+
+    # test training with the regularizer queue
+    batch, _ = gen_batch(cfg.optimizer.batch_size, cfg.data.num_classes, "cifar10")
+    model.log = model.log_dict = lambda *args, **kwargs: None
+    batch_size, queue_size = cfg.optimizer.batch_size, cfg.method_kwargs.reg_queue_size
+    for step in range(3):
+        loss = model.training_step(batch, step)
+        assert torch.isfinite(loss)
+        loss.backward()
+        num_enqueued = (step + 1) * batch_size
+        assert int(model.reg_queue_len) == min(num_enqueued, queue_size)
+        assert int(model.reg_queue_ptr) == num_enqueued % queue_size
+    # the last block is the target, only the other layers are queued
+    assert model.reg_queue.size() == (2, 2 * cfg.optimizer.batch_size, model.features_dim)
+    assert model.backbone.blocks[3].mlp.fc1.weight.grad is not None
+
+    # only the regularized blocks and the last one are tapped, and only while training
+    X = batch[1][0]
+    out = model(X)
+    assert sorted(key for key in out if key.startswith("mean_block_")) == [
+        "mean_block_11",
+        "mean_block_3",
+        "mean_block_6",
+    ]
+    assert out["mean_block_3"].size() == (cfg.optimizer.batch_size, model.features_dim)
+
+    model.eval()
+    with torch.no_grad():
+        out = model(X)
+    assert not any(key.startswith("mean_block_") for key in out)
+    # the reductions of the eval forward are released instead of kept until the next step
+    assert not model.block_tap.block_feats
@@ -93,3 +93,19 @@ def test_checkpointer():
 
     # clean stuff
     shutil.rmtree(ckpt_callback.logdir)
+
+
+def test_checkpointer_every_n_steps():
+    cfg = gen_base_cfg("barlow_twins", batch_size=2, num_classes=100)
+    cfg = Checkpointer.add_and_assert_specific_cfg(cfg)
+    ckpt_callback = Checkpointer(cfg, every_n_steps=2)
+
+    saved_steps = []
+    ckpt_callback.save = lambda trainer, step=None: saved_steps.append(step)
+
+    # two micro-batches per optimizer step, as with accumulate_grad_batches=2
+    batch = (torch.arange(2), [torch.zeros(2, 3)], torch.zeros(2))
+    for global_step in [0, 0, 1, 1, 2, 2, 3, 3, 4, 4]:
+        trainer = argparse.Namespace(global_step=global_step)
+        ckpt_callback.on_train_batch_end(trainer, None, None, batch, 0)
+    assert saved_steps == [2, 4]
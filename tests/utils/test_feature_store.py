@@ -0,0 +1,83 @@
+# Copyright 2023 solo-learn development team.
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in
+# the Software without restriction, including without limitation the rights to use,
+# copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the
+# Software, and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all copies
+# or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR
+# PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE
+# FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR
+# OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+import torch
+import torch.nn as nn
+from solo.utils.feature_store import (
+    FeatureStore,
+    extract_features,
+    extract_or_load_features,
+    feature_store_key,
+)
+from torch.utils.data import DataLoader, TensorDataset
+
+
+class DummyModel(nn.Module):
+    def __init__(self):
+        super().__init__()
+        self.backbone = nn.Linear(8, 4)
+
+    def forward(self, x):
+        # no "z", as for MAE
+        return {"feats": self.backbone(x), "logits": x}
+
+
+def test_feature_store(tmp_path):
+    x = torch.randn(10, 8)
+    y = torch.arange(10)
+    loader = DataLoader(TensorDataset(x, y), batch_size=4)
+    model = DummyModel()
+
+    features = extract_features(loader, model, device="cpu")
+    assert set(features) == {"feats", "targets"}
+    assert features["feats"].dtype == torch.float16
+    assert features["feats"].shape == (10, 4)
+    assert torch.equal(features["targets"], y)
+    with torch.no_grad():
+        assert torch.allclose(features["feats"].float(), model.backbone(x), atol=1e-2)
+
+    # a backbone returns a tensor, which is stored as "feats"
+    backbone_features = extract_features(loader, model.backbone, device="cpu")
+    assert torch.equal(backbone_features["feats"], features["feats"])
+
+    ckpt_path = tmp_path / "model.ckpt"
+    torch.save(model.state_dict(), ckpt_path)
+    key = feature_store_key(ckpt_path, "dummy", None, "train")
+    assert key == feature_store_key(ckpt_path, "dummy", None, "train")
+    assert key != feature_store_key(ckpt_path, "dummy", None, "val")
+    assert key != feature_store_key(ckpt_path, "other", None, "train")
+
+    store = FeatureStore(tmp_path / "features")
+    assert key not in store
+    stored = extract_or_load_features(loader, model, store, key, device="cpu")
+    assert key in store
+
+    # the features are loaded instead of extracted again
+    loaded = extract_or_load_features(loader, None, store, key)
+    assert set(loaded) == set(stored)
+    for name in stored:
+        assert torch.equal(loaded[name], stored[name])
+
+    # the key changes with the checkpoint
+    torch.save(DummyModel().state_dict(), ckpt_path)
+    assert feature_store_key(ckpt_path, "dummy", None, "train") not in store
+
+    # the features of several passes over the loader are concatenated
+    views = extract_or_load_features(loader, model, device="cpu", num_views=2)
+    assert views["feats"].shape == (20, 4)
+    assert torch.equal(views["targets"], y.repeat(2))
@@ -59,3 +59,124 @@ def test_knn():
     assert acc1 >= 0 and acc1 <= 100
     assert acc5 >= 0 and acc5 <= 100
     assert acc5 >= acc1
+
+
+def test_streaming_knn():
+    num_samples_train = 100
+    num_samples_test = 20
+    num_classes = 10
+    features_dim = 16
+
+    train_features = torch.randn(num_samples_train, features_dim)
+    train_targets = torch.arange(end=num_classes).repeat(num_samples_train // num_classes)
+    test_features = torch.randn(num_samples_test, features_dim)
+    test_targets = torch.arange(end=num_classes).repeat(num_samples_test // num_classes)
+
+    for distance_fx in ["cosine", "euclidean"]:
+        results = []
+        for kwargs in [
+            {},
+            {"streaming": True},
+            {"offload_train_features": True},
+            {"sharded": True},
+        ]:
+            knn = WeightedKNNClassifier(
+                k=5, distance_fx=distance_fx, max_distance_matrix_size=200, **kwargs
+            )
+            # several batches of train features, streamed chunk by chunk
+            for features, targets in zip(train_features.split(30), train_targets.split(30)):
+                knn.update(train_features=features, train_targets=targets)
+            knn.update(test_features=test_features, test_targets=test_targets)
+            results.append(knn.compute())
+            assert not knn._local_train_features
+
+        # streaming in float32 finds the same neighbors
+        assert results[0] == results[1]
+        # float16 offloading may only flip near ties
+        assert abs(results[0][0] - results[2][0]) <= 10
+        # in a single process, sharded is the same as streaming
+        assert results[1] == results[3]
+
+        # the running top-k matches the top-k over all the train features
+        knn = WeightedKNNClassifier(k=5, distance_fx=distance_fx, max_distance_matrix_size=200)
+        features = F.normalize(test_features) if distance_fx == "cosine" else test_features
+        similarities, _ = knn._streaming_topk(
+            features, train_features.split(30), train_targets.split(30), 5
+        )
+        if distance_fx == "cosine":
+            expected = knn._similarities(features, F.normalize(train_features))
+        else:
+            expected = knn._similarities(features, train_features)
+        expected, _ = expected.topk(5)
+        assert torch.allclose(similarities, expected, atol=1e-5)
+
+
+def test_knn_sweep():
+    num_classes = 10
+    train_features = torch.randn(100, 16)
+    train_targets = torch.arange(end=num_classes).repeat(10)
+    test_features = torch.randn(20, 16)
+    test_targets = torch.arange(end=num_classes).repeat(2)
+
+    # neighbors searched once at the largest k
+    knn = WeightedKNNClassifier(k=20, distance_fx="cosine", streaming=True)
+    knn.update(train_features=train_features, train_targets=train_targets)
+    knn.update(test_features=test_features, test_targets=test_targets)
+    similarities, neighbors, targets = knn.compute_neighbors()
+    assert similarities.size() == neighbors.size() == (20, 20)
+    assert torch.equal(targets, test_targets)
+
+    for k in [1, 5, 20]:
+        for T in [0.02, 0.07, 0.2]:
+            expected_knn = WeightedKNNClassifier(k=k, T=T, distance_fx="cosine", streaming=True)
+            expected_knn.update(train_features=train_features, train_targets=train_targets)
+            expected_knn.update(test_features=test_features, test_targets=test_targets)
+            expected = expected_knn.compute()
+            assert (
+                knn.accuracy_from_neighbors(similarities, neighbors, targets, k=k, T=T) == expected
+            )
+
+
+def test_knn_forward_keeps_offloaded_features():
+    num_classes = 10
+    train_features = torch.randn(100, 16)
+    train_targets = torch.arange(end=num_classes).repeat(10)
+    test_features = torch.randn(20, 16)
+    test_targets = torch.arange(end=num_classes).repeat(2)
+
+    expected_knn = WeightedKNNClassifier(k=5, distance_fx="cosine", offload_train_features=True)
+    expected_knn.update(train_features=train_features, train_targets=train_targets)
+    expected_knn.update(test_features=test_features, test_targets=test_targets)
+    expected = expected_knn.compute()
+
+    # the methods feed the classifier batch by batch, as in training and validation steps
+    knn = WeightedKNNClassifier(k=5, distance_fx="cosine", offload_train_features=True)
+    for features, targets in zip(train_features.split(20), train_targets.split(20)):
+        knn(train_features=features, train_targets=targets)
+    for features, targets in zip(test_features.split(5), test_targets.split(5)):
+        knn(test_features=features, test_targets=targets)
+    assert sum(targets.size(0) for targets in knn._local_train_targets) == 100
+    assert knn.compute() == expected
+    assert not knn._local_train_features
+
+
+def test_sharded_knn_forward_keeps_local_features():
+    num_classes = 10
+    train_features = torch.randn(100, 16)
+    train_targets = torch.arange(end=num_classes).repeat(10)
+    test_features = torch.randn(20, 16)
+    test_targets = torch.arange(end=num_classes).repeat(2)
+
+    expected_knn = WeightedKNNClassifier(k=5, distance_fx="euclidean", sharded=True)
+    expected_knn.update(train_features=train_features, train_targets=train_targets)
+    expected_knn.update(test_features=test_features, test_targets=test_targets)
+    expected = expected_knn.compute()
+
+    knn = WeightedKNNClassifier(k=5, distance_fx="euclidean", sharded=True)
+    for features, targets in zip(train_features.split(20), train_targets.split(20)):
+        knn(train_features=features, train_targets=targets)
+    for features, targets in zip(test_features.split(5), test_targets.split(5)):
+        knn(test_features=features, test_targets=targets)
+    assert sum(targets.size(0) for targets in knn._local_train_targets) == 100
+    assert knn.compute() == expected
+    assert not knn._local_train_targets